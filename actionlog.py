@@ -0,0 +1,175 @@
+"""Structured action log. Records of the actions ({"t", "action", "path", ...}) and log messages
+are queued by the workers and written as JSON lines in batches by a background thread,
+a summary of the run is its last line. Runs are appended to the log. The script generators inline this module, the bash
+script feeds its command line with tab-separated records: action, path and key=value fields"""
+
+import sys
+import json
+import logging
+import threading
+from time import time
+from collections import Counter, deque
+
+
+class Summary:
+    """Counts of the actions, their errors and bytes, of the messages"""
+
+    def __init__(self, started: float = None):
+        self.actions, self.errors = Counter(), Counter()
+        self.bytes = 0
+        self.messages = 0
+        self.started = started
+        self.ended = started
+
+    def count(self, record: dict):
+        self.started = record["t"] if self.started is None else self.started
+        self.ended = record["t"]
+        if "action" not in record:
+            self.messages += 1
+            return
+        self.actions[record["action"]] += 1
+        if "error" in record:
+            self.errors[record["action"]] += 1
+        self.bytes += record.get("bytes") or 0
+
+    def as_dict(self) -> dict:
+        return {
+            "seconds": round((self.ended or 0) - (self.started or 0), 3),
+            "actions": dict(self.actions),
+            "errors": dict(self.errors),
+            "bytes": self.bytes,
+            "messages": self.messages,
+        }
+
+
+class ActionLog:
+    """Writes the queued records every 'interval' seconds, or once 'batch' are pending"""
+
+    def __init__(self, path: str, interval: float = 1.0, batch: int = 4096):
+        self.path = path
+        self.interval = interval
+        self.batch = batch
+        self.file = open(path, "a", encoding="utf-8", errors="surrogateescape")
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.summary = Summary(time())
+        self.wake = threading.Event()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def write(self, action: str, path: str = None, error=None, **fields):
+        record = {"t": round(time(), 3), "action": action, "path": path, **fields}
+        if error is not None:
+            record["error"] = str(error)
+        self.put(record)
+
+    def message(self, text: str, level: str = "INFO"):
+        self.put({"t": round(time(), 3), "level": level, "message": text})
+
+    def put(self, record: dict):
+        # deque.append is thread-safe, the writer isn't woken for each record
+        self.pending.append(record)
+        if len(self.pending) >= self.batch:
+            self.wake.set()
+
+    def loop(self):
+        while not self.closed.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines = list()
+            while self.pending:
+                record = self.pending.popleft()
+                self.summary.count(record)
+                lines.append(json.dumps(record))
+            if lines and not self.file.closed:
+                self.file.write("\n".join(lines) + "\n")
+                self.file.flush()
+
+    def close(self):
+        """Write the pending records and the summary of the run"""
+        if self.file.closed:
+            return
+        self.closed.set()
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        self.summary.ended = time()
+        with self.lock:
+            self.file.write(json.dumps({"summary": self.summary.as_dict()}) + "\n")
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ActionLogHandler(logging.Handler):
+    """Routes log messages to the ActionLog"""
+
+    def __init__(self, action_log: ActionLog):
+        super().__init__()
+        self.action_log = action_log
+
+    def emit(self, record):
+        self.action_log.message(self.format(record), record.levelname)
+
+
+def parse_line(line: str) -> tuple:
+    """(action, path, fields) of a tab-separated record, None if it's a plain message"""
+    action, sep, rest = line.partition("\t")
+    if not sep:
+        return None
+    path, *pairs = rest.split("\t")
+    fields = dict()
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        fields[key] = int(value) if value.isdigit() else value
+    return action, path, fields
+
+
+def read_summary(path: str, start: int = 0) -> dict:
+    """Summary of the last run closed after the start offset of the log, computed from
+    the records after the offset if the run wasn't closed"""
+    summary, last = Summary(), None
+    with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+        f.seek(start)
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "summary" in record:
+                last = record["summary"]
+            elif last is None:
+                summary.count(record)
+    return summary.as_dict() if last is None else last
+
+
+def append(path: str, records: list):
+    """Append records to the log of a completed run"""
+    with open(path, "a", encoding="utf-8", errors="surrogateescape") as f:
+        f.writelines(json.dumps({"t": round(time(), 3), **r}) + "\n" for r in records)
+
+
+def serve(path: str, stream, **opts):
+    """Log the records read from the stream, other lines are messages"""
+    with ActionLog(path, **opts) as log:
+        for line in stream:
+            line = line.rstrip("\n")
+            if (parsed := parse_line(line)) is not None:
+                action, name, fields = parsed
+                log.write(action, name, **fields)
+            elif line.strip():
+                log.message(line)
+
+
+if __name__ == "__main__":
+    # actionlog.py <logfile> '<options>' < records
+    serve(sys.argv[1], sys.stdin, **json.loads(sys.argv[2]))
@@ -0,0 +1,273 @@
+"""Typed plan of the actions - the intermediate representation between the monitors and the
+script generators. Actions of the monitors are lowered to ops, rewritten by the passes of the
+Optimizer and rendered by each generator, so an optimization of the plan lands in both backends"""
+
+import os
+from dataclasses import dataclass
+
+from scan import is_within, outermost
+
+MKDIR = "mkdir"
+MOVE = "move"
+REMOVE = "remove"
+RMTREE = "rmtree"
+META = "meta"
+COPY = "copy"
+UPDATE = "update"
+COPYTREE = "copytree"
+EXTRACT = "extract"
+
+TREES = {RMTREE, COPYTREE}
+REMOVALS = {REMOVE, RMTREE}
+TRANSFERS = {COPY, UPDATE, COPYTREE}
+# order of the emission: moves and removals precede the copies that could conflict with them
+RANKS = {
+    MKDIR: 0,
+    MOVE: 1,
+    REMOVE: 2,
+    RMTREE: 2,
+    META: 3,
+    COPY: 4,
+    UPDATE: 4,
+    COPYTREE: 4,
+    EXTRACT: 5,
+}
+
+
+@dataclass
+class Op:
+    """An operation of the plan. A source copied to many destinations (fanout) is a single op"""
+
+    kind: str
+    src: str | None
+    dsts: list
+    batch_id: int = 0
+    device: tuple = ()
+
+    @property
+    def dst(self) -> str:
+        return self.dsts[0]
+
+    @property
+    def action(self) -> str:
+        """Name of the action in the journal: remove, copy, update, meta, move, extract, mkdir"""
+        return {RMTREE: REMOVE, COPYTREE: COPY}.get(self.kind, self.kind)
+
+
+def lower(actions, monitor) -> list:
+    """Ops of the monitor's actions [{src, dst, action, batch_id}], one per destination"""
+    ops = list()
+    for a in actions:
+        if a["action"] == "remove":
+            dst = os.path.normpath(a["dst"])
+            kind = RMTREE if monitor.is_target_dir(dst) else REMOVE
+            ops.append(Op(kind, None, [dst], a["batch_id"]))
+        elif a["action"] == "copy":
+            kind = COPY if monitor.context.isfile(a["src"]) else COPYTREE
+            ops.append(Op(kind, a["src"], [a["dst"]], a["batch_id"]))
+        else:
+            ops.append(Op(a["action"], a["src"], [a["dst"]], a["batch_id"]))
+    return ops
+
+
+def lower_mkdirs(dirs: list) -> list:
+    """Dirs to create before the backup begins, if they don't exist yet"""
+    return [Op(MKDIR, None, [d]) for d in dirs if not os.path.exists(d)]
+
+
+class Optimizer:
+    """Rewrites the lowered plan before the emission. The structural passes always run:
+    no-ops are dropped, type conflicts resolved, children collapsed into their tree ops,
+    fanouts grouped and the ops ordered by the kind and the device.
+    With the 'optimize' options, renames are detected and mass copies merged into dir copies"""
+
+    def __init__(self, monitor, options: dict = None):
+        self.monitor = monitor
+        self.context = monitor.context
+        self.options = options
+        self.devices = dict()
+
+    @property
+    def passes(self) -> list:
+        passes = [self.drop_noops, self.resolve_conflicts]
+        if self.options is not None:
+            if self.options.get("moves", True):
+                passes.append(self.detect_moves)
+            if self.options.get("min_files", 64):
+                passes.append(self.merge_copies)
+        return [*passes, self.collapse, self.fanout, self.order]
+
+    def run(self, ops: list) -> list:
+        for p in self.passes:
+            ops = p(ops)
+        return ops
+
+    def drop_noops(self, ops: list) -> list:
+        """Duplicates, copies onto the source and metadata of files which are copied anyway"""
+        seen, out = set(), list()
+        copied = {op.dst for op in ops if op.kind in TRANSFERS}
+        for op in ops:
+            key = (op.kind, op.src, op.dst)
+            if key in seen or op.src == op.dst or (op.kind == META and op.dst in copied):
+                continue
+            seen.add(key)
+            out.append(op)
+        return out
+
+    def target_isdir(self, path: str) -> bool:
+        """If the destination path is a dir. Served from the scan if it was visited"""
+        try:
+            return self.context.kinds[path]
+        except KeyError:
+            e = self.monitor.get_target_entry(path)
+            return e is not None and e[2]
+
+    def target_isfile(self, path: str) -> bool:
+        try:
+            return not self.context.kinds[path]
+        except KeyError:
+            e = self.monitor.get_target_entry(path)
+            return e is not None and not e[2]
+
+    def resolve_conflicts(self, ops: list) -> list:
+        """A file replacing a dir and a dir replacing a file: the destination is removed first
+        and a dir replacing a file is copied as a whole"""
+        out, parents = list(), dict()
+        for op in ops:
+            if op.kind == UPDATE and self.target_isdir(op.dst):
+                out.append(Op(RMTREE, None, [op.dst]))
+                op = Op(COPY, op.src, op.dsts, op.batch_id)
+            elif op.kind in {COPY, COPYTREE}:
+                dst_dir = os.path.dirname(op.dst)
+                if dst_dir not in parents:
+                    parents[dst_dir] = self.target_isfile(dst_dir)
+                if parents[dst_dir]:
+                    src_dir = os.path.dirname(op.src)
+                    out.append(Op(REMOVE, None, [dst_dir]))
+                    out.append(Op(COPYTREE, src_dir, [dst_dir], op.batch_id))
+                    # the first copy of the dir replaced the file
+                    parents[dst_dir] = False
+            out.append(op)
+        return out
+
+    def detect_moves(self, ops: list) -> list:
+        """A removed file and a copied one of the same size and mtime are a rename
+        on the destination, if the match is unique, on the same device and of the same content"""
+        from verify import compare
+
+        prec = self.monitor.config["settings"].get("sync_precision", 1)
+
+        def bucket(mtime: float):
+            return round(mtime / prec) if prec else mtime
+
+        removed, copied = dict(), dict()
+        for op in ops:
+            if op.kind == REMOVE:
+                if e := self.monitor.get_target_entry(op.dst):
+                    removed.setdefault((e[0], bucket(e[1])), list()).append(op)
+            elif op.kind == COPY:
+                try:
+                    st = os.stat(op.src)
+                except OSError:
+                    continue
+                copied.setdefault((st.st_size, bucket(st.st_mtime)), list()).append(op)
+        moves = dict()
+        for key, (rm,) in ((k, v) for k, v in removed.items() if len(v) == 1):
+            if key[0] <= 0 or len(cp := copied.get(key, ())) != 1:
+                continue
+            if self.get_device(rm.dst) != self.get_device(cp[0].dst):
+                continue
+            # the size and the mtime may match by chance
+            if compare((cp[0].src, rm.dst)) is None:
+                moves[id(rm)] = moves[id(cp[0])] = Op(MOVE, rm.dst, cp[0].dsts, cp[0].batch_id)
+        out = list()
+        for op in ops:
+            if (move := moves.pop(id(op), None)) is not None:
+                if op.kind == COPY:
+                    out.append(move)
+                continue
+            out.append(op)
+        return out
+
+    def merge_copies(self, ops: list) -> list:
+        """At least 'min_files' files copied from a dir holding nothing else, into a dir holding
+        nothing else, are a single copy of the dir. It replaces the destination dir at once"""
+        min_files = self.options.get("min_files", 64)
+        groups, removed = dict(), {op.dst for op in ops if op.kind in REMOVALS}
+        for op in ops:
+            if op.kind in {COPY, UPDATE}:
+                key = (os.path.dirname(op.src), os.path.dirname(op.dst), op.batch_id)
+                groups.setdefault(key, list()).append(op)
+        merged = dict()
+        for (src_dir, dst_dir, batch_id), group in groups.items():
+            if len(group) < min_files:
+                continue
+            srcs, dsts = {op.src for op in group}, {op.dst for op in group}
+            try:
+                listed = self.monitor.list_src(src_dir, batch_id)
+            except OSError:
+                continue
+            if set(listed) != srcs or any(self.context.isdir(p) for p in listed):
+                continue
+            if any(p not in dsts and p not in removed for p in self.monitor.list_target(dst_dir)):
+                continue
+            tree = Op(COPYTREE, src_dir, [dst_dir], batch_id)
+            for op in group:
+                merged[id(op)] = tree
+        out, emitted = list(), set()
+        for op in ops:
+            if (tree := merged.get(id(op))) is None:
+                out.append(op)
+            elif id(tree) not in emitted:
+                emitted.add(id(tree))
+                out.append(tree)
+        return out
+
+    def collapse(self, ops: list) -> list:
+        """Ops within a copied or a removed tree are carried out by the tree op"""
+        return outermost(ops, lambda op: op.dst, lambda op: op.kind in TREES)
+
+    def fanout(self, ops: list) -> list:
+        """Transfers and metadata of the same source are a single op for all destinations,
+        the source is read only once. Only ops of paths with the same excludes are grouped,
+        as a dir copy applies the excludes of its first op to all the destinations"""
+        out, groups = list(), dict()
+        for op in ops:
+            if op.kind not in TRANSFERS | {META}:
+                out.append(op)
+                continue
+            exclude = self.monitor.config["paths"][op.batch_id].get("exclude") or ()
+            key = (op.kind == META, op.src, tuple(exclude))
+            if key not in groups:
+                groups[key] = Op(op.kind, op.src, list(op.dsts), op.batch_id)
+                out.append(groups[key])
+                continue
+            group = groups[key]
+            group.dsts.extend(op.dsts)
+            if op.kind == COPYTREE:
+                group.kind = COPYTREE
+        return out
+
+    def get_device(self, path: str) -> int:
+        """Device of the innermost source or destination root containing the path"""
+        roots = [
+            r for p in self.context.paths for r in (p["src"], p["dst"]) if is_within(path, r)
+        ]
+        if not roots:
+            return None
+        root = max(roots, key=len)
+        if root not in self.devices:
+            try:
+                self.devices[root] = os.stat(root).st_dev
+            except OSError:
+                self.devices[root] = None
+        return self.devices[root]
+
+    def order(self, ops: list) -> list:
+        """By the kind, then grouped per device - the transfers by both of their devices"""
+        for op in ops:
+            if op.kind in TRANSFERS | {META, EXTRACT}:
+                op.device = (self.get_device(op.src), self.get_device(op.dst))
+            else:
+                op.device = (self.get_device(op.dst),)
+        return sorted(ops, key=lambda op: (RANKS[op.kind], str(op.device), op.dst))
@@ -15,15 +15,21 @@ class AgnosticBase(ABC):
         )
         for i, v in enumerate(config["settings"].setdefault("mkdirs", [])):
             config["settings"]["mkdirs"][i] = os.path.normpath(v)
-        batch_id = 0
+        paths = list()
         for i, v in enumerate(config["paths"]):
-            config["paths"][i]["batch_id"] = batch_id
-            config["paths"][i]["src"] = os.path.normpath(v["src"])
-            try:
-                config["paths"][i]["dst"] = os.path.normpath(v["dst"])
-            except KeyError:
-                config["paths"][i]["dst"] = config["settings"]["defaultdst"]
-            batch_id += 1
+            dst = v.get("dst", config["settings"]["defaultdst"])
+            if isinstance(dst, list):
+                # Fan-out: the source is scanned once for all destinations
+                paths.extend({**v, "dst": d, "fanout": i} for d in dst)
+            else:
+                paths.append({**v, "dst": dst})
+        for batch_id, v in enumerate(paths):
+            if "layout" in config["settings"]:
+                v.setdefault("layout", config["settings"]["layout"])
+            v["batch_id"] = batch_id
+            v["src"] = os.path.normpath(v["src"])
+            v["dst"] = os.path.normpath(v["dst"])
+        config["paths"] = paths
         return config
 
 
@@ -35,7 +41,7 @@ class LinuxBase:
     def execute(tmpfile):
         """Runs the backup script"""
         run(["chmod", "+x", tmpfile])
-        run([f"./{tmpfile}"], shell=True)
+        return run([f"./{tmpfile}"], shell=True).returncode
 
 
 class PythonBase:
@@ -45,4 +51,4 @@ class PythonBase:
     @staticmethod
     def execute(tmpfile):
         """Runs the backup script"""
-        run([f"python3 ./{tmpfile}"], shell=True)
+        return run([f"python3 ./{tmpfile}"], shell=True).returncode
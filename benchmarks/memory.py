@@ -0,0 +1,77 @@
+"""Peak RSS of the plan generation, unbounded vs within the 'memory' budget. Each
+generation runs in its own process, over a mirrored tree of the given number of files.
+Linux only - the peak is read from /proc.
+
+    python benchmarks/memory.py [--files N] [--budgets MIB,...]
+"""
+
+import os
+import sys
+import json
+import argparse
+from subprocess import run as run_process
+from tempfile import TemporaryDirectory
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# builds the tree and reports the peak RSS of the generation
+RSS_PROBE = """
+import os, sys, json
+sys.path.insert(0, {root!r})
+from base import AgnosticBase
+from monitors import PythonMonitor
+
+def status(key):
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) << 10 for line in f if line.startswith(key))
+
+cfg = json.loads(sys.argv[1])
+src, dst = cfg["paths"][0]["src"], os.path.join(cfg["paths"][0]["dst"], "src")
+for i in range(int(sys.argv[2])):
+    d = f"d{{i % 50}}"
+    name = f"{{d}}/{{i:06}}" + "x" * 150
+    os.makedirs(os.path.join(src, d), exist_ok=True)
+    os.makedirs(os.path.join(dst, d), exist_ok=True)
+    open(os.path.join(src, name), "w").close()
+    os.link(os.path.join(src, name), os.path.join(dst, name))
+monitor = PythonMonitor(AgnosticBase().parse_config(cfg))
+# reset the peak RSS to the current one
+with open("/proc/self/clear_refs", "w") as f:
+    f.write("5")
+base = status("VmRSS")
+res = monitor.generate()
+print(json.dumps({{"actions": len(res), "peak": status("VmHWM") - base}}))
+"""
+
+
+def run(files: int = 20000, budgets=(None, 1)) -> dict:
+    """Peak RSS in bytes per budget in MiB, None stands for unbounded"""
+    with open(os.path.join(ROOT, "profiles", "example.json"), "r") as f:
+        profile = json.load(f)
+    results = dict()
+    for budget in budgets:
+        with TemporaryDirectory() as tmp:
+            cfg = {**profile, "settings": {**profile["settings"], "mkdirs": [], "memory": budget}}
+            cfg["paths"] = [{"src": f"{tmp}/src", "dst": f"{tmp}/dst"}]
+            out = run_process(
+                [sys.executable, "-c", RSS_PROBE.format(root=ROOT), json.dumps(cfg), str(files)],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            res = json.loads(out.stdout.splitlines()[-1])
+            assert res["actions"] == 0, res
+            results[budget] = res["peak"]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--budgets", default="1")
+    args = parser.parse_args()
+    budgets = [None] + [float(b) for b in args.budgets.split(",")]
+    res = run(args.files, budgets)
+    for budget, peak in res.items():
+        name = f"{budget:g} MiB" if budget else "unbounded"
+        print(f"{name:12}{peak / (1 << 20):8.1f} MiB {res[None] / max(peak, 1):8.1f}x")
@@ -0,0 +1,99 @@
+"""Small files copied one by one vs packed into tar batches, on a local stand-in
+for a high-latency mount: each open/chmod/utime/rename/makedirs under the mount
+sleeps for the given latency.
+
+    python benchmarks/packing.py [--files N] [--size BYTES] [--latency SECONDS]
+"""
+
+import os
+import sys
+import shutil
+import argparse
+from time import sleep, perf_counter
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import runtime  # noqa: E402
+
+
+class LatentMount:
+    """Injects the latency into the metadata operations on paths under the root"""
+
+    OS_CALLS = ("replace", "chmod", "utime", "makedirs")
+
+    def __init__(self, root: str, latency: float):
+        self.root = root
+        self.latency = latency
+        self.patches = list()
+
+    def wrap(self, fn):
+        def wrapper(path, *args, **kwargs):
+            if isinstance(path, str) and path.startswith(self.root):
+                sleep(self.latency)
+            return fn(path, *args, **kwargs)
+
+        return wrapper
+
+    def __enter__(self):
+        self.patches = [
+            mock.patch.object(os, name, self.wrap(getattr(os, name))) for name in self.OS_CALLS
+        ]
+        # the modules opening files on the mount
+        self.patches.extend(
+            mock.patch.object(mod, "open", self.wrap(open), create=True)
+            for mod in (shutil, runtime)
+        )
+        for p in self.patches:
+            p.start()
+        return self
+
+    def __exit__(self, *exc):
+        for p in self.patches:
+            p.stop()
+
+
+def make_files(root: str, files: int, size: int) -> list:
+    paths = list()
+    for i in range(files):
+        path = os.path.join(root, f"d{i % 16}", f"f{i}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def run(files: int = 500, size: int = 4096, latency: float = 0.002) -> dict:
+    """Seconds taken by each method"""
+    results = dict()
+    with TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "src")
+        paths = make_files(src, files, size)
+        for method in ("per-file", "packed"):
+            dst = os.path.join(tmp, method)
+            os.makedirs(dst)
+            with LatentMount(dst, latency):
+                t0 = perf_counter()
+                if method == "packed":
+                    packer = runtime.Packer()
+                    for p in paths:
+                        packer.cp(p, os.path.join(dst, os.path.relpath(p, src)))
+                    packer.close()
+                else:
+                    for p in paths:
+                        runtime.cp(p, os.path.join(dst, os.path.relpath(p, src)))
+                results[method] = perf_counter() - t0
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--latency", type=float, default=0.002)
+    args = parser.parse_args()
+    res = run(args.files, args.size, args.latency)
+    for method, secs in res.items():
+        print(f"{method:10}{secs:8.3f}s {args.files / secs:10.0f} files/s")
+    print(f"speedup   {res['per-file'] / res['packed']:8.1f}x")
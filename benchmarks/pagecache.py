@@ -0,0 +1,103 @@
+"""Page-cache footprint of copying a large file: shutil.copy2 vs the CopyIO engine
+(buffered with fadvise, and O_DIRECT). The footprint is the part of the source and
+of the destination resident in the page cache right after the copy (mincore).
+Run it on the filesystem of interest - tmpfs has no cache to spare.
+
+    python benchmarks/pagecache.py [--size MIB] [--dir DIR]
+"""
+
+import os
+import sys
+import mmap
+import ctypes
+import shutil
+import argparse
+import ctypes.util
+from time import perf_counter
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import runtime  # noqa: E402
+
+PAGE = mmap.PAGESIZE
+
+
+def resident(path: str) -> int:
+    """Bytes of the file in the page cache"""
+    size = os.path.getsize(path)
+    if not size:
+        return 0
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int]
+    libc.mmap.argtypes += [ctypes.c_int, ctypes.c_long]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+    vec = (ctypes.c_ubyte * ((size + PAGE - 1) // PAGE))()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), "mmap failed")
+        try:
+            if libc.mincore(addr, size, vec) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed")
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+    return sum(v & 1 for v in vec) * PAGE
+
+
+def evict(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def make_file(path: str, size: int):
+    """A file of random data, written back and evicted from the cache"""
+    chunk = os.urandom(1 << 20)
+    with open(path, "wb") as f:
+        for _ in range(size >> 20):
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    evict(path)
+
+
+def run(size: int = 256 << 20, root: str = None) -> dict:
+    """{method: (seconds, resident bytes of the source, of the destination)}"""
+    methods = {
+        "copy2": shutil.copy2,
+        "copyio": runtime.CopyIO().copy,
+        "direct": runtime.CopyIO(direct=1).copy,
+    }
+    results = dict()
+    with TemporaryDirectory(dir=root) as tmp:
+        src = os.path.join(tmp, "src.bin")
+        make_file(src, size)
+        for method, fn in methods.items():
+            dst = os.path.join(tmp, f"{method}.bin")
+            evict(src)
+            t0 = perf_counter()
+            fn(src, dst)
+            results[method] = (perf_counter() - t0, resident(src), resident(dst))
+            os.remove(dst)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=256, help="MiB")
+    parser.add_argument("--dir", default=None)
+    args = parser.parse_args()
+    res = run(args.size << 20, args.dir)
+    print(f"{'method':8}{'seconds':>9}{'MiB/s':>8}{'src cached':>12}{'dst cached':>12}")
+    for method, (secs, src, dst) in res.items():
+        print(
+            f"{method:8}{secs:9.3f}{args.size / secs:8.0f}"
+            f"{src / (1 << 20):10.1f}Mi{dst / (1 << 20):10.1f}Mi"
+        )
@@ -0,0 +1,63 @@
+"""Walk of a single tree by build_tree vs the work-stealing ParallelWalker, on a local
+stand-in for a high-latency mount: each listing of a dir sleeps for the given latency.
+
+    python benchmarks/scan.py [--dirs N] [--files N] [--latency SECONDS] [--workers 1,2,4,8]
+"""
+
+import os
+import re
+import sys
+import argparse
+from time import sleep, perf_counter
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import scan  # noqa: E402
+
+
+def make_tree(root: str, dirs: int, files: int):
+    """Unbalanced tree - most of the dirs are under the first one"""
+    for i in range(dirs):
+        parts = (["big"] if i % 4 else []) + [f"d{j}" for j in str(i)[:3]]
+        path = os.path.join(root, *parts, f"n{i}")
+        os.makedirs(path, exist_ok=True)
+        for j in range(files):
+            open(os.path.join(path, f"f{j}"), "w").close()
+
+
+def run(dirs: int = 400, files: int = 10, latency: float = 0.002, workers=(1, 2, 4, 8)) -> dict:
+    """Seconds taken by each number of workers, 0 stands for build_tree"""
+    results = dict()
+    exclude = re.compile(r".^")
+    scandir = os.scandir
+
+    def latent(path):
+        sleep(latency)
+        return scandir(path)
+
+    with TemporaryDirectory() as tmp:
+        make_tree(tmp, dirs, files)
+        with mock.patch.object(os, "scandir", latent):
+            for n in (0, *workers):
+                t0 = perf_counter()
+                if n:
+                    scan.build_tree_parallel(tmp, exclude, dict(), workers=n)
+                else:
+                    scan.build_tree(tmp, exclude, dict())
+                results[n] = perf_counter() - t0
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dirs", type=int, default=400)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.002)
+    parser.add_argument("--workers", default="1,2,4,8")
+    args = parser.parse_args()
+    workers = [int(n) for n in args.workers.split(",")]
+    res = run(args.dirs, args.files, args.latency, workers)
+    for n, secs in res.items():
+        name = f"{n} workers" if n else "build_tree"
+        print(f"{name:12}{secs:8.3f}s {res[0] / secs:8.1f}x")
@@ -0,0 +1,127 @@
+"""Content-addressed store. Files are stored once per unique content under
+objects/<hash>, and every run commits a manifest mapping paths to the objects.
+The script generators inline this module, so it must depend only on the stdlib"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+from datetime import datetime
+
+log = logging.getLogger("OpenBackup")
+
+
+class CasStore:
+
+    def __init__(self, root: str, bufsize: int = 1 << 20):
+        self.root = root
+        self.bufsize = bufsize
+        self.objects = os.path.join(root, "objects")
+        self.manifests = os.path.join(root, "manifests")
+        self.manifest = self.load_manifest()
+
+    def get_object_path(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def hash_file(self, path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            while buf := f.read(self.bufsize):
+                h.update(buf)
+        return h.hexdigest()
+
+    def put(self, src: str, key: str):
+        """Store the content of src (unless already present) and map the key to it"""
+        digest = self.hash_file(src)
+        obj = self.get_object_path(digest)
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            shutil.copyfile(src, f"{obj}.tmp")
+            os.replace(f"{obj}.tmp", obj)
+            log.info(f"Stored object {digest} from {src}")
+        st = os.stat(src)
+        self.manifest[key] = {
+            "hash": digest,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "mode": st.st_mode & 0o7777,
+        }
+
+    def drop(self, key: str):
+        self.manifest.pop(key, None)
+        log.info(f"Dropped {key}")
+
+    def commit(self) -> str:
+        """Save the manifest of this run"""
+        os.makedirs(self.manifests, exist_ok=True)
+        name = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        path = os.path.join(self.manifests, f"{name}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(f"{path}.tmp", path)
+        log.info(f"Committed manifest {name} ({len(self.manifest):,} files)")
+        return name
+
+    def list_manifests(self) -> list:
+        try:
+            return sorted(
+                f[:-5] for f in os.listdir(self.manifests) if f.endswith(".json")
+            )
+        except FileNotFoundError:
+            return []
+
+    def load_manifest(self, name: str = None) -> dict:
+        """Load the given or the latest manifest"""
+        if name is None:
+            if not (names := self.list_manifests()):
+                return dict()
+            name = names[-1]
+        with open(os.path.join(self.manifests, f"{name}.json"), "r") as f:
+            return json.load(f)
+
+    def materialize(self, target: str, name: str = None, subpath: str = "") -> int:
+        """Recreate files of the manifest (or of its subpath) under the target.
+        Files matching by size and mtime are skipped. Returns number of files written"""
+        manifest = self.load_manifest(name)
+        prefix = subpath.strip("/")
+        written = 0
+        for key, e in manifest.items():
+            if prefix and not (key == prefix or key.startswith(f"{prefix}/")):
+                continue
+            dst = os.path.join(target, key)
+            try:
+                st = os.stat(dst)
+                if st.st_size == e["size"] and st.st_mtime == e["mtime"]:
+                    continue
+            except FileNotFoundError:
+                pass
+            os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+            shutil.copyfile(self.get_object_path(e["hash"]), f"{dst}.tmp")
+            os.chmod(f"{dst}.tmp", e["mode"])
+            os.utime(f"{dst}.tmp", (e["mtime"], e["mtime"]))
+            os.replace(f"{dst}.tmp", dst)
+            written += 1
+        return written
+
+    def gc(self, keep: int = 1) -> tuple:
+        """Remove all but the latest 'keep' manifests and the objects they don't reference.
+        Returns (removed manifests, removed objects, freed bytes)"""
+        names = self.list_manifests()
+        stale = names[: max(len(names) - keep, 0)]
+        for name in stale:
+            os.remove(os.path.join(self.manifests, f"{name}.json"))
+        referenced = set()
+        for name in names[len(stale) :]:
+            referenced |= {e["hash"] for e in self.load_manifest(name).values()}
+        removed, freed = 0, 0
+        for root, _, files in os.walk(self.objects):
+            for f in files:
+                digest = f"{os.path.basename(root)}{f}"
+                if digest not in referenced:
+                    path = os.path.join(root, f)
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                    removed += 1
+        self.manifest = self.load_manifest()
+        return len(stale), removed, freed
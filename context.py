@@ -0,0 +1,120 @@
+import os
+import re
+
+
+def expand_braces(text: str) -> list:
+    """Brace expansion with many and nested groups: 'a{b,c{d,e}}{1,2}' -> [ab1, ab2, acd1, ...].
+    Unbalanced braces are taken literally"""
+    start = text.find("{")
+    if start < 0:
+        return [text]
+    depth, last, parts = 0, start + 1, list()
+    for i in range(start, len(text)):
+        if text[i] == "{":
+            depth += 1
+        elif text[i] == "}":
+            depth -= 1
+            if depth == 0:
+                parts.append(text[last:i])
+                break
+        elif text[i] == "," and depth == 1:
+            parts.append(text[last:i])
+            last = i + 1
+    else:
+        return [text]
+    pre, post = text[:start], text[i + 1 :]
+    return [
+        res
+        for part in parts
+        for alt in expand_braces(part)
+        for res in expand_braces(f"{pre}{alt}{post}")
+    ]
+
+
+def expand_paths(paths: list) -> list:
+    """Paths with braces in the src are divided into separate 'plain' paths,
+    which follow the paths that didn't need an expansion"""
+    plain, expanded = list(), list()
+    for v in paths:
+        if "{" in v["src"]:
+            expanded.extend({**v, "src": src} for src in expand_braces(v["src"]))
+        else:
+            plain.append(v)
+    return plain + expanded
+
+
+class PlanContext:
+    """State of a single run, shared by the script generator and its monitors:
+    expanded paths, compiled excludes, target roots, archive indexes and what the scan learned
+    about the visited entries (dir mtimes, entry kinds, source mtimes, dir digests)"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.paths = expand_paths(config["paths"])
+        self.matchers = dict()
+        self.target_roots = dict()
+        self.manifests = dict()
+        self.archives = dict()
+        self.digest_stores = dict()
+        self.agent = None
+        self.reset()
+
+    def reset(self):
+        """Forget results of the previous scan"""
+        for runs in getattr(self, "src_runs", dict()).values():
+            runs.close()
+        self.src_runs = dict()
+        self.digests = dict()
+        self.fingerprint = dict()
+        self.scan_cache = dict()
+        self.kinds = dict()
+        self.mtimes = dict()
+        self.snapshots = dict()
+
+    def get_paths(self, paths: list) -> list:
+        """Expanded paths, precomputed for the paths of the config"""
+        return self.paths if paths is self.config["paths"] else expand_paths(paths)
+
+    def get_matcher(self, excl: list, compile_fn) -> re.Pattern:
+        key = tuple(excl or ())
+        if key not in self.matchers:
+            self.matchers[key] = compile_fn(excl)
+        return self.matchers[key]
+
+    def get_target_root(self, path: dict) -> str:
+        """Where the src of the path is mirrored to"""
+        key = (path["src"], path["dst"])
+        if key not in self.target_roots:
+            self.target_roots[key] = os.path.join(path["dst"], os.path.basename(path["src"]))
+        return self.target_roots[key]
+
+    def isdir(self, path: str) -> bool:
+        """Served from the scan if the path was visited"""
+        try:
+            return self.kinds[path]
+        except KeyError:
+            return os.path.isdir(path)
+
+    def isfile(self, path: str) -> bool:
+        try:
+            return not self.kinds[path]
+        except KeyError:
+            return os.path.isfile(path)
+
+    def get_mtime(self, path: str) -> float:
+        """Cached, as the source may be compared with many destinations"""
+        try:
+            return self.mtimes[path]
+        except KeyError:
+            self.mtimes[path] = os.stat(path).st_mtime
+            return self.mtimes[path]
+
+    def get_archive_index(self, archive: str) -> list:
+        """Members of the archive, read once while it's unchanged"""
+        from extract import read_index
+
+        st = os.stat(archive)
+        key = (archive, st.st_size, st.st_mtime_ns)
+        if key not in self.archives:
+            self.archives[key] = read_index(archive)
+        return self.archives[key]
@@ -0,0 +1,100 @@
+"""Merkle digests of the scanned trees. The digest of a dir covers the (name, size, mtime)
+of its files and the digests of its subdirs, so equal digests mean equal subtrees.
+Digests of a source mirrored by a successful run are persisted at the destination, along
+with the mtimes of the destination dirs, and the next scan compares only the subtrees whose
+digests differ or whose destination dirs were modified since"""
+
+import os
+import sqlite3
+from time import time
+from hashlib import blake2b
+from urllib.parse import quote
+
+
+def get_digests(rootdir: str, tree: set, isdir, stat) -> dict:
+    """Digests of the rootdir and the dirs of its tree {dir: digest}.
+    Empty if the rootdir is not a dir"""
+    if not isdir(rootdir):
+        return dict()
+    children, dirs = dict(), [rootdir]
+    for path in tree:
+        children.setdefault(os.path.dirname(path), list()).append(path)
+        if isdir(path):
+            dirs.append(path)
+    digests = dict()
+    # subdirs are hashed before their parents
+    for d in sorted(dirs, key=lambda d: -d.count("/")):
+        h = blake2b(digest_size=16)
+        for path in sorted(children.get(d, ())):
+            name = path[len(d) + 1 :]
+            if path in digests:
+                h.update(f"{name}/\0{digests[path]}\0".encode(errors="surrogateescape"))
+                continue
+            try:
+                st = stat(path)
+                entry = f"{name}\0{st.st_size}\0{st.st_mtime_ns}\0"
+            except OSError:
+                entry = f"{name}\0?\0"
+            h.update(entry.encode(errors="surrogateescape"))
+        digests[d] = h.hexdigest()
+    return digests
+
+
+def get_mtime_ns(path: str) -> int:
+    """Mtime of the destination dir, None if it's missing"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class DigestStore:
+    """Digests of the trees mirrored to a destination, kept in a SQLite file at its root,
+    each with the mtime of its destination dir. Paths of the dirs are relative to the source,
+    '' being the source itself"""
+
+    NAME = ".obdigests.db"
+
+    def __init__(self, root: str, readonly: bool = False):
+        self.root = root
+        self.path = os.path.join(root, self.NAME)
+        if readonly:
+            # the plan only reads the digests, they're saved once the run succeeded
+            if not os.path.isfile(self.path):
+                raise FileNotFoundError(self.path)
+            self.db = sqlite3.connect(f"file:{quote(self.path)}?mode=ro", uri=True)
+            return
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS digests "
+            "(tree TEXT, path TEXT, digest TEXT, mtime INTEGER, PRIMARY KEY (tree, path))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS trees (tree TEXT PRIMARY KEY, exclude TEXT, saved REAL)"
+        )
+        self.db.commit()
+
+    def load(self, tree: str, exclude: str, max_age: float = None) -> dict:
+        """{path: (digest, mtime)} of the tree, empty if it was saved with other excludes
+        or before max_age"""
+        row = self.db.execute(
+            "SELECT exclude, saved FROM trees WHERE tree = ?", (tree,)
+        ).fetchone()
+        if not row or row[0] != exclude or (max_age and time() - row[1] >= max_age):
+            return dict()
+        rows = self.db.execute("SELECT path, digest, mtime FROM digests WHERE tree = ?", (tree,))
+        return {p: (h, mtime) for p, h, mtime in rows}
+
+    def save(self, tree: str, exclude: str, digests: dict):
+        """Replace the digests of the tree {path: (digest, mtime)}"""
+        self.db.execute("DELETE FROM digests WHERE tree = ?", (tree,))
+        self.db.executemany(
+            "INSERT INTO digests VALUES (?, ?, ?, ?)",
+            ((tree, p, h, mtime) for p, (h, mtime) in digests.items()),
+        )
+        self.db.execute("INSERT OR REPLACE INTO trees VALUES (?, ?, ?)", (tree, exclude, time()))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
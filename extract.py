@@ -0,0 +1,353 @@
+"""Extraction of archives ('extract' paths). The index of the archive is read once,
+members matching the destination by size and mtime are skipped and the others are
+written by a pool of workers. Multi-member gzip streams (bgzip, concatenated archives)
+are decompressed in parallel, single-member ones are left to the tarfile. The script generators inline this module"""
+
+import os
+import sys
+import mmap
+import zlib
+import tarfile
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("OpenBackup")
+GZIP_MAGIC = b"\x1f\x8b\x08"
+CHUNK = 1 << 20
+COMPRESSED_MAGIC = (GZIP_MAGIC, b"BZh", b"\xfd7zXZ\x00")
+EXTRACT_FILTER = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+
+def normalize(name: str) -> str:
+    """Member name relative to the destination, None if it would escape it"""
+    name = os.path.normpath(name.lstrip("/"))
+    if name == "." or name.startswith("../") or name == "..":
+        return None
+    return name
+
+
+def is_compressed(archive: str) -> bool:
+    with open(archive, "rb") as f:
+        head = f.read(6)
+    return any(head.startswith(m) for m in COMPRESSED_MAGIC)
+
+
+def is_gzip(archive: str) -> bool:
+    with open(archive, "rb") as f:
+        return f.read(3) == GZIP_MAGIC
+
+
+def matches(info: tarfile.TarInfo, dst: str, precision: float = 1) -> bool:
+    """If the member is already at the destination"""
+    try:
+        st = os.lstat(dst)
+    except OSError:
+        return False
+    if info.isreg():
+        return st.st_size == info.size and abs(st.st_mtime - info.mtime) <= precision
+    if info.isdir():
+        return os.path.isdir(dst)
+    return True
+
+
+class GzipMembers:
+    """Decompressed stream of a gzip file. Each member starts with the gzip magic,
+    so members are decompressed concurrently between the candidate offsets.
+    A candidate inside a member is a false one - the member is then decompressed
+    serially and the stream continues at its actual end. So is a member inflating
+    to more than 'max_member' bytes, the serial data is yielded in bounded chunks"""
+
+    def __init__(
+        self, path: str, workers: int = None, window: int = None, max_member: int = 4 << 20
+    ):
+        self.file = open(path, "rb")
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.workers = workers or os.cpu_count() or 1
+        self.window = window or self.workers * 4
+        self.max_member = max_member
+        self.candidates = self.get_candidates()
+        self.chunks = self.iter_chunks()
+        # data read so far is dropped only as the buffer is refilled
+        self.pending = bytearray()
+        self.offset = 0
+
+    def get_candidates(self) -> list:
+        """Offsets of the gzip headers. Reserved flag bits must be clear"""
+        out, i = list(), self.buf.find(GZIP_MAGIC)
+        while i >= 0:
+            if i + 10 <= len(self.buf) and not self.buf[i + 3] & 0xE0:
+                out.append(i)
+            i = self.buf.find(GZIP_MAGIC, i + 1)
+        return out
+
+    def inflate(self, start: int, end: int) -> bytes:
+        """Data of the member spanning exactly [start, end), None if it doesn't
+        or if it inflates to more than max_member"""
+        d, pos, out, size = zlib.decompressobj(31), start, list(), 0
+        try:
+            while pos < end and not d.eof:
+                chunk = self.buf[pos : min(pos + CHUNK, end)]
+                pos += len(chunk)
+                out.append(d.decompress(chunk, self.max_member - size + 1))
+                size += len(out[-1])
+                if d.unconsumed_tail or size > self.max_member:
+                    return None
+        except zlib.error:
+            return None
+        return b"".join(out) if d.eof and not d.unused_data and pos == end else None
+
+    def inflate_serial(self, start: int):
+        """Decompress the member at start, yields its data in chunks of at most CHUNK.
+        Returns its end offset"""
+        d, pos = zlib.decompressobj(31), start
+        while not d.eof:
+            if d.unconsumed_tail:
+                yield d.decompress(d.unconsumed_tail, CHUNK)
+                continue
+            if pos >= len(self.buf):
+                raise EOFError("Compressed file ended before the end-of-stream marker")
+            chunk = self.buf[pos : pos + CHUNK]
+            pos += len(chunk)
+            yield d.decompress(chunk, CHUNK)
+        return pos - len(d.unused_data)
+
+    def iter_chunks(self):
+        cands = self.candidates
+        if not cands or cands[0] != 0:
+            raise zlib.error("Not a gzip file")
+        tasks = iter(zip(cands, cands[1:] + [len(self.buf)]))
+        pending, pos = deque(), 0
+        with ThreadPoolExecutor(self.workers) as pool:
+
+            def fill():
+                for start, end in tasks:
+                    pending.append((start, end, pool.submit(self.inflate, start, end)))
+                    if len(pending) >= self.window:
+                        return
+
+            fill()
+            while pending:
+                start, end, future = pending.popleft()
+                fill()
+                if start < pos:
+                    # a false candidate, within a member already decompressed
+                    continue
+                if start == pos and (data := future.result()) is not None:
+                    yield data
+                    pos = end
+                    continue
+                if self.buf[pos : pos + 3] != GZIP_MAGIC:
+                    break
+                # the member continues past a false candidate
+                pos = yield from self.inflate_serial(pos)
+                if start >= pos:
+                    pending.appendleft((start, end, future))
+        if any(self.buf[pos:]):
+            log.warning(f"Trailing garbage at {pos} ignored")
+
+    def read(self, n: int = -1) -> bytes:
+        while n < 0 or len(self.pending) - self.offset < n:
+            try:
+                data = next(self.chunks)
+            except StopIteration:
+                break
+            del self.pending[: self.offset]
+            self.offset = 0
+            self.pending += data
+        end = len(self.pending) if n < 0 else min(self.offset + n, len(self.pending))
+        out = bytes(self.pending[self.offset : end])
+        self.offset = end
+        return out
+
+    def close(self):
+        self.chunks.close()
+        self.buf.close()
+        self.file.close()
+
+
+def open_archive(archive: str, workers: int = None) -> tarfile.TarFile:
+    """Seekable for plain tars, else a stream"""
+    if not is_compressed(archive):
+        return tarfile.open(archive, "r:")
+    if is_gzip(archive):
+        stream = GzipMembers(archive, workers)
+        if len(stream.candidates) > 1:
+            return tarfile.open(fileobj=stream, mode="r|")
+        stream.close()
+    return tarfile.open(archive, "r|*")
+
+
+def read_index(archive: str, workers: int = None) -> list:
+    """Members of the archive. Headers of a plain tar are read with seeks"""
+    with open_archive(archive, workers) as tar:
+        members = [m for m in tar if normalize(m.name)]
+        if isinstance(tar.fileobj, GzipMembers):
+            tar.fileobj.close()
+        return members
+
+
+def get_changes(members: list, dst: str, precision: float = 1) -> list:
+    """Members that differ from the destination"""
+    return [
+        m for m in members if not matches(m, os.path.join(dst, normalize(m.name)), precision)
+    ]
+
+
+class Extractor:
+    """Extracts members which differ from the destination. Files are written
+    to a temporary name by a pool of writers, then renamed. Plain tars are read
+    by the writers at the offsets of the index, compressed ones are streamed
+    once and small members are handed over to the writers, up to 'inflight_bytes'"""
+
+    def __init__(
+        self,
+        archive: str,
+        dst: str,
+        workers: int = 8,
+        precision: float = 1,
+        large_member: int = 64 << 20,
+        inflight_bytes: int = 128 << 20,
+    ):
+        self.archive = archive
+        self.dst = dst
+        self.workers = workers
+        self.precision = precision
+        self.large_member = large_member
+        self.inflight_cap = inflight_bytes
+        self.written, self.skipped = 0, 0
+        self.errors = list()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.inflight = 0
+        self.max_inflight = 0
+        self.dirs = list()
+
+    def run(self) -> tuple:
+        """Returns numbers of (written, skipped) members"""
+        if is_compressed(self.archive):
+            self.run_stream()
+        else:
+            self.run_indexed()
+        # after the files, as writing them updates the dirs
+        for info, path in sorted(self.dirs, key=lambda d: -len(d[1])):
+            os.utime(path, (info.mtime, info.mtime))
+        if self.errors:
+            raise self.errors[0]
+        log.info(f"Extracted {self.written} members of {self.archive}, {self.skipped} unchanged")
+        return self.written, self.skipped
+
+    def get_target(self, info: tarfile.TarInfo) -> str:
+        return os.path.join(self.dst, normalize(info.name))
+
+    def run_indexed(self):
+        with tarfile.open(self.archive, "r:") as tar:
+            members = [m for m in tar if normalize(m.name)]
+            changed = get_changes(members, self.dst, self.precision)
+            self.skipped = len(members) - len(changed)
+            files = [m for m in changed if m.isreg()]
+            for m in changed:
+                if not m.isreg():
+                    self.extract_other(tar, m)
+            fd = os.open(self.archive, os.O_RDONLY)
+            try:
+                with ThreadPoolExecutor(self.workers) as pool:
+                    for m in files:
+                        pool.submit(self.write, m, self.pread(fd, m))
+            finally:
+                os.close(fd)
+
+    def run_stream(self):
+        with open_archive(self.archive, self.workers) as tar:
+            with ThreadPoolExecutor(self.workers) as pool:
+                for m in tar:
+                    if not normalize(m.name):
+                        continue
+                    if matches(m, self.get_target(m), self.precision):
+                        self.skipped += 1
+                    elif not m.isreg():
+                        self.extract_other(tar, m)
+                    elif m.size >= self.large_member:
+                        f = tar.extractfile(m)
+                        self.write(m, iter(lambda: f.read(1 << 20), b""))
+                    else:
+                        self.acquire(m.size)
+                        try:
+                            data = tar.extractfile(m).read()
+                        except Exception:
+                            self.release(m.size)
+                            raise
+                        pool.submit(self.write_read, m, data)
+            if isinstance(tar.fileobj, GzipMembers):
+                tar.fileobj.close()
+
+    def acquire(self, size: int):
+        """Wait for room for the member's data. A member bigger than the cap
+        is admitted once nothing else is in flight"""
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.inflight == 0 or self.inflight + size <= self.inflight_cap
+            )
+            self.inflight += size
+            self.max_inflight = max(self.max_inflight, self.inflight)
+
+    def release(self, size: int):
+        with self.cond:
+            self.inflight -= size
+            self.cond.notify_all()
+
+    def write_read(self, info: tarfile.TarInfo, data: bytes):
+        """Write the data read from the stream, then free its room"""
+        try:
+            self.write(info, [data])
+        finally:
+            self.release(info.size)
+
+    def extract_other(self, tar: tarfile.TarFile, info: tarfile.TarInfo):
+        """Dirs are created, links and others are left to the tarfile"""
+        path = self.get_target(info)
+        try:
+            if info.isdir():
+                os.makedirs(path, exist_ok=True)
+                self.dirs.append((info, path))
+            else:
+                tar.extract(info, self.dst, set_attrs=True, **EXTRACT_FILTER)
+            with self.lock:
+                self.written += 1
+        except Exception as e:
+            self.errors.append(e)
+            log.error(f"Failed to extract {path}: {e}")
+
+    @staticmethod
+    def pread(fd: int, info: tarfile.TarInfo, bufsize: int = 1 << 20):
+        """Data of the member, read at its offset in the archive"""
+        for pos in range(0, info.size, bufsize):
+            yield os.pread(fd, min(bufsize, info.size - pos), info.offset_data + pos)
+
+    def write(self, info: tarfile.TarInfo, chunks):
+        path = self.get_target(info)
+        part = f"{path}.obpart"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(part, "wb") as f:
+                for buf in chunks:
+                    f.write(buf)
+            os.chmod(part, info.mode)
+            os.utime(part, (info.mtime, info.mtime))
+            os.replace(part, path)
+            with self.lock:
+                self.written += 1
+            log.debug(f"Extracted {path}")
+        except Exception as e:
+            self.errors.append(e)
+            log.error(f"Failed to extract {path}: {e}")
+
+
+def extract(archive: str, dst: str, **kwargs) -> tuple:
+    return Extractor(archive, dst, **kwargs).run()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s", level="INFO")
+    extract(sys.argv[1], sys.argv[2])
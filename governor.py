@@ -0,0 +1,158 @@
+"""Low-impact mode. A Governor paces the backup by the pressure of the host - the share
+of time tasks stalled on I/O (PSI, /proc/pressure/io) or else the load per CPU.
+The backup runs for a 'duty' fraction of each interval: it's halved while the pressure
+exceeds the target and raised by a step once it's below (AIMD). The script generators
+inline this module, the command line runs a command (e.g. rsync) paced by stopping
+its process group"""
+
+import os
+import sys
+import json
+import shutil
+import signal
+import logging
+import threading
+import subprocess
+
+log = logging.getLogger("OpenBackup")
+PSI = "/proc/pressure/io"
+
+
+def read_pressure(path: str = PSI) -> float:
+    """Share of time (%) some tasks stalled on I/O, averaged over 10s. None if unsupported"""
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                if line.startswith("some"):
+                    return float(line.split()[1].split("=")[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def read_load() -> float:
+    """Load average (1 minute) per CPU, in %"""
+    return os.getloadavg()[0] / (os.cpu_count() or 1) * 100
+
+
+def lower_priority(nice: int = 10, ioclass: int = 3):
+    """Lower the CPU and I/O priority of the process, inherited by its children.
+    The niceness is raised up to 'nice', so repeated calls don't accumulate.
+    I/O classes of ionice: 2 - best-effort, 3 - idle"""
+    if nice and hasattr(os, "nice"):
+        os.nice(max(0, nice - os.nice(0)))
+    if ioclass and shutil.which("ionice"):
+        subprocess.run(
+            ["ionice", "-c", str(ioclass), "-p", str(os.getpid())],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+class Governor:
+    """Runs the backup for a 'duty' fraction of every interval, paused for the rest.
+    Workers wait() while it's paused, listeners are called on each change"""
+
+    def __init__(self, target=10.0, interval=1.0, min_duty=0.1, step=0.1, probe=None):
+        self.target = target
+        self.interval = interval
+        self.min_duty = min_duty
+        self.step = step
+        self.probe = probe or self.get_pressure
+        self.duty = 1.0
+        self.listeners = list()
+        self.running = threading.Event()
+        self.running.set()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def get_pressure() -> float:
+        pressure = read_pressure()
+        return read_load() if pressure is None else pressure
+
+    def adapt(self, pressure: float) -> float:
+        """Multiplicative decrease of the duty while under pressure, additive increase after"""
+        if pressure > self.target:
+            self.duty = max(self.min_duty, self.duty / 2)
+        else:
+            self.duty = min(1.0, self.duty + self.step)
+        return self.duty
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def loop(self):
+        while not self.stopped.is_set():
+            duty = self.adapt(self.probe())
+            self.set_running(True)
+            if self.stopped.wait(self.interval * duty):
+                break
+            if duty < 1:
+                self.set_running(False)
+                self.stopped.wait(self.interval * (1 - duty))
+        self.set_running(True)
+
+    def set_running(self, running: bool):
+        if running == self.running.is_set():
+            return
+        if running:
+            self.running.set()
+        else:
+            log.debug(f"Paused for {self.interval * (1 - self.duty):.2f}s, duty {self.duty:.2f}")
+            self.running.clear()
+        for fn in self.listeners:
+            fn(running)
+
+    def wait(self):
+        """Block while the backup is paused"""
+        self.running.wait()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+
+def run(cmd: list, **opts) -> int:
+    """Run the command paced by a Governor: its process group is stopped while paused.
+    Signals terminating the run are forwarded to the group, which is resumed first"""
+    proc = subprocess.Popen(cmd, preexec_fn=os.setpgrp)
+
+    def pace(running: bool):
+        try:
+            os.killpg(proc.pid, signal.SIGCONT if running else signal.SIGSTOP)
+        except ProcessLookupError:
+            pass
+
+    def forward(signum, frame=None):
+        # the group doesn't receive the signals of the terminal or sent to this process
+        governor.stopped.set()
+        pace(True)
+        try:
+            os.killpg(proc.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    governor = Governor(**opts)
+    governor.listeners.append(pace)
+    governor.start()
+    handlers = {s: signal.signal(s, forward) for s in (signal.SIGTERM, signal.SIGHUP)}
+    try:
+        return proc.wait()
+    except KeyboardInterrupt:
+        forward(signal.SIGINT)
+        return proc.wait()
+    finally:
+        governor.stop()
+        # never leave the group stopped, e.g. on an error
+        pace(True)
+        for s, handler in handlers.items():
+            signal.signal(s, handler)
+
+
+if __name__ == "__main__":
+    # governor.py '<options>' cmd [args...]
+    sys.exit(run(sys.argv[2:], **json.loads(sys.argv[1])))
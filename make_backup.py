@@ -1,20 +1,51 @@
 import os
 import json
+import argparse
+from contextlib import nullcontext
 from time import perf_counter
-from uuid import uuid4
 from subprocess import run
 from platform import node, system
 
 from base import *
-from script_gen import *
+from plans import PlanStore, check_approval
+
+# Modules of the features (generators, scan, cas, verify, profiling) are imported
+# when used, so that only the selected backend is loaded on start
 
 
 class OpenBackup(AgnosticBase):
     """Interactively handles the backup process"""
 
-    def __init__(self):
+    def __init__(
+        self,
+        selected: str = None,
+        profile_dir: str = None,
+        profile_exec=False,
+        headless=False,
+        command="run",
+        cas_options: dict = None,
+        verify_manifest=False,
+        restore_options: dict = None,
+    ):
         self.tmpfile = ""
         self.should_run = False
+        self.selected = selected
+        self.profile_dir = profile_dir
+        self.profile_exec = profile_exec
+        self.profiler = None
+        self.headless = headless
+        self.command = command
+        self.cas_options = cas_options or dict()
+        self.restore_options = restore_options or dict()
+        self.verify_manifest = verify_manifest
+        self.plans = PlanStore(f"{self.SWD}/plans")
+        self.profile_name = None
+        self.config_path = None
+        self.actions_index = list()
+        self.verify_pairs = None
+        self.history = None
+        # the scan renders its own progress, unless a runner of many profiles does
+        self.live = True
 
     def make(self):
         try:
@@ -22,26 +53,70 @@ class OpenBackup(AgnosticBase):
         except ValueError:
             print("No profile was selected")
             return
-        self.prepare_script()
-        self.show_output()
+        if self.command == "resume":
+            self.resume()
+            self.cleanup()
+            return
+        if self.command in {"materialize", "gc"}:
+            self.manage_cas()
+            return
+        if self.command == "verify":
+            self.run_verify()
+            return
+        if self.command == "restore" and not self.invert_config():
+            return
+        if self.command not in {"review", "plan"} or not self.load_plan():
+            with self.profiled("generate"):
+                self.prepare_script()
+            if self.command == "plan":
+                plan = self.get_plan()
+                print(f"Plan: {self.fmt_stats(plan['stats'])}")
+                print(f"Plan saved for review: {self.plans.save(self.profile_name, plan)}")
+        if self.command == "plan":
+            return
+        if self.headless and self.command == "run":
+            self.auto_approve()
+        else:
+            self.show_output()
         if self.should_run:
             self.execute()
+        elif self.headless and self.command == "run":
+            print(f"Plan held for review: {self.plans.get_path(self.profile_name)}")
         else:
             print("Cancelled")
+        self.cleanup()
+
+    def cleanup(self):
         if self.tmpfile:
             run([self.FN.rm, self.tmpfile])
             print(f"Removed temporary file: {self.tmpfile}")
+        if self.profiler:
+            print(f"Profiling data saved to {self.profiler.outdir}")
 
-    def load_config(self):
-        """Sources config file(s) from the 'profiles' directory.
-        Includes automation: default.json, single file or platform name"""
-        profiles = sorted(os.listdir(f"{self.SWD}/profiles"))
+    @classmethod
+    def list_profiles(cls) -> list:
+        """Profile files in the 'profiles' directory, except the example"""
+        profiles = sorted(os.listdir(f"{cls.SWD}/profiles"))
         try:
             # ignore example profile
             profiles.remove("example.json")
         except ValueError:
             pass
-        if "default.json" in profiles:
+        return profiles
+
+    def load_config(self):
+        """Sources config file(s) from the 'profiles' directory.
+        Includes automation: default.json, single file or platform name"""
+        profiles = self.list_profiles()
+        if self.selected:
+            selected = (
+                self.selected
+                if self.selected.endswith(".json")
+                else f"{self.selected}.json"
+            )
+            if selected not in profiles:
+                raise ValueError(f"Profile {selected} does not exist")
+        elif "default.json" in profiles:
             selected = "default.json"
         elif len(profiles) == 1:
             selected = profiles[0]
@@ -50,14 +125,59 @@ class OpenBackup(AgnosticBase):
         else:
             for i, v in enumerate(profiles):
                 print(f"{i+1}. {v.split('.')[0]}")
+            if self.headless:
+                raise ValueError("Ambiguous profile selection")
             selected = profiles[int(input("Select profile: ")) - 1]
-        self.config = self.parse_config(
-            json.load(open(f"{self.SWD}/profiles/{selected}", "r"))
-        )
+        self.profile_name = selected.split(".")[0]
+        self.config_path = f"{self.SWD}/profiles/{selected}"
+        self.config = self.read_profile(self.config_path)
+        if self.config["settings"].get("checkpoint"):
+            self.config["settings"]["journal"] = self.plans.get_journal_path(
+                self.profile_name
+            )
+        if self.verify_manifest:
+            self.config["settings"]["verify_manifest"] = True
+        self.load_history()
         self.load_platform_base()
         self.editor: list = self.config["settings"].get("editor", [])
+        if self.profile_dir:
+            from profiling import PipelineProfiler
+
+            self.profiler = PipelineProfiler.for_run(
+                self.profile_dir,
+                f"{node()}-{selected.split('.')[0]}",
+                exec_phase=self.profile_exec,
+            )
         print(f"Loaded {selected}")
 
+    @staticmethod
+    def get_parser_hash() -> str:
+        """Hash of the module normalizing the profiles, the cached ones are stale once it changes"""
+        import base
+        import inspect
+        from hashlib import blake2b
+
+        return blake2b(inspect.getsource(base).encode(), digest_size=8).hexdigest()
+
+    def read_profile(self, path: str) -> dict:
+        """Parsed and normalized profile. Cached in '.cache' until the file or the parser changes"""
+        cache = os.path.join(self.SWD, ".cache", f"{os.path.basename(path)}")
+        mtime, parser = self.plans.get_mtime(path), self.get_parser_hash()
+        try:
+            with open(cache, "r") as f:
+                cached = json.load(f)
+            if cached["mtime"] == mtime and cached.get("parser") == parser:
+                return cached["config"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+        with open(path, "r") as f:
+            config = self.parse_config(json.load(f))
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(f"{cache}.tmp", "w") as f:
+            json.dump({"mtime": mtime, "parser": parser, "config": config}, f)
+        os.replace(f"{cache}.tmp", cache)
+        return config
+
     def load_platform_base(self):
         _os = self.config["settings"].get("os", "python").lower()
         if _os == "auto":
@@ -71,20 +191,123 @@ class OpenBackup(AgnosticBase):
                 else "python"
             )
         if _os == "linux":
+            from script_gen import LinuxScriptGenerator
+
             self.FN = LinuxBase.FN
             self.ScriptGenerator = LinuxScriptGenerator(self.config)
             self.script_executor = LinuxBase.execute
         elif _os == "python":
+            from script_gen import PythonScriptGenerator
+
             self.FN = PythonBase.FN
             self.ScriptGenerator = PythonScriptGenerator(self.config)
             self.script_executor = PythonBase.execute
         else:
             raise Exception("Unsupported OS!")
 
+    def profiled(self, phase: str):
+        """Profile the phase if profiling was requested"""
+        return self.profiler.phase(phase) if self.profiler else nullcontext()
+
+    def load_history(self):
+        """Throughput of the previous runs of the profile, if the 'progress' setting is enabled.
+        The rate of the transfers is passed to the script for its ETA"""
+        if not (opts := self.config["settings"].get("progress")):
+            return
+        from progress import History
+
+        self.history = History(self.plans.get_history_path(self.profile_name))
+        opts = dict(opts) if isinstance(opts, dict) else dict()
+        opts["rate"] = self.history.get("bytes_rate")
+        self.config["settings"]["progress"] = opts
+
+    def get_scan_progress(self):
+        """Live progress of the scan, None if disabled"""
+        if self.history is None or not self.live:
+            return None
+        import scan
+        from progress import Progress
+
+        opts = self.config["settings"]["progress"]
+        return Progress(
+            scan.counters,
+            "Scanning",
+            entries=self.history.get("scan_entries") or 0,
+            rate=self.history.get("scan_rate"),
+            **{k: opts[k] for k in ("interval", "every") if k in opts},
+        )
+
     def prepare_script(self):
         """Generate instructions for the backup script"""
         print("Preparing script...")
-        self.instructions = "\n".join(self.ScriptGenerator.generate())
+        if self.command == "restore" and not self.restore_options.get("delete"):
+            self.drop_removals()
+        if opts := self.config["settings"].get("governor"):
+            # low-impact mode: the scan and the script run at a lower priority
+            from governor import lower_priority
+
+            opts = opts if isinstance(opts, dict) else dict()
+            lower_priority(opts.get("nice", 10), opts.get("ioclass", 3))
+        progress = self.get_scan_progress()
+        with progress or nullcontext():
+            self.instructions = "\n".join(self.ScriptGenerator.generate())
+        # nothing was walked if the scan was served from the cache
+        if progress is not None and (files := progress.counters.files):
+            self.history.update(scan_entries=files, scan_rate=files / progress.elapsed)
+        self.actions_index = self.ScriptGenerator.actions_index
+
+    def drop_removals(self):
+        """Leave out the removals of the entries missing from the destination"""
+        actions = self.ScriptGenerator.get_actions()
+        if removals := [a for a in actions if a["action"] == "remove"]:
+            self.ScriptGenerator.drop(removals)
+            print(f"Kept {len(removals):,} entries missing from the backup (--delete removes them)")
+
+    def get_plan(self) -> dict:
+        """Snapshot of the generated script for the PlanStore"""
+        return {
+            "exe": self.FN.exe,
+            "instructions": self.instructions,
+            "stats": self.ScriptGenerator.get_stats(),
+            "fingerprint": self.ScriptGenerator.monitor.fingerprint,
+            "actions": self.actions_index,
+            "config_path": self.config_path,
+            "config_mtime": self.plans.get_mtime(self.config_path),
+        }
+
+    def load_plan(self) -> bool:
+        """Use the held plan if it is still valid. Returns False if it has to be regenerated"""
+        try:
+            plan = self.plans.load(self.profile_name)
+        except FileNotFoundError:
+            print("No plan held for review")
+            return False
+        if plan.get("status") == "running":
+            print("Plan was interrupted, run with --resume to continue it")
+            return False
+        if plan["exe"] != self.FN.exe or not self.plans.is_valid(plan):
+            print("Held plan is outdated")
+            return False
+        self.instructions = plan["instructions"]
+        self.actions_index = plan.get("actions", [])
+        print(f"Loaded held plan: {self.fmt_stats(plan['stats'])}")
+        return True
+
+    def auto_approve(self):
+        """Approve execution if the plan satisfies the 'approve' rules, otherwise hold it"""
+        plan = self.get_plan()
+        print(f"Plan: {self.fmt_stats(plan['stats'])}")
+        if reasons := check_approval(plan["stats"], self.config["settings"].get("approve")):
+            print(f"Not approved: {', '.join(reasons)}")
+            self.plans.save(self.profile_name, plan)
+        else:
+            print("Auto-approved")
+            self.gen_tmpfile()
+            self.should_run = True
+
+    def fmt_stats(self, stats: dict) -> str:
+        size = "?" if stats["bytes"] is None else f"{stats['bytes']:,}"
+        return f"{stats['deletions']:,} deletions, {stats['copies']:,} copies, {size} bytes"
 
     def show_output(self):
         """
@@ -93,6 +316,9 @@ class OpenBackup(AgnosticBase):
         In this case, the script will be executed only if it was saved/modified.
         Without an editor, instructions are written to a tmpfile and a manual confirmation is required.
         """
+        if self.should_summarize():
+            self.review_summary()
+            return
         self.gen_tmpfile()
         print("Displaying output...")
         if self.editor:
@@ -104,32 +330,520 @@ class OpenBackup(AgnosticBase):
             print(f"You can now edit {self.tmpfile} in your favourite editor")
             self.should_run = input("Confirm execution (y/n)? ").lower() in {"yes", "y"}
 
+    def should_summarize(self) -> bool:
+        """If the plan is big enough for the 'review' summary. Requires the scan results"""
+        if not (opts := self.config["settings"].get("review")):
+            return False
+        opts = opts if isinstance(opts, dict) else dict()
+        return self.ScriptGenerator.monitor.results_ready and len(
+            self.ScriptGenerator.get_actions()
+        ) >= opts.get("min_actions", 10_000)
+
+    def review_summary(self):
+        """Present the plan summarized per subtree. Rows are expanded and dropped in the
+        editor until the document is saved without expansions. The dropped actions
+        are left out of the re-generated script"""
+        from review import PlanSummary
+
+        opts = self.config["settings"]["review"]
+        opts = opts if isinstance(opts, dict) else dict()
+        actions = self.ScriptGenerator.get_actions()
+        for a in actions:
+            try:
+                a["size"] = self.ScriptGenerator.monitor.get_size(a["src"] or a["dst"])
+            except OSError:
+                a["size"] = 0
+        summary = PlanSummary(actions, opts.get("depth", 2), opts.get("top", 3))
+        rows = summary.get_rows(depth=summary.depth)
+        stats = self.fmt_stats(self.ScriptGenerator.get_stats())
+        if not self.editor:
+            print(summary.render(rows, stats))
+            self.should_run = input("Confirm execution (y/n)? ").lower() in {"yes", "y"}
+            if self.should_run:
+                self.gen_tmpfile()
+            return
+        doc = f"{self.config['settings'].get('name', 'job')}.review"
+        dropped, expanded = list(), True
+        print("Displaying summary...")
+        while expanded:
+            with open(doc, "w") as f:
+                f.write(summary.render(rows, stats))
+            mtime = os.path.getmtime(doc)
+            run(self.parse_editor_command(self.editor.copy(), doc))
+            if os.path.getmtime(doc) <= mtime:
+                os.remove(doc)
+                return
+            with open(doc, "r") as f:
+                rows, d, expanded = summary.update(rows, f.read())
+            dropped.extend(d)
+        os.remove(doc)
+        if dropped:
+            self.ScriptGenerator.drop(dropped)
+            self.prepare_script()
+            print(f"Dropped {len(dropped):,} actions")
+        self.gen_tmpfile()
+        self.should_run = True
+
     def gen_tmpfile(self):
         """Creates an uniquely named file with the backup instructions.
         It is deleted after self.generate() ends"""
+        from uuid import uuid4
+
         name = self.config["settings"].get("name", "job")
         while f"{name}.{self.FN.exe}" in os.listdir("."):
             name += f"-{str(uuid4())[:8]}"
         self.tmpfile = f"{name}.{self.FN.exe}"
         open(self.tmpfile, "w").write(self.instructions)
 
-    def parse_editor_command(self, cmd: list) -> list:
+    def parse_editor_command(self, cmd: list, file: str = None) -> list:
         """Replace special tags with corresponding values"""
         for i, v in enumerate(cmd):
-            cmd[i] = v.replace(r"${FILE}", self.tmpfile)
+            cmd[i] = v.replace(r"${FILE}", file or self.tmpfile)
         return cmd
 
+    def manage_cas(self):
+        """Restore files from, or collect garbage of, the content-addressed stores"""
+        from cas import CasStore
+
+        roots = {
+            os.path.join(p["dst"], ".cas")
+            for p in self.config["paths"]
+            if p.get("layout") == "cas"
+        }
+        if not roots:
+            print("Profile has no paths with the 'cas' layout")
+        for root in sorted(roots):
+            store = CasStore(root)
+            if self.command == "gc":
+                manifests, objects, freed = store.gc(self.cas_options.get("keep", 1))
+                print(
+                    f"{root}: removed {manifests:,} manifests and {objects:,} objects ({freed:,} bytes)"
+                )
+            else:
+                target = self.cas_options.get("target") or os.path.dirname(root)
+                written = store.materialize(
+                    target,
+                    self.cas_options.get("manifest"),
+                    self.cas_options.get("subpath", ""),
+                )
+                print(f"{root}: materialized {written:,} files in {target}")
+
+    def invert_config(self) -> bool:
+        """Restore the mirrored paths from their destinations instead of backing them up.
+        Copies are made by the python executor with the parallel Scheduler. Returns False
+        if there's nothing to restore"""
+        from restore import invert_config
+
+        self.config, skipped = invert_config(
+            self.config,
+            [self.restore_options["subpath"]] if self.restore_options.get("subpath") else None,
+            self.restore_options.get("target"),
+        )
+        for path in skipped:
+            print(f"Skipped {path['src']}: not mirrored, use 'materialize' for the 'cas' layout")
+        if not self.config["paths"]:
+            print("Nothing to restore")
+            return False
+        self.config["settings"]["os"] = "python"
+        self.config["settings"].setdefault("scheduler", True)
+        # the plans and the journal of the backup are left alone
+        self.profile_name = f"{self.profile_name}-restore"
+        if self.config["settings"].get("checkpoint"):
+            self.config["settings"]["journal"] = self.plans.get_journal_path(self.profile_name)
+        self.load_platform_base()
+        return True
+
+    def resume(self):
+        """Continue the interrupted plan. Completed actions are skipped by the script"""
+        try:
+            plan = self.plans.load(self.profile_name)
+        except FileNotFoundError:
+            plan = dict()
+        if plan.get("status") != "running":
+            print("Nothing to resume")
+            return
+        if plan["exe"] != self.FN.exe:
+            print(f"Interrupted plan requires the .{plan['exe']} executor")
+            return
+        self.instructions = plan["instructions"]
+        self.actions_index = plan["actions"]
+        self.verify_pairs = plan.get("verify")
+        completed = self.plans.read_journal(self.profile_name)
+        remaining = [a for a in self.actions_index if a["id"] not in completed]
+        if stale := [a["id"] for a in remaining if self.plans.is_stale(a)]:
+            self.plans.append_journal(self.profile_name, stale)
+        print(
+            f"Resuming {len(remaining)-len(stale):,} of {len(self.actions_index):,} actions"
+            f" ({len(stale):,} no longer applicable)"
+        )
+        self.gen_tmpfile()
+        self.should_run = True
+        self.execute()
+
     def execute(self):
-        """Wrapper around the script executor"""
+        """Wrapper around the script executor.
+        If the checkpoint journal is enabled, the plan is kept until the script succeeds,
+        along with the files to verify - a resumed run doesn't re-scan for them"""
+        journaled = bool(self.config["settings"].get("journal"))
+        if self.command != "resume":
+            self.verify_pairs = self.get_verify_pairs()
+        if journaled and self.command != "resume":
+            self.plans.clear_journal(self.profile_name)
+            self.plans.save(
+                self.profile_name,
+                {
+                    "status": "running",
+                    "exe": self.FN.exe,
+                    "instructions": self.instructions,
+                    "actions": self.actions_index,
+                    "verify": self.verify_pairs,
+                },
+            )
+        pairs = self.verify_pairs
+        edited = self.is_edited()
         print(f"Running script...")
+        log_size = self.get_log_size()
+        t0 = perf_counter()
+        if self.profiler and self.profiler.exec_phase and self.FN.exe == "py":
+            returncode = run(self.profiler.wrap_command(self.tmpfile)).returncode
+        else:
+            returncode = self.script_executor(self.tmpfile)
+        elapsed = perf_counter() - t0
+        print(f"Executed in {elapsed:.2f} seconds")
+        # the totals of a held or resumed plan would take a whole scan
+        if self.history is not None and returncode == 0 and self.ScriptGenerator.plan is not None:
+            if size := self.ScriptGenerator.get_totals()["bytes"]:
+                self.history.update(bytes_rate=size / elapsed)
+        self.print_action_summary(log_size)
+        if journaled and returncode != 0:
+            print("Script did not complete, run with --resume to continue")
+        elif self.profile_name:
+            self.plans.remove(self.profile_name)
+        # failures of the bash script are detected only with the journal
+        if returncode == 0 and not edited and (self.FN.exe == "py" or journaled):
+            self.ScriptGenerator.monitor.save_digests()
+        if pairs is not None and returncode == 0:
+            self.verify(pairs)
+
+    def get_log_size(self) -> int:
+        """Size of the logfile before the run, the action log appends the run to it"""
+        try:
+            return os.path.getsize(self.config["settings"].get("logfile") or "")
+        except OSError:
+            return 0
+
+    def print_action_summary(self, start: int = 0):
+        """Summary of the run written by the action log from the start offset of the logfile,
+        if the 'actionlog' setting is enabled"""
+        if not self.config["settings"].get("actionlog"):
+            return
+        from actionlog import read_summary
+
+        try:
+            summary = read_summary(self.config["settings"]["logfile"], start)
+        except FileNotFoundError:
+            return
+        actions = ", ".join(f"{n:,} {a}" for a, n in sorted(summary["actions"].items()))
+        errors = sum(summary["errors"].values())
+        print(f"Actions: {actions or 'none'}, {errors:,} errors, {summary['bytes']:,} bytes")
+
+    def is_edited(self) -> bool:
+        """If the script to run differs from the generated one, e.g. edited in the editor"""
+        try:
+            with open(self.tmpfile, "r") as f:
+                return f.read() != self.instructions
+        except FileNotFoundError:
+            return True
+
+    def get_verifier(self, opts: dict):
+        from verify import BUFSIZE, Verifier
+
+        return Verifier(
+            self.ScriptGenerator.monitor, opts.get("workers"), opts.get("bufsize", BUFSIZE)
+        )
+
+    def get_verify_pairs(self) -> list:
+        """Files to verify once the script completes, None if 'verify' is disabled.
+        Collected before the execution, as 'touched' are the transfers of the plan"""
+        from verify import get_options as get_verify_options
+
+        if not (opts := self.config["settings"].get("verify")):
+            return None
+        opts = get_verify_options(opts)
+        transfers = self.ScriptGenerator.get_transfers() if opts["mode"] == "touched" else None
+        return self.get_verifier(opts).get_pairs(
+            opts["mode"], opts.get("fraction", 1.0), transfers
+        )
+
+    def run_verify(self):
+        """Compare the mirrored paths with their destinations, without a backup"""
+        from verify import get_options as get_verify_options
+
+        opts = get_verify_options(self.config["settings"].get("verify") or "full")
+        mode = "full" if opts["mode"] == "touched" else opts["mode"]
+        self.verify(self.get_verifier(opts).get_pairs(mode, opts.get("fraction", 1.0)))
+
+    def verify(self, pairs: list):
+        """Compare checksums of the (src, dst) pairs. Mismatches are appended to the run log"""
+        from verify import get_options as get_verify_options
+
+        opts = get_verify_options(self.config["settings"].get("verify") or "full")
+        print(f"Verifying {len(pairs):,} files...")
         t0 = perf_counter()
-        self.script_executor(self.tmpfile)
-        print(f"Executed in {perf_counter()-t0:.2f} seconds")
+        mismatches = self.get_verifier(opts).run(pairs)
+        summary = f"Verified {len(pairs):,} files in {perf_counter()-t0:.2f} seconds, {len(mismatches):,} mismatches"
+        if self.config["settings"].get("actionlog"):
+            from actionlog import append
+
+            append(
+                self.config["settings"]["logfile"],
+                [{"action": "verify", "path": d, "src": s, "error": r} for s, d, r in mismatches]
+                + [{"level": "INFO", "message": summary}],
+            )
+        else:
+            with open(self.config["settings"]["logfile"], "a") as f:
+                f.writelines(f"VERIFY {r}: {s} -> {d}\n" for s, d, r in mismatches)
+                f.write(f"{summary}\n")
+        print(summary)
+
+
+class MultiProfileRunner:
+    """Runs several profiles at once. Their trees are scanned into a SharedScan
+    (overlapping sources are walked once), scripts are generated and executed
+    concurrently by up to 'jobs' workers and reviewed in a single step.
+    Profiles writing to a common device are executed one after another, so the
+    in-flight limits of their scripts aren't multiplied on the device"""
+
+    def __init__(self, selected: list, jobs=2, scan_workers=4, headless=False):
+        self.backups = [OpenBackup(s, headless=headless) for s in selected]
+        for ob in self.backups:
+            ob.live = False
+        self.jobs = jobs
+        self.scan_workers = scan_workers
+        self.headless = headless
+
+    def make(self):
+        try:
+            for ob in self.backups:
+                ob.load_config()
+        except ValueError:
+            print("No profile was selected")
+            return
+        self.scan()
+        self.prepare_scripts()
+        if self.headless:
+            for ob in self.backups:
+                print(f"[{ob.profile_name}]", end=" ")
+                ob.auto_approve()
+        else:
+            self.show_output()
+        if approved := [ob for ob in self.backups if ob.should_run]:
+            self.execute(approved)
+        else:
+            print("Cancelled")
+        for ob in self.backups:
+            if self.headless and not ob.should_run:
+                print(f"Plan held for review: {ob.plans.get_path(ob.profile_name)}")
+            ob.cleanup()
+
+    def scan(self):
+        """Walk trees of all profiles once, deduplicating overlapping roots"""
+        from scan import SharedScan
+
+        shared = SharedScan(self.scan_workers)
+        t0 = perf_counter()
+        progress = None
+        if any(ob.history is not None for ob in self.backups):
+            import scan
+            from progress import Progress
+
+            progress = Progress(scan.counters, "Scanning")
+        with progress or nullcontext():
+            shared.prefetch(
+                [r for ob in self.backups for r in ob.ScriptGenerator.monitor.get_scan_roots()]
+            )
+        print(f"Scanned {len(shared.snapshots):,} trees in {perf_counter()-t0:.2f} seconds")
+        for ob in self.backups:
+            ob.ScriptGenerator.monitor.shared_scan = shared
+
+    def prepare_scripts(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(self.jobs) as pool:
+            list(pool.map(lambda ob: ob.prepare_script(), self.backups))
+
+    def show_output(self):
+        """Present all generated scripts for a single confirmation"""
+        for ob in self.backups:
+            ob.gen_tmpfile()
+            stats = ob.ScriptGenerator.get_stats(with_bytes=False)
+            print(f"{ob.profile_name}: {ob.tmpfile} ({ob.fmt_stats(stats)})")
+        print("You can now edit the scripts in your favourite editor")
+        should_run = input("Confirm execution of all (y/n)? ").lower() in {"yes", "y"}
+        for ob in self.backups:
+            ob.should_run = should_run
+
+    def execute(self, backups: list):
+        from concurrent.futures import ThreadPoolExecutor
+
+        def run_group(group: list):
+            for ob in group:
+                ob.execute()
+
+        with ThreadPoolExecutor(self.jobs) as pool:
+            list(pool.map(run_group, self.group_by_device(backups)))
+
+    @staticmethod
+    def get_devices(ob: OpenBackup) -> set:
+        """Devices of the profile's destinations, of their nearest existing ancestors"""
+        devices = set()
+        for path in ob.config["paths"]:
+            dst = os.path.abspath(path["dst"])
+            while not os.path.exists(dst):
+                dst = os.path.dirname(dst)
+            devices.add(os.stat(dst).st_dev)
+        return devices
+
+    def group_by_device(self, backups: list) -> list:
+        """Profiles grouped transitively by their common destination devices"""
+        groups = list()
+        for ob in backups:
+            devices, group = self.get_devices(ob), [ob]
+            for other in [g for g in groups if g[0] & devices]:
+                groups.remove(other)
+                devices |= other[0]
+                group = other[1] + group
+            groups.append((devices, group))
+        return [group for _, group in groups]
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Make an incremental backup")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="run",
+        choices=["run", "review", "verify", "restore", "materialize", "gc"],
+        help="'review' presents the plan held by a headless run. "
+        "'verify' compares checksums of the sources and destinations. "
+        "'restore' copies what differs from the destinations back to the sources. "
+        "'materialize' and 'gc' manage the content-addressed stores",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        action="append",
+        help="name of the profile to load, skips the selection. Repeat to run many profiles",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=2,
+        help="number of profiles generated/executed concurrently",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profiling",
+        metavar="DIR",
+        help="profile the run and save .pstats/.collapsed files to DIR",
+    )
+    parser.add_argument(
+        "--profile-exec",
+        action="store_true",
+        help="also profile execution of the generated script (python mode)",
+    )
+    parser.add_argument(
+        "--list-profiles",
+        action="store_true",
+        help="print names of the available profiles and exit",
+    )
+    parser.add_argument(
+        "--plan-only",
+        action="store_true",
+        help="generate the plan, print its summary and save it for 'review' without executing",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="never prompt, execute only if the plan satisfies the 'approve' rules",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the last interrupted plan (requires 'checkpoint' setting)",
+    )
+    parser.add_argument(
+        "--verify-manifest",
+        action="store_true",
+        help="rebuild the destination manifests from a walk of the destinations",
+    )
+    parser.add_argument(
+        "--target",
+        help="materialize: directory to restore files to. Defaults to the dst. "
+        "restore: directory the sources are restored under. Defaults to their locations",
+    )
+    parser.add_argument(
+        "--manifest", help="materialize: name of the manifest. Defaults to the latest"
+    )
+    parser.add_argument(
+        "--subpath",
+        default="",
+        help="materialize, restore: restore only this part of the tree (restore: a source path)",
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="restore: remove the entries of the sources missing from the destinations",
+    )
+    parser.add_argument(
+        "--keep", type=int, default=1, help="gc: number of manifests to keep"
+    )
+    args = parser.parse_args(argv)
+    if len(args.config or []) > 1:
+        # the MultiProfileRunner only runs the backups, headless or confirmed at once
+        unsupported = [
+            option
+            for option, used in (
+                (f"'{args.command}'", args.command != "run"),
+                ("--profile", args.profile),
+                ("--profile-exec", args.profile_exec),
+                ("--plan-only", args.plan_only),
+                ("--resume", args.resume),
+                ("--verify-manifest", args.verify_manifest),
+            )
+            if used
+        ]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} can't be used with several profiles")
+    return args
 
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        ob = OpenBackup()
+        if args.list_profiles:
+            print("\n".join(p.split(".")[0] for p in OpenBackup.list_profiles()))
+            raise SystemExit
+        if len(args.config or []) > 1:
+            ob = MultiProfileRunner(args.config, args.jobs, headless=args.headless)
+        else:
+            ob = OpenBackup(
+                (args.config or [None])[0],
+                args.profile,
+                args.profile_exec,
+                args.headless,
+                "resume" if args.resume else "plan" if args.plan_only else args.command,
+                {
+                    "target": args.target,
+                    "manifest": args.manifest,
+                    "subpath": args.subpath,
+                    "keep": args.keep,
+                },
+                args.verify_manifest,
+                {"target": args.target, "subpath": args.subpath, "delete": args.delete},
+            )
         ob.make()
         print("Done")
     except KeyboardInterrupt:
@@ -0,0 +1,184 @@
+"""Persistent manifest of a destination tree (path, size, mtime, type), kept in
+a SQLite file at the destination root, so that slow or removable targets do not
+have to be walked on every run. The script generators inline this module,
+so it must depend only on the stdlib"""
+
+import os
+import sys
+import sqlite3
+import threading
+from time import time, monotonic
+from urllib.parse import quote
+
+
+class DestManifest:
+
+    NAME = ".obmanifest.db"
+
+    def __init__(
+        self, root: str, batch: int = 1000, interval: float = 2.0, readonly: bool = False
+    ):
+        self.root = root
+        self.path = os.path.join(root, self.NAME)
+        self.batch = batch
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.last_commit = monotonic()
+        if readonly:
+            # the plan only reads the manifest, it's created and updated by the script
+            if not os.path.isfile(self.path):
+                raise FileNotFoundError(self.path)
+            self.db = sqlite3.connect(
+                f"file:{quote(self.path)}?mode=ro", uri=True, check_same_thread=False
+            )
+            return
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, is_dir INTEGER, hash TEXT)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self.db.commit()
+
+    def get_key(self, path: str) -> str:
+        return os.path.relpath(path, self.root)
+
+    def get_range(self, key: str) -> tuple:
+        """Condition matching the key and all keys below it"""
+        if key == ".":
+            return "1", ()
+        return "(path = ? OR (path >= ? AND path < ?))", (key, f"{key}/", f"{key}0")
+
+    def get(self, path: str) -> tuple:
+        """Returns (size, mtime, is_dir) or None if the path is not in the manifest"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT size, mtime, is_dir FROM files WHERE path = ?",
+                (self.get_key(path),),
+            ).fetchone()
+
+    def list(self, path: str) -> list:
+        """All entries below the path as [(path, is_dir)], sorted"""
+        return list(self.iter_list(path))
+
+    def iter_list(self, path: str, batch: int = 10000):
+        """Same as list, fetched in batches"""
+        key = self.get_key(path)
+        where, args = self.get_range(key)
+        with self.lock:
+            cursor = self.db.execute(
+                f"SELECT path, is_dir FROM files WHERE {where} ORDER BY path", args
+            )
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(batch)
+            if not rows:
+                return
+            yield from ((os.path.join(self.root, p), bool(d)) for p, d in rows if p != key)
+
+    def record(self, path: str, st: os.stat_result = None):
+        """Add or update the entry of a path that exists on the destination"""
+        st = st or os.stat(path)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL)",
+                (self.get_key(path), st.st_size, st.st_mtime, os.path.isdir(path)),
+            )
+            self.changed()
+
+    def record_tree(self, path: str):
+        """Record the path, its subtree and the missing parents, e.g. created by makedirs"""
+        parent = os.path.dirname(path)
+        while parent.startswith(f"{self.root.rstrip('/')}/") and not self.get(parent):
+            self.record(parent)
+            parent = os.path.dirname(parent)
+        self.record(path)
+        for root, dirs, files in os.walk(path):
+            for f in dirs + files:
+                self.record(os.path.join(root, f))
+
+    def remove(self, path: str):
+        """Remove the entry and everything below it"""
+        where, args = self.get_range(self.get_key(path))
+        with self.lock:
+            self.db.execute(f"DELETE FROM files WHERE {where}", args)
+            self.changed()
+
+    def changed(self):
+        """Commit in batches - an interrupted run loses at most the last batch"""
+        self.pending += 1
+        if self.pending >= self.batch or monotonic() - self.last_commit > self.interval:
+            self.db.commit()
+            self.pending = 0
+            self.last_commit = monotonic()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def rebuild(self):
+        """Replace the manifest with the result of a full walk of the destination"""
+        with self.lock:
+            self.db.execute("DELETE FROM files")
+            self.db.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, NULL)", self.walk(self.root)
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('verified', ?)", (time(),)
+            )
+            self.db.commit()
+
+    def walk(self, rootdir: str):
+        try:
+            entries = list(os.scandir(rootdir))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for e in entries:
+            if rootdir == self.root and e.name.startswith(self.NAME):
+                continue
+            is_dir = e.is_dir(follow_symlinks=False)
+            st = e.stat(follow_symlinks=False)
+            yield os.path.relpath(e.path, self.root), st.st_size, st.st_mtime, is_dir
+            if is_dir:
+                yield from self.walk(e.path)
+
+    def get_verified(self) -> float:
+        """Time of the last full walk, 0 if never verified"""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'verified'").fetchone()
+        return row[0] if row else 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def update(op: str, root: str, lines):
+    """Record (or remove) the paths, relative to the root or absolute, in its manifest.
+    Paths that don't exist are skipped, e.g. summary lines of the rsync output.
+    'rebuild' replaces the manifest with a walk of the root instead"""
+    manifest = DestManifest(root)
+    if op == "rebuild":
+        manifest.rebuild()
+        lines = ()
+    for line in lines:
+        if not (line := line.rstrip("\n").rstrip("/")):
+            continue
+        path = os.path.join(root, line)
+        try:
+            if op == "remove":
+                manifest.remove(path)
+            elif not os.path.relpath(path, root).startswith(".."):
+                manifest.record(path)
+        except OSError:
+            pass
+    manifest.close()
+
+
+if __name__ == "__main__":
+    # manifest.py <record|remove> <root> < paths, manifest.py rebuild <root> < /dev/null
+    update(sys.argv[1], sys.argv[2], sys.stdin)
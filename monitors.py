@@ -1,8 +1,20 @@
 import os
 import re
-from time import perf_counter
+import stat
+from time import time, perf_counter
 from abc import ABC, abstractmethod
 
+from scan import (
+    build_tree,
+    build_tree_parallel,
+    is_within,
+    iter_select,
+    iter_tree,
+    outermost,
+    select_tree,
+)
+from context import PlanContext
+
 
 class AgnosticMonitor(ABC):
     """Supports the sync tool (rsync, ...) in detecting files that were deleted/renamed/moved.
@@ -10,85 +22,426 @@ class AgnosticMonitor(ABC):
     **To be used only for incremental backups** - all surplus files from destination will be marked for deletion
     """
 
+    shared_scan = None
+
+    @property
+    def fingerprint(self) -> dict:
+        return self.context.fingerprint
+
+    @property
+    def scan_cache(self) -> dict:
+        return self.context.scan_cache
+
+    @property
+    def manifests(self) -> dict:
+        return self.context.manifests
+
     @abstractmethod
     def generate(self) -> list:
         """Create actions from the Monitor results"""
         ...
 
+    @property
+    def budget(self) -> int:
+        """Bytes of memory the scan may hold, 0 if unbounded"""
+        from spill import parse_budget
+
+        return parse_budget(self.config["settings"].get("memory"))
+
+    def get_spill_dir(self) -> str:
+        opts = self.config["settings"].get("memory")
+        return opts.get("tmpdir") if isinstance(opts, dict) else None
+
     def collect_diff(self, paths: list) -> None:
         """Build a set of files that are present only on the target"""
+        if self.budget:
+            return self.collect_diff_bounded(paths)
         self.diff = set()
         for path in paths:
-            if any(k in path.keys() for k in {"archive", "extract"}):
+            if not self.is_mirrored(path):
                 continue
             excl = self.parse_rsync_exclude(path.get("exclude"))
             parsed_src = self.get_parsed_src(path, excl)
-            tgt_files = self.btr(
-                self.get_target_path({**path, "src": os.path.basename(path["src"])}),
-                excl,
-            )
+            root, lsrc = self.context.get_target_root(path), len(path["src"])
+            unchanged = {f"{root}{d[lsrc:]}" for d in self.get_unchanged(path, excl)}
+            tgt_files = self.get_target_tree(path, root, excl, unchanged)
             self.diff |= self.filter_diff(tgt_files.difference(parsed_src))
             self._files_scanned += len(parsed_src)
         self.diff = {f for f in self.diff if not any(p in f for p in self.mkdir_paths)}
 
-    def get_parsed_src(self, path, excl) -> set:
-        parsed_src = set()
+    def collect_diff_bounded(self, paths: list) -> None:
+        """Same as collect_diff, within the memory budget. Both trees are collected
+        as sorted runs of relative paths on disk and compared by a streaming merge"""
+        from spill import ExternalSorter, difference
+
+        self.diff = set()
+        for path in paths:
+            if not self.is_mirrored(path):
+                continue
+            excl = self.parse_rsync_exclude(path.get("exclude"))
+            root = self.context.get_target_root(path)
+            key = (path["src"], root, excl.pattern)
+            srcs = self.context.src_runs.pop(key, None) or self.get_src_runs(path, excl)
+            dsts = ExternalSorter(self.budget // 4, self.get_spill_dir())
+            dsts.extend(p[len(root) :] for p in self.iter_target_tree(path, root, excl))
+            try:
+                removed = (f"{root}{rel}" for rel in difference(dsts, srcs))
+                self.diff |= self.filter_diff(removed)
+            finally:
+                srcs.close()
+                dsts.close()
+            self._files_scanned += len(srcs)
+        self.diff = {f for f in self.diff if not any(p in f for p in self.mkdir_paths)}
+
+    def get_src_runs(self, path: dict, excl: re.Pattern):
+        """Relative paths of the source tree as sorted runs"""
+        from spill import ExternalSorter
+
+        runs = ExternalSorter(self.budget // 4, self.get_spill_dir())
+        lsrc = len(path["src"])
+        for srcpath, _, _ in iter_tree(path["src"], excl, self.fingerprint):
+            runs.add(srcpath[lsrc:])
+        return runs
+
+    def iter_target_tree(self, path: dict, rootdir: str, exclude: re.Pattern):
+        """Same as get_target_tree, without collecting the tree"""
+        if not (manifest := self.get_manifest(path["dst"])):
+            yield from (p for p, _, _ in iter_tree(rootdir, exclude, self.fingerprint))
+        elif e := manifest.get(rootdir):
+            if not e[2]:
+                yield rootdir
+            else:
+                yield from iter_select((p for p, _ in manifest.iter_list(rootdir)), exclude)
+
+    @staticmethod
+    def is_mirrored(path: dict) -> bool:
+        """If the path is backed up to a mirror of the source tree"""
+        return not (
+            any(k in path.keys() for k in {"archive", "extract"})
+            or path.get("layout") == "cas"
+        )
+
+    def get_cas_changes(self, path: dict, manifest: dict) -> tuple[list, list]:
+        """Compare the source with the manifest of the content-addressed store.
+        Returns files to store [(src, key)] and keys to drop. Keys are relative to the dst
+        """
+        prec = self.config["settings"].get("sync_precision", 1)
+        excl = self.parse_rsync_exclude(path.get("exclude"))
         lcompi = path["src"].rfind("/") + 1
-        for sub_path in self.btr(path["src"], excl):
-            parsed_src.add(self.get_target_path({**path, "src": sub_path[lcompi:]}))
-        return parsed_src
+        puts, seen = list(), set()
+        for srcpath in sorted(self.btr(path["src"], excl)):
+            if self.context.isdir(srcpath):
+                continue
+            key = srcpath[lcompi:]
+            seen.add(key)
+            st = os.stat(srcpath)
+            e = manifest.get(key)
+            if not e or e["size"] != st.st_size or abs(e["mtime"] - st.st_mtime) > prec:
+                puts.append((srcpath, key))
+        root = os.path.basename(path["src"])
+        drops = [
+            k for k in sorted(manifest) if is_within(k, root) and k not in seen
+        ]
+        self._files_scanned += len(seen)
+        return puts, drops
+
+    def get_extract_changes(self, path: dict) -> list:
+        """Members of the archive which differ from the destination by size or mtime.
+        None if the archive doesn't exist yet, e.g. it's created by the same run"""
+        from extract import get_changes
+
+        if not os.path.isfile(path["src"]):
+            return None
+        prec = self.config["settings"].get("sync_precision", 1)
+        return get_changes(self.context.get_archive_index(path["src"]), path["dst"], prec)
+
+    def get_parsed_src(self, path, excl) -> set:
+        """Source paths mapped onto the target"""
+        root, lsrc = self.context.get_target_root(path), len(path["src"])
+        return {f"{root}{sub_path[lsrc:]}" for sub_path in self.btr(path["src"], excl)}
+
+    def get_scan_roots(self) -> list[tuple[str, re.Pattern]]:
+        """Roots (with excludes) of all the trees that will be walked by the scan.
+        Empty if the scan is bounded, as the snapshots would hold the trees in memory"""
+        roots = list()
+        if self.budget:
+            return roots
+        for path in self.get_expanded_paths(self.config["paths"]):
+            if not self.is_mirrored(path):
+                continue
+            excl = self.parse_rsync_exclude(path.get("exclude"))
+            roots.append((path["src"], excl))
+            if not self.get_manifest(path["dst"]):
+                roots.append((self.context.get_target_root(path), excl))
+        return roots
+
+    def reset_scan(self):
+        """Forget results of the previous scan"""
+        self.context.reset()
 
     def btr(self, rootdir: str, exclude: re.Pattern) -> set:
-        """Build Tree Recursive"""
-        self.__btr_res = set()
-        self.__btr_exc = exclude
-        self.__build_tree_recursive(rootdir)
-        return self.__btr_res
+        """Build Tree Recursive. Mtimes of the visited dirs are recorded in the fingerprint.
+        Results are cached for the scan, so a source shared by many paths is walked once
+        """
+        key = (rootdir, exclude.pattern)
+        if key not in self.scan_cache:
+            if self.shared_scan:
+                self.scan_cache[key] = self.shared_scan.get(
+                    rootdir, exclude, self.fingerprint, self.context.kinds
+                )
+            elif (workers := self.config["settings"].get("scan_workers", 1)) > 1:
+                self.scan_cache[key] = build_tree_parallel(
+                    rootdir, exclude, self.fingerprint, self.context.kinds, workers
+                )
+            else:
+                self.scan_cache[key] = build_tree(
+                    rootdir, exclude, self.fingerprint, self.context.kinds
+                )
+        return self.scan_cache[key]
 
-    def __build_tree_recursive(self, rootdir: str):
-        try:
-            for f in os.listdir(rootdir):
-                path = f"{rootdir}/{f}"
-                if self.__btr_exc.search(path):
+    def get_digest_options(self) -> dict:
+        """Options of the 'digests' setting, None if disabled or the scan is bounded"""
+        if not (opts := self.config["settings"].get("digests")) or self.budget:
+            return None
+        return opts if isinstance(opts, dict) else dict()
+
+    def get_unchanged(self, path: dict, excl: re.Pattern) -> set:
+        """Source dirs whose subtrees match the digests saved by the last successful run,
+        i.e. they are mirrored as they are, unless a dir of the subtree was modified at the
+        destination since. Digests of the scan are kept for save_digests"""
+        if (opts := self.get_digest_options()) is None:
+            return set()
+        from digest import DigestStore, get_digests, get_mtime_ns
+
+        key = (path["src"], path["dst"], excl.pattern)
+        if key not in self.context.digests:
+            # a source mirrored to many destinations is hashed once
+            same = (v for k, v in self.context.digests.items() if (k[0], k[2]) == (key[0], key[2]))
+            if (digests := next(same, None)) is None:
+                tree = self.btr(path["src"], excl)
+                digests = get_digests(path["src"], tree, self.context.isdir, self.stat_src)
+            self.context.digests[key] = dict(digests)
+        if path["dst"] not in self.context.digest_stores:
+            try:
+                self.context.digest_stores[path["dst"]] = DigestStore(path["dst"], readonly=True)
+            except FileNotFoundError:
+                self.context.digest_stores[path["dst"]] = None
+        saved = dict()
+        if store := self.context.digest_stores[path["dst"]]:
+            saved = store.load(
+                self.get_digest_tree(path), excl.pattern, opts.get("verify_days", 30) * 86400
+            )
+        root, lsrc = self.context.get_target_root(path), len(path["src"])
+        digests = self.context.digests[key]
+        unchanged = {d for d, h in digests.items() if (e := saved.get(d[lsrc:])) and e[0] == h}
+        # a dir modified at the destination, e.g. an entry was removed, and its ancestors
+        # are compared again
+        for d in sorted(unchanged, key=lambda d: -d.count("/")):
+            if d in unchanged and get_mtime_ns(f"{root}{d[lsrc:]}") != saved[d[lsrc:]][1]:
+                while is_within(d, path["src"]):
+                    unchanged.discard(d)
+                    d = os.path.dirname(d)
+        return unchanged
+
+    def get_digest_tree(self, path: dict) -> str:
+        """Key of the path's tree in the store of its destination"""
+        return os.path.relpath(self.context.get_target_root(path), path["dst"])
+
+    def stat_src(self, path: str) -> os.stat_result:
+        """Stat of a source file, its mtime is kept for the comparison"""
+        st = os.stat(path)
+        self.context.mtimes[path] = st.st_mtime
+        return st
+
+    def discard_digests(self, actions: list):
+        """Forget digests of the dirs containing the actions, e.g. dropped from the plan,
+        so their subtrees are compared again by the next run"""
+        for a in actions:
+            for (src, dst, _), digests in self.context.digests.items():
+                root = self.context.get_target_root({"src": src, "dst": dst})
+                if not is_within(a["dst"], root):
+                    continue
+                d = f"{src}{a['dst'][len(root):]}"
+                while is_within(d, src):
+                    digests.pop(d, None)
+                    d = os.path.dirname(d)
+
+    def save_digests(self):
+        """Persist digests of the scan, once the script mirrored the sources successfully.
+        The stores are created only now, the plan opened them read-only"""
+        from digest import DigestStore, get_mtime_ns
+
+        stores = dict()
+        for (src, dst, pattern), digests in self.context.digests.items():
+            path = {"src": src, "dst": dst}
+            root = self.context.get_target_root(path)
+            rel = dict()
+            for d, h in digests.items():
+                if (mtime := get_mtime_ns(f"{root}{d[len(src):]}")) is not None:
+                    rel[d[len(src) :]] = (h, mtime)
+            if dst not in stores:
+                stores[dst] = DigestStore(dst)
+            stores[dst].save(self.get_digest_tree(path), pattern, rel)
+        for store in stores.values():
+            store.close()
+
+    def get_manifest(self, dst: str):
+        """Manifest of the destination if the 'manifest' setting is enabled, else its remote snapshot
+        or None. It's opened read-only: a missing one, or older than 'verify_days', is None -
+        the destination is walked instead and the script rebuilds the manifest"""
+        if not (opts := self.config["settings"].get("manifest")):
+            return self.get_snapshot(dst)
+        if dst not in self.manifests:
+            from manifest import DestManifest
+
+            opts = opts if isinstance(opts, dict) else dict()
+            max_age = opts.get("verify_days", 30) * 86400
+            try:
+                manifest = DestManifest(dst, readonly=True)
+            except FileNotFoundError:
+                manifest = None
+            if manifest and (
+                self.config["settings"].get("verify_manifest")
+                or time() - manifest.get_verified() >= max_age
+            ):
+                manifest.close()
+                manifest = None
+            if manifest is None:
+                print(f"Manifest of {dst} is rebuilt by the script")
+            self.manifests[dst] = manifest
+        return self.manifests[dst]
+
+    def find_manifest(self, path: str, manifests: dict = None):
+        """Manifest of the innermost destination containing the path"""
+        manifests = self.manifests if manifests is None else manifests
+        roots = [r for r in manifests if is_within(path, r)]
+        return manifests[max(roots, key=len)] if roots else None
+
+    def get_remote_root(self, path: str) -> str:
+        """Location of the path on the server of the 'remote' agent. None if not on a mapped mount"""
+        mounts = self.config["settings"]["remote"].get("paths", {"/": "/"})
+        if not (local := [m for m in mounts if is_within(path, m)]):
+            return None
+        local = max(local, key=len)
+        return os.path.normpath(os.path.join(mounts[local], os.path.relpath(path, local)))
+
+    def get_snapshot(self, dst: str):
+        """Target trees of the destination scanned by the 'remote' agent on the server,
+        in a single request per destination. None if disabled or the dst isn't on a mapped mount"""
+        if not (opts := self.config["settings"].get("remote")):
+            return None
+        if dst not in self.context.snapshots:
+            from remote import RemoteSnapshot, ScannerAgent
+
+            self.context.snapshots[dst] = None
+            if self.get_remote_root(dst) is None:
+                return None
+            roots = list()
+            for path in self.get_expanded_paths(self.config["paths"]):
+                if path["dst"] != dst or not self.is_mirrored(path):
                     continue
-                self.__btr_res.add(path)
-                if os.path.isdir(path):
-                    self.__build_tree_recursive(path)
-        except FileNotFoundError:
-            pass
-        except NotADirectoryError:
-            self.__btr_res.add(rootdir)
+                root = self.context.get_target_root(path)
+                excl = self.parse_rsync_exclude(path.get("exclude"))
+                roots.append((self.get_remote_root(root), root, excl.pattern))
+            if not self.context.agent:
+                self.context.agent = ScannerAgent(opts["command"], opts.get("python", "python3"))
+            t0 = perf_counter()
+            snapshot = RemoteSnapshot(self.context.agent.scan(roots))
+            print(f"Scanned {dst} remotely in {perf_counter()-t0:.2f} seconds")
+            self.context.snapshots[dst] = snapshot
+        return self.context.snapshots[dst]
+
+    def get_target_tree(
+        self, path: dict, rootdir: str, exclude: re.Pattern, unchanged: set = None
+    ) -> set:
+        """Same as btr for the destination side, served from the manifest if enabled.
+        Unchanged dirs - mirrored as they are - aren't descended"""
+        if not (manifest := self.get_manifest(path["dst"])):
+            if not unchanged:
+                return self.btr(rootdir, exclude)
+            if rootdir in unchanged:
+                return set()
+            res = set()
+            for p, is_dir, _ in iter_tree(rootdir, exclude, self.fingerprint, set(unchanged)):
+                res.add(p)
+                self.context.kinds[p] = is_dir
+            return res
+        if not (e := manifest.get(rootdir)):
+            return set()
+        elif not e[2]:
+            return {rootdir}
+        return select_tree((p for p, _ in manifest.list(rootdir)), rootdir, exclude)
+
+    def is_target_dir(self, path: str) -> bool:
+        manifest = self.find_manifest(path) or self.find_manifest(path, self.context.snapshots)
+        if manifest:
+            return bool((e := manifest.get(path)) and e[2])
+        return self.context.isdir(path)
+
+    def get_target_entry(self, path: str) -> tuple:
+        """(size, mtime, is_dir) of the destination path, None if it doesn't exist"""
+        manifest = self.find_manifest(path) or self.find_manifest(path, self.context.snapshots)
+        if manifest:
+            return manifest.get(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime, stat.S_ISDIR(st.st_mode)
+
+    def list_target(self, path: str) -> list:
+        """Entries of the destination dir, served from the manifest if enabled"""
+        manifest = self.find_manifest(path) or self.find_manifest(path, self.context.snapshots)
+        if manifest:
+            return [p for p, _ in manifest.iter_list(path) if os.path.dirname(p) == path]
+        with os.scandir(path) as it:
+            return [e.path for e in it]
+
+    def list_src(self, path: str, batch_id: int) -> list:
+        """Entries of the source dir, without the excluded ones of the path"""
+        excl = self.parse_rsync_exclude(self.config["paths"][batch_id].get("exclude"))
+        with os.scandir(path) as it:
+            return [e.path for e in it if not excl.search(e.path)]
+
+    def get_dst_mtime(self, path: str, dst: str) -> float:
+        """Raises FileNotFoundError if the path does not exist on the destination"""
+        if not (manifest := self.get_manifest(dst)):
+            return os.stat(path).st_mtime
+        if not (e := manifest.get(path)):
+            raise FileNotFoundError(path)
+        return e[1]
+
+    def get_src_mtime(self, path: str) -> float:
+        return self.context.get_mtime(path)
+
+    def get_size(self, path: str) -> int:
+        """Size of the file or the total size of files in the dir"""
+        if not self.context.isdir(path):
+            return os.path.getsize(path)
+        total = 0
+        for root, _, files in os.walk(path):
+            for f in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, f))
+                except OSError:
+                    pass
+        return total
 
     def filter_diff(self, diff: set) -> set:
-        """Remove unwanted elements from the diff"""
-        for d in diff:
-            if os.path.isdir(d):
-                # if a dir is removed, don't include files
-                diff = {i for i in diff if not i.startswith(d)}
-                diff.add(d)
-        return diff
+        """Remove unwanted elements from the diff: if a dir is removed, don't include files"""
+        return set(outermost(diff, str, self.is_target_dir))
 
     def get_expanded_paths(self, paths: list) -> list:
         """If path contains {x,y,...}, then it will be divided into separate 'plain' paths"""
-        to_del, to_add, exp_paths = set(), list(), list()
-        for i, v in enumerate(paths):
-            if "{" in v["src"]:
-                lbi, rbi = v["src"].find("{"), v["src"].find("}")
-                pre_path = v["src"][:lbi]
-                exp_paths = v["src"][lbi + 1 : rbi].split(",")
-                post_path = v["src"][rbi + 1 :]
-                for e in exp_paths:
-                    src = f"{pre_path}{e}{post_path}"
-                    to_add.append({**v, "src": src})
-                to_del.add(i)
-        exp_paths = [v for i, v in enumerate(paths) if i not in to_del]
-        for p in to_add:
-            exp_paths.append(p)
-        return exp_paths
+        return self.context.get_paths(paths)
 
-    # TODO implement proper parsing
     def parse_rsync_exclude(self, excl: list) -> re.Pattern:
-        """Parses the rsync glob patterns to regex"""
+        """Parses the rsync glob patterns to regex. Compiled once per run"""
+        return self.context.get_matcher(excl, self.compile_rsync_exclude)
+
+    # TODO implement proper parsing
+    @staticmethod
+    def compile_rsync_exclude(excl: list) -> re.Pattern:
         if not excl:
             res = r".^"
         else:
@@ -101,12 +454,17 @@ class AgnosticMonitor(ABC):
 
 class LinuxMonitor(AgnosticMonitor):
 
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, context: PlanContext = None):
         self.config = config
+        self.context = context or PlanContext(config)
         self.mkdir_paths = {d for d in self.config["settings"]["mkdirs"]}
+        self.results_ready = False
 
-    def generate(self) -> list:
+    def generate(self, use_cache=False) -> list:
+        if use_cache and self.results_ready:
+            return self.out
         self._files_scanned = 0
+        self.reset_scan()
         self.out = list()
         t0 = perf_counter()
         self.collect_diff(self.get_expanded_paths(self.config["paths"]))
@@ -114,10 +472,12 @@ class LinuxMonitor(AgnosticMonitor):
             f"Scanned {self._files_scanned:,} files in {perf_counter()-t0:.2f} seconds"
         )
         self.gen_actions()
+        self.results_ready = True
         return self.out
 
     def gen_actions(self):
         actions = sorted([os.path.normpath(p) for p in self.diff])
+        self.out = list()
         self.out.extend(
             [
                 f"rm -rfv '{f}' | tee -a '{self.config['settings']['logfile']}'"
@@ -128,31 +488,34 @@ class LinuxMonitor(AgnosticMonitor):
 
 class PythonMonitor(AgnosticMonitor):
 
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, context: PlanContext = None):
         self.config = config
+        self.context = context or PlanContext(config)
         self.mkdir_paths = {d for d in self.config["settings"]["mkdirs"]}
         self.actions = type(
-            "Actions", (object,), {"cp": "copy", "rm": "remove", "up": "update"}
+            "Actions",
+            (object,),
+            {"cp": "copy", "rm": "remove", "up": "update", "meta": "meta"},
         )()
         self.results_ready = False
+        self._files_seen = 0
         self.sync_prec = self.config["settings"].get("sync_precision", 1)
 
     def generate(self, use_cache=False) -> list[dict[str, str, str, int]]:
         """Returns list of dicts [{src, dst, action, batch_id}].
-        Marks files for: copy, update, delete.
+        Marks files for: copy, update, delete, extract.
         Does NOT include os-specific instructions"""
         if use_cache and self.results_ready:
             return self.results
         self.results_ready = False
         self._files_seen = 0
         self._files_scanned = 0
+        self.reset_scan()
         self.results = list()
         t0 = perf_counter()
-        for path in self.get_expanded_paths(self.config["paths"]):
-            if not any(k in path.keys() for k in {"archive", "extract"}):
-                self.results.extend(self.get_sync(path))
-        self.results = self.filtered_sync(self.results)
+        self.results = self.get_transfers()
         self.results.extend(self.get_diff())
+        self.results.extend(self.get_extracts())
         self.results_ready = True
         print(f"Compared {self._files_seen:,} files in {perf_counter()-t0:.2f} seconds")
         return self.results
@@ -168,29 +531,30 @@ class PythonMonitor(AgnosticMonitor):
                 }
             ]
         out = list()
-        lcompi = path["src"].rfind("/") + 1
+        root, lsrc = self.context.get_target_root(path), len(path["src"])
         excl = self.parse_rsync_exclude(path.get("exclude"))
         src_tree = self.btr(path["src"], excl)
+        unchanged = self.get_unchanged(path, excl)
         for srcpath in src_tree:
-            dstpath = self.get_target_path({**path, "src": srcpath[lcompi:]})
+            if unchanged and os.path.dirname(srcpath) in unchanged:
+                # the entry is covered by the digest of its dir
+                continue
+            dstpath = f"{root}{srcpath[lsrc:]}"
             try:
-                # st_mtime precision may vary. Adding <sync_prec> seconds for practical reasons
-                if (
-                    os.stat(srcpath).st_mtime
-                    > os.stat(dstpath).st_mtime + self.sync_prec
-                ):
-                    if os.path.isfile(srcpath):
+                if self.is_outdated(srcpath, dstpath, path["dst"]):
+                    if self.context.isfile(srcpath):
                         out.append(
                             {
                                 "src": srcpath,
                                 "dst": dstpath,
-                                "action": self.actions.up,
+                                "action": self.get_update_action(srcpath, dstpath),
                                 "batch_id": path["batch_id"],
                             }
                         )
                     else:
                         continue
-            except FileNotFoundError:
+            except (FileNotFoundError, NotADirectoryError):
+                # a parent on the destination may be a file, replaced by the optimizer
                 out.append(
                     {
                         "src": srcpath,
@@ -202,6 +566,112 @@ class PythonMonitor(AgnosticMonitor):
         self._files_seen += len(src_tree)
         return out
 
+    def is_outdated(self, srcpath: str, dstpath: str, dst: str, st=None) -> bool:
+        """If the destination is older than the source. With 'exact' (set by restore) if their
+        mtimes or file sizes differ at all. Raises FileNotFoundError if the dst is missing"""
+        if not self.config["settings"].get("exact"):
+            mtime = st.st_mtime if st else self.get_src_mtime(srcpath)
+            # st_mtime precision may vary. Adding <sync_prec> seconds for practical reasons
+            return mtime > self.get_dst_mtime(dstpath, dst) + self.sync_prec
+        if not (e := self.get_target_entry(dstpath)):
+            raise FileNotFoundError(dstpath)
+        st = st or os.stat(srcpath)
+        if abs(st.st_mtime - e[1]) > self.sync_prec:
+            return True
+        return stat.S_ISREG(st.st_mode) and not e[2] and st.st_size != e[0]
+
+    def get_update_action(self, srcpath: str, dstpath: str) -> str:
+        """Action for a modified file: 'meta' if the quick check of the 'meta' setting
+        finds the same content at the destination, i.e. only the metadata changed"""
+        if not (opts := self.config["settings"].get("meta")):
+            return self.actions.up
+        from verify import sample_equal
+
+        opts = opts if isinstance(opts, dict) else dict()
+        try:
+            same = sample_equal(
+                srcpath, dstpath, opts.get("samples", 0), opts.get("block", 1 << 16)
+            )
+        except OSError:
+            same = False
+        return self.actions.meta if same else self.actions.up
+
+    def get_sync_bounded(self, path: dict, excl: re.Pattern, out):
+        """Same as get_sync, streamed into the out. New dirs aren't descended.
+        Returns sorted runs of the source tree for the diff"""
+        from spill import ExternalSorter
+
+        srcs = ExternalSorter(self.budget // 4, self.get_spill_dir())
+        root, lsrc = self.context.get_target_root(path), len(path["src"])
+        skip = set()
+        for srcpath, is_dir, entry in iter_tree(path["src"], excl, self.fingerprint, skip):
+            self._files_seen += 1
+            dstpath = f"{root}{srcpath[lsrc:]}"
+            action = None
+            try:
+                st = entry.stat() if entry else os.stat(srcpath)
+                outdated = self.is_outdated(srcpath, dstpath, path["dst"], st)
+                srcs.add(srcpath[lsrc:])
+                if not is_dir and outdated:
+                    action = self.get_update_action(srcpath, dstpath)
+            except FileNotFoundError:
+                action = self.actions.cp
+                if is_dir:
+                    skip.add(srcpath)
+            if action:
+                out.append(
+                    {"src": srcpath, "dst": dstpath, "action": action, "batch_id": path["batch_id"]}
+                )
+        if srcs.buffer:
+            # the runs wait on disk for the diff
+            srcs.spill()
+        return srcs
+
+    def get_transfers_bounded(self):
+        from spill import SpillList
+
+        out = SpillList(self.budget // 4, self.get_spill_dir())
+        for path in self.get_expanded_paths(self.config["paths"]):
+            if not self.is_mirrored(path):
+                continue
+            if path.get("isconf", False):
+                out.extend(self.get_sync(path))
+                continue
+            excl = self.parse_rsync_exclude(path.get("exclude"))
+            key = (path["src"], self.context.get_target_root(path), excl.pattern)
+            self.context.src_runs[key] = self.get_sync_bounded(path, excl, out)
+        return out
+
+    def get_transfers(self) -> list:
+        """Actions syncing new and modified files, without the deletions"""
+        if self.budget:
+            return self.get_transfers_bounded()
+        out = list()
+        for path in self.get_expanded_paths(self.config["paths"]):
+            if self.is_mirrored(path):
+                out.extend(self.get_sync(path))
+        return self.filtered_sync(out)
+
+    def get_extracts(self) -> list:
+        """An action per 'extract' path with members to extract"""
+        out = list()
+        for path in self.get_expanded_paths(self.config["paths"]):
+            if not path.get("extract"):
+                continue
+            changed = self.get_extract_changes(path)
+            if changed == []:
+                continue
+            out.append(
+                {
+                    "src": path["src"],
+                    "dst": path["dst"],
+                    "action": "extract",
+                    "batch_id": path["batch_id"],
+                    "members": None if changed is None else len(changed),
+                }
+            )
+        return out
+
     def get_diff(self) -> list:
         out = list()
         self.collect_diff(self.get_expanded_paths(self.config["paths"]))
@@ -212,8 +682,9 @@ class PythonMonitor(AgnosticMonitor):
         return out
 
     def filtered_sync(self, generated: list[dict[str, str, str]]):
-        for i in generated:
-            if os.path.isdir(i["dst"]):
-                generated = [p for p in generated if not p["dst"].startswith(i["dst"])]
-                generated.append(i)
-        return generated
+        """If a new dir is copied, don't include its files"""
+        return outermost(
+            generated,
+            lambda a: a["dst"],
+            lambda a: a["action"] == self.actions.cp and self.context.isdir(a["src"]),
+        )
@@ -0,0 +1,116 @@
+import os
+import json
+from time import time
+
+
+class PlanStore:
+    """Persists generated plans, so that a held plan can be reviewed later
+    without re-scanning. A plan is validated against the fingerprint
+    - mtimes of the directories visited while generating it"""
+
+    def __init__(self, rootdir: str):
+        self.rootdir = rootdir
+
+    def get_path(self, name: str) -> str:
+        return os.path.join(self.rootdir, f"{name}.json")
+
+    def save(self, name: str, plan: dict) -> str:
+        os.makedirs(self.rootdir, exist_ok=True)
+        path = self.get_path(name)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({**plan, "created": time()}, f)
+        os.replace(tmp, path)
+        return path
+
+    def load(self, name: str) -> dict:
+        with open(self.get_path(name), "r") as f:
+            return json.load(f)
+
+    def remove(self, name: str):
+        for path in (self.get_path(name), self.get_journal_path(name)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get_history_path(self, name: str) -> str:
+        """Throughput of the previous runs, kept across the plans"""
+        return os.path.join(self.rootdir, f"{name}.history")
+
+    def get_journal_path(self, name: str) -> str:
+        """Checkpoint journal - ids of the completed actions, one per line"""
+        return os.path.join(self.rootdir, f"{name}.journal")
+
+    def read_journal(self, name: str) -> set:
+        try:
+            with open(self.get_journal_path(name), "r") as f:
+                return {line.strip() for line in f}
+        except FileNotFoundError:
+            return set()
+
+    def append_journal(self, name: str, ids: list):
+        os.makedirs(self.rootdir, exist_ok=True)
+        with open(self.get_journal_path(name), "a") as f:
+            f.writelines(f"{i}\n" for i in ids)
+
+    def clear_journal(self, name: str):
+        try:
+            os.remove(self.get_journal_path(name))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def is_stale(action: dict) -> bool:
+        """Cheap check if the action can't or doesn't have to be executed anymore"""
+        if action["action"] == "remove":
+            return not os.path.lexists(action["dst"])
+        return action["src"] is not None and not os.path.lexists(action["src"])
+
+    def list(self) -> list:
+        try:
+            return sorted(
+                f[:-5] for f in os.listdir(self.rootdir) if f.endswith(".json")
+            )
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def get_fingerprint(dirs) -> dict:
+        """Map each dir to its current mtime. None if it does not exist"""
+        out = dict()
+        for d in dirs:
+            try:
+                out[d] = os.stat(d).st_mtime_ns
+            except FileNotFoundError:
+                out[d] = None
+        return out
+
+    def is_valid(self, plan: dict) -> bool:
+        """Check if none of the scanned directories changed since the plan was made"""
+        if plan.get("config_mtime") != self.get_mtime(plan.get("config_path")):
+            return False
+        return self.get_fingerprint(plan["fingerprint"]) == plan["fingerprint"]
+
+    @staticmethod
+    def get_mtime(path: str):
+        try:
+            return os.stat(path).st_mtime_ns
+        except (FileNotFoundError, TypeError):
+            return None
+
+
+def check_approval(stats: dict, rules: dict) -> list:
+    """Returns reasons for holding the plan, empty if it can be auto-approved.
+    Rules are upper limits (exclusive), e.g. {"max_deletions": 10, "max_bytes": 1e9}"""
+    if not rules:
+        return ["no approval rules"]
+    reasons = list()
+    for rule, limit in rules.items():
+        key = rule.removeprefix("max_")
+        value = stats.get(key)
+        if value is None:
+            reasons.append(f"{key} unknown")
+        elif value >= limit:
+            reasons.append(f"{key} {value:,} >= {limit:,}")
+    return reasons
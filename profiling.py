@@ -0,0 +1,77 @@
+import os
+import sys
+import runpy
+import cProfile
+import threading
+from time import strftime
+from collections import Counter
+from contextlib import contextmanager
+
+
+class PipelineProfiler:
+    """Profiles the phases of a backup run. Each phase is recorded with cProfile
+    (dumped as <phase>.pstats) and with a thread sampling the call stack
+    (dumped as <phase>.collapsed - the input format of flamegraph.pl/speedscope)
+    """
+
+    def __init__(self, outdir: str, interval: float = 0.005, exec_phase=False):
+        self.outdir = outdir
+        self.interval = interval
+        self.exec_phase = exec_phase
+        os.makedirs(self.outdir, exist_ok=True)
+
+    @classmethod
+    def for_run(cls, rootdir: str, label: str, **kwargs) -> "PipelineProfiler":
+        """Create a profiler writing to an unique sub-directory of the rootdir"""
+        return cls(os.path.join(rootdir, f"{label}-{strftime('%Y%m%d-%H%M%S')}"), **kwargs)
+
+    @contextmanager
+    def phase(self, name: str):
+        """Profile the code executed within the context"""
+        stacks = Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self.__sample,
+            args=(threading.get_ident(), stacks, stop),
+            daemon=True,
+        )
+        prof = cProfile.Profile()
+        sampler.start()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            stop.set()
+            sampler.join()
+            prof.dump_stats(os.path.join(self.outdir, f"{name}.pstats"))
+            self.dump_collapsed(stacks, os.path.join(self.outdir, f"{name}.collapsed"))
+
+    def __sample(self, ident: int, stacks: Counter, stop: threading.Event):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(ident)
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}"
+                )
+                frame = frame.f_back
+            if stack:
+                stacks[";".join(reversed(stack))] += 1
+
+    def dump_collapsed(self, stacks: Counter, path: str):
+        with open(path, "w") as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+    def wrap_command(self, tmpfile: str) -> list:
+        """Command running the generated .py script under the profiler"""
+        return [sys.executable, os.path.abspath(__file__), self.outdir, "execute", tmpfile]
+
+
+if __name__ == "__main__":
+    # Profile a generated script in-process: profiling.py <outdir> <phase> <script>
+    outdir, phase, script = sys.argv[1:4]
+    with PipelineProfiler(outdir).phase(phase):
+        runpy.run_path(script, run_name="__main__")
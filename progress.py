@@ -0,0 +1,202 @@
+"""Live progress of the scan and the execution. The hot loops only count in the
+Counters - e.g. once per listed dir - and a background thread samples them every interval,
+rendering the throughput and the ETA. The ETA is based on the totals of the plan and, until
+the run has its own rate, on the throughput of the previous runs of the profile (History).
+The script generators inline this module"""
+
+import os
+import sys
+import json
+import shutil
+import threading
+from time import monotonic
+
+
+class Counters:
+    """Progress of a phase. The increments aren't locked, a sample may lag behind.
+    The walks and the actions run in several threads, each counts in its own slot
+    [dirs, entries, actions, bytes] and the totals are the sums - shared increments
+    would lose updates"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.slots = dict()
+        self.current = ""
+
+    def get_slot(self) -> list:
+        return self.slots.setdefault(threading.get_ident(), [0, 0, 0, 0])
+
+    def listed(self, current: str, entries: int):
+        """Count a listed dir of the given number of entries"""
+        slot = self.get_slot()
+        slot[0] += 1
+        slot[1] += entries
+        self.current = current
+
+    def done(self, current: str, size: int = 0):
+        """Count a completed action which transferred size bytes"""
+        slot = self.get_slot()
+        slot[2] += 1
+        slot[3] += size
+        self.current = current
+
+    def get_total(self, i: int) -> int:
+        return sum(slot[i] for slot in list(self.slots.values()))
+
+    @property
+    def dirs(self) -> int:
+        return self.get_total(0)
+
+    @property
+    def files(self) -> int:
+        return self.get_total(1)
+
+    @property
+    def actions(self) -> int:
+        return self.get_total(2)
+
+    @property
+    def bytes(self) -> int:
+        return self.get_total(3)
+
+
+def fmt_bytes(n: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(n) < 1024 or unit == "TiB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def fmt_time(seconds: float) -> str:
+    if seconds is None:
+        return "--:--"
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02}:{s:02}" if h else f"{m:02}:{s:02}"
+
+
+class Progress:
+    """Renders the counters every 'interval' seconds, in place on a terminal, else a line every
+    'every' renders. Totals of the plan (actions, bytes) switch to the execution format.
+    The rate is the throughput of the previous runs (bytes/s, or entries/s of the scan)"""
+
+    def __init__(
+        self,
+        counters,
+        label="",
+        actions=0,
+        bytes=0,
+        entries=0,
+        rate=None,
+        interval=0.5,
+        every=20,
+        stream=None,
+    ):
+        self.counters = counters
+        self.label = label
+        self.actions = actions
+        self.bytes = bytes
+        self.entries = entries
+        self.rate = rate
+        self.interval = interval
+        self.every = every
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.counters.reset()
+        self.t0 = monotonic()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.write(self.render(), final=True)
+
+    def loop(self):
+        n = 0
+        while not self.stopped.wait(self.interval):
+            n += 1
+            if self.tty or n % self.every == 0:
+                self.write(self.render())
+
+    def write(self, line: str, final: bool = False):
+        if self.tty:
+            width = shutil.get_terminal_size().columns - 1
+            self.stream.write(f"\r{line[:width]:<{width}}{chr(10) if final else ''}")
+        else:
+            self.stream.write(f"{line}\n")
+        self.stream.flush()
+
+    @property
+    def elapsed(self) -> float:
+        return monotonic() - self.t0
+
+    def get_eta(self, done: float, total: float, rate: float = None) -> float:
+        """Seconds until the total is done, None if unknown. The rate of the run is used
+        once it's measurable, until then the given one - e.g. of the previous runs"""
+        if done and self.elapsed >= 5 * self.interval:
+            rate = done / self.elapsed
+        if not total or not rate:
+            return None
+        return max(0, total - done) / rate
+
+    def render(self) -> str:
+        c = self.counters
+        if not (self.actions or self.bytes):
+            rate = c.files / self.elapsed if self.elapsed else 0
+            eta = self.get_eta(c.files, self.entries, self.rate)
+            eta = f", ETA {fmt_time(eta)}" if self.entries else ""
+            entries = f"{c.dirs:,} dirs, {c.files:,} entries ({rate:,.0f}/s){eta}"
+            return f"{self.label}: {entries} {c.current}"
+        rate = c.bytes / self.elapsed if self.elapsed else 0
+        if self.bytes:
+            eta = self.get_eta(c.bytes, self.bytes, self.rate)
+        else:
+            eta = self.get_eta(c.actions, self.actions)
+        return (
+            f"{self.label}: {c.actions:,}/{self.actions:,} actions, "
+            f"{fmt_bytes(c.bytes)}/{fmt_bytes(self.bytes)} ({fmt_bytes(rate)}/s), "
+            f"ETA {fmt_time(eta)}"
+        )
+
+
+class History:
+    """Throughput of the previous runs of a profile, as exponentially weighted averages"""
+
+    def __init__(self, path: str, weight: float = 0.5):
+        self.path = path
+        self.weight = weight
+        try:
+            with open(path, "r") as f:
+                self.values = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.values = dict()
+
+    def get(self, key: str) -> float:
+        return self.values.get(key)
+
+    def update(self, **values):
+        """Blend the values of a run into the averages and save them"""
+        for k, v in values.items():
+            old = self.values.get(k)
+            self.values[k] = v if old is None else self.weight * v + (1 - self.weight) * old
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(self.values, f)
+        os.replace(f"{self.path}.tmp", self.path)
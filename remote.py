@@ -0,0 +1,161 @@
+"""Scanner agent for destinations mounted from a server (SSHFS, NFS). The agent is spawned
+on the server over a command pipe, e.g. ssh, walks the target trees locally and streams
+back a zlib-compressed snapshot of (root, type, size, mtime, path) records, served to the
+monitors in place of a destination manifest. Its source is sent over the pipe,
+so nothing has to be installed on the server"""
+
+import os
+import re
+import sys
+import json
+import zlib
+import shlex
+import struct
+import bisect
+import weakref
+import subprocess
+
+# reads the source of the agent from the pipe and runs it
+BOOT = "import sys; exec(sys.stdin.buffer.read(int(sys.stdin.buffer.readline())))"
+CHUNK = 1 << 20
+
+
+def walk(remote: str, local: str, exclude: re.Pattern, index: int = 0):
+    """Records of the remote tree, tagged with the index of its root - a missing root
+    has no records. Excludes are matched against the local paths.
+    The rootdir itself is the record with an empty path"""
+    stack = [("", True)]
+    while stack:
+        rel, is_dir = stack.pop()
+        path = f"{remote}/{rel}" if rel else remote
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        is_dir = os.path.isdir(path) if not rel else is_dir
+        yield f"{index}\t{'d' if is_dir else 'f'}\t{st.st_size}\t{st.st_mtime_ns}\t{rel}\0"
+        if not is_dir:
+            continue
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for e in entries:
+            child = f"{rel}/{e.name}" if rel else e.name
+            if exclude.search(f"{local}/{child}"):
+                continue
+            stack.append((child, e.is_dir()))
+
+
+def serve(stdin, stdout):
+    """Agent: answers each request - a JSON line {"roots": [[remote, local, exclude]]} - with
+    frames of the compressed records, terminated by an empty frame"""
+    for line in stdin:
+        request = json.loads(line)
+        compressor = zlib.compressobj(6)
+        buf = list()
+        size = 0
+
+        def send(data: bytes):
+            if data:
+                stdout.write(struct.pack(">I", len(data)) + data)
+
+        for i, (remote, local, exclude) in enumerate(request["roots"]):
+            for record in walk(remote, local, re.compile(exclude), i):
+                buf.append(record)
+                size += len(record)
+                if size >= CHUNK:
+                    send(compressor.compress("".join(buf).encode(errors="surrogateescape")))
+                    buf, size = list(), 0
+        send(compressor.compress("".join(buf).encode(errors="surrogateescape")))
+        send(compressor.flush())
+        stdout.write(struct.pack(">I", 0))
+        stdout.flush()
+
+
+class ScannerAgent:
+    """Client of an agent spawned by the command, which runs its last argument as a shell
+    command: ["ssh", "host"], ["sh", "-c"], ["docker", "exec", "c", "sh", "-c"], ..."""
+
+    def __init__(self, command: list, python: str = "python3"):
+        import inspect
+
+        source = inspect.getsource(sys.modules[__name__]).encode()
+        self.proc = subprocess.Popen(
+            [*command, shlex.join([python, "-c", BOOT])],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.finalizer = weakref.finalize(self, self.stop, self.proc)
+        self.send(f"{len(source)}\n".encode() + source)
+
+    @staticmethod
+    def stop(proc):
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        proc.wait()
+
+    def send(self, data: bytes):
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            raise ConnectionError(f"Scanner agent exited with {self.proc.wait()}")
+
+    def read_frame(self) -> bytes:
+        head = self.proc.stdout.read(4)
+        if len(head) < 4:
+            raise ConnectionError(f"Scanner agent exited with {self.proc.wait()}")
+        (size,) = struct.unpack(">I", head)
+        return self.proc.stdout.read(size) if size else None
+
+    def scan(self, roots: list) -> dict:
+        """{local path: (size, mtime, is_dir)} of the roots [(remote, local, exclude pattern)]"""
+        request = json.dumps({"roots": [list(r) for r in roots]})
+        self.send(f"{request}\n".encode())
+        decompressor = zlib.decompressobj()
+        entries, tail = dict(), b""
+        while (frame := self.read_frame()) is not None:
+            # a frame may end within a record, even within a character
+            *records, tail = (tail + decompressor.decompress(frame)).split(b"\0")
+            for record in records:
+                record = record.decode(errors="surrogateescape")
+                index, kind, size, mtime, rel = record.split("\t", 4)
+                local = roots[int(index)][1]
+                path = f"{local}/{rel}" if rel else local
+                entries[path] = (int(size), int(mtime) / 1e9, kind == "d")
+        return entries
+
+    def close(self):
+        self.finalizer()
+
+
+class RemoteSnapshot:
+    """Entries of the target trees scanned by the agent.
+    Read like a DestManifest: get(path) and the sorted list(path) of a subtree"""
+
+    def __init__(self, entries: dict):
+        self.entries = entries
+        self.keys = sorted(entries)
+
+    def get(self, path: str) -> tuple:
+        """Returns (size, mtime, is_dir) or None if the path wasn't found"""
+        return self.entries.get(path)
+
+    def list(self, path: str) -> list:
+        return list(self.iter_list(path))
+
+    def iter_list(self, path: str):
+        """Entries below the path as (path, is_dir), sorted"""
+        prefix = f"{path.rstrip('/')}/"
+        for key in self.keys[bisect.bisect_left(self.keys, prefix) :]:
+            if not key.startswith(prefix):
+                return
+            yield key, self.entries[key][2]
+
+
+if __name__ == "__main__":
+    serve(sys.stdin.buffer, sys.stdout.buffer)
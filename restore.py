@@ -0,0 +1,58 @@
+"""Restore of the mirrored paths. The mapping of the profile is inverted: the target root
+of each path (<dst>/<basename of src>) becomes the source and the parent of the src
+the destination, so the scan, the diff and the copy engines of the backup restore
+only what differs from the current state of the host. Any difference of the mtime
+or the size is restored ('exact'), also of files modified on the host since the backup"""
+
+import os
+
+from context import PlanContext
+from monitors import AgnosticMonitor
+from scan import is_within
+
+# settings of the backup side, meaningless or harmful on the host
+BACKUP_SETTINGS = {"manifest", "digests", "verify_manifest", "cmd"}
+
+
+def invert_path(path: dict, root: str, subpath: str = "", target: str = None) -> dict:
+    """Path restoring the subpath of the src (the whole src if empty) from the target root.
+    Restored under the target directory instead of the src, if given"""
+    src = path["src"]
+    rel = os.path.relpath(subpath, src) if subpath and is_within(subpath, src) else ""
+    host = os.path.join(target, src.lstrip("/")) if target else src
+    restored = os.path.normpath(os.path.join(host, rel))
+    return {
+        **path,
+        "src": os.path.normpath(os.path.join(root, rel)),
+        "dst": os.path.dirname(restored) or ".",
+    }
+
+
+def invert_config(config: dict, subpaths: list = None, target: str = None) -> tuple:
+    """Config restoring the mirrored paths of the profile and the skipped paths.
+    Subpaths select the parts of the sources to restore, paths fanned out to many
+    destinations are restored from the first one"""
+    context = PlanContext(config)
+    paths, skipped, fanouts = list(), list(), set()
+    for path in context.paths:
+        if not AgnosticMonitor.is_mirrored(path):
+            skipped.append(path)
+            continue
+        if "fanout" in path:
+            if path["fanout"] in fanouts:
+                continue
+            fanouts.add(path["fanout"])
+        root = context.get_target_root(path)
+        for sub in subpaths or [""]:
+            sub = os.path.normpath(sub) if sub else ""
+            if not sub or is_within(sub, path["src"]):
+                paths.append(invert_path(path, root, sub, target))
+            elif is_within(path["src"], sub):
+                # the whole src is within the selected subtree
+                paths.append(invert_path(path, root, "", target))
+    for batch_id, path in enumerate(paths):
+        path["batch_id"] = batch_id
+    settings = {k: v for k, v in config["settings"].items() if k not in BACKUP_SETTINGS}
+    settings["mkdirs"] = list()
+    settings["exact"] = True
+    return {**config, "paths": paths, "settings": settings}, skipped
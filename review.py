@@ -0,0 +1,108 @@
+"""Summarized review of huge plans. Actions are aggregated per subtree of the
+destination and rendered as a compact document - rows can be expanded on demand
+and deleting a row drops all of its actions, without re-scanning"""
+
+import os
+from bisect import bisect_left
+
+HEADER = [
+    "# Delete a row to drop all actions of its subtree, prefix it with '+' to expand it.",
+    "# Save to apply the changes, leave the file unchanged to cancel.",
+]
+
+
+class PlanSummary:
+    """Index of the plan's actions, sorted by the destination path.
+    Actions of a subtree are found by bisection, so rows are expanded
+    without walking the whole plan"""
+
+    def __init__(self, actions: list, depth: int = 2, top: int = 3):
+        self.actions = sorted(actions, key=lambda a: a["dst"])
+        self.keys = [a["dst"] for a in self.actions]
+        self.depth = depth
+        self.top = top
+        self.base = os.path.commonpath(self.keys) if self.keys else "/"
+        if len(self.actions) == 1:
+            self.base = os.path.dirname(self.base)
+
+    def get_range(self, subtree: str) -> list:
+        """Actions of the subtree (including the subtree itself)"""
+        i = bisect_left(self.keys, subtree)
+        exact = self.actions[i : i + 1] if self.keys[i : i + 1] == [subtree] else []
+        lo, hi = bisect_left(self.keys, f"{subtree}/"), bisect_left(self.keys, f"{subtree}0")
+        return exact + self.actions[lo:hi]
+
+    def get_rows(self, subtree: str = None, depth: int = 1) -> dict:
+        """Group actions of the subtree by (action, child) 'depth' levels below it.
+        Entries within the cut are grouped with their dir, so each row is a whole subtree
+        and a dir of many files is a single row - only the entries right below the subtree
+        are rows of their own"""
+        subtree = subtree or self.base
+        actions = self.actions if subtree == self.base else self.get_range(subtree)
+        split = list()
+        for a in actions:
+            rel = os.path.relpath(a["dst"], subtree)
+            split.append((a, tuple() if rel == "." else tuple(rel.split("/"))))
+        grouped = {parts[:-1] for _, parts in split if 1 < len(parts) <= depth}
+        rows = dict()
+        for a, parts in split:
+            cut = min(depth, len(parts))
+            cut = next((k for k in range(1, cut) if parts[:k] in grouped), cut)
+            child = os.path.join(subtree, *parts[:cut]) if parts else subtree
+            rows.setdefault((a["action"], child), list()).append(a)
+        return rows
+
+    def fmt_row(self, key: tuple, actions: list, indent: int = 0) -> list:
+        action, subtree = key
+        size = sum(a.get("size") or 0 for a in actions)
+        out = [f"{'  '*indent}{action}\t{subtree}\t{len(actions):,} actions\t{size:,} bytes"]
+        if len(actions) > 1:
+            largest = sorted(actions, key=lambda a: -(a.get("size") or 0))[: self.top]
+            out.append(
+                f"#{'  '*indent}   largest: "
+                + ", ".join(f"{a['dst']} ({a.get('size') or 0:,})" for a in largest)
+            )
+        return out
+
+    def render(self, rows: dict, stats: str = "") -> str:
+        """Review document of the rows {(action, subtree): actions}"""
+        out = [f"# Plan: {stats}"] if stats else []
+        out.extend(HEADER)
+        for key in sorted(rows, key=lambda k: (k[1], k[0])):
+            out.extend(self.fmt_row(key, rows[key]))
+        return "\n".join(out) + "\n"
+
+    @staticmethod
+    def parse(text: str) -> tuple:
+        """Returns the (action, subtree) of the remaining rows and of the rows to expand"""
+        kept, expand = set(), set()
+        for line in text.splitlines():
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            fields = line.strip().split("\t")
+            if len(fields) < 2:
+                continue
+            action, subtree = fields[0], fields[1]
+            if action.startswith("+"):
+                expand.add((action[1:].strip(), subtree))
+            kept.add((action.lstrip("+").strip(), subtree))
+        return kept, expand
+
+    def update(self, rows: dict, text: str) -> tuple:
+        """Apply the edited document to the rows.
+        Returns (rows, dropped actions, if any row was expanded)"""
+        kept, expand = self.parse(text)
+        dropped = [a for key, actions in rows.items() if key not in kept for a in actions]
+        out = dict()
+        for key, actions in rows.items():
+            if key not in kept:
+                continue
+            children = self.get_rows(key[1]) if key in expand else {key: actions}
+            children = {k: v for k, v in children.items() if k[0] == key[0]}
+            if key in expand and len(children) == 1 and key in children:
+                # a leaf, it can't be expanded further
+                out[key] = actions
+                continue
+            for k, v in children.items():
+                out.setdefault(k, list()).extend(v)
+        return out, dropped, bool(expand)
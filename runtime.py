@@ -0,0 +1,661 @@
+"""Functions used by the generated Python script.
+The PythonScriptGenerator inlines this module, so the script remains standalone"""
+
+import os
+import mmap
+import queue
+import atexit
+import shutil
+import tarfile
+import logging
+import functools
+import threading
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("OpenBackup")
+BUFSIZE = 1 << 20
+PART = ".obpart"
+journal = None
+journal_lock = threading.Lock()
+done = set()
+manifests = dict()
+copy_io = None
+governor = None
+action_log = None
+progress = None
+
+
+def open_journal(path):
+    """Load ids of the completed actions and append the new ones as they complete"""
+    global journal
+    try:
+        with open(path, "r") as f:
+            done.update(line.strip() for line in f)
+    except FileNotFoundError:
+        pass
+    journal = open(path, "a", buffering=1)
+
+
+def checkpointed(fn):
+    """Skip the action if its 'aid' is in the journal, record it once it completes"""
+
+    @functools.wraps(fn)
+    def wrapper(*args, aid=None, **kwargs):
+        if aid is not None and str(aid) in done:
+            return
+        pace()
+        fn(*args, **kwargs)
+        if aid is not None and journal:
+            with journal_lock:
+                journal.write(f"{aid}\n")
+
+    return wrapper
+
+
+def open_manifest(root, rebuild=False):
+    """Record the completed actions in the DestManifest of the destination.
+    It's rebuilt from a walk first if the plan found it missing or outdated"""
+    manifests[root] = DestManifest(root)
+    if rebuild:
+        manifests[root].rebuild()
+    atexit.register(manifests[root].close)
+
+
+def track(dst, removed=False):
+    """Update the manifest of the innermost destination containing dst"""
+    roots = [r for r in manifests if dst == r or dst.startswith(f"{r.rstrip('/')}/")]
+    if not roots:
+        return
+    manifest = manifests[max(roots, key=len)]
+    if removed:
+        manifest.remove(dst)
+    else:
+        manifest.record_tree(dst)
+
+
+def open_action_log(path, **opts):
+    """Record the actions and the log messages in a JSON-lines ActionLog instead of logging"""
+    global action_log
+    action_log = ActionLog(path, **opts)
+    handler = ActionLogHandler(action_log)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.DEBUG)
+    atexit.register(action_log.close)
+
+
+def report(action, path, message, error=None, **fields):
+    """Record the outcome of an action in the action log, or else log the message.
+    Counted by the live progress, if enabled"""
+    if progress is not None:
+        progress.counters.done(path, fields.get("bytes") or 0)
+    if action_log is not None:
+        action_log.write(action, path, error, **fields)
+    elif error is None:
+        log.info(message)
+    else:
+        log.error(message)
+
+
+def set_progress(**opts):
+    """Render the progress of the actions with a Progress of the plan's totals"""
+    global progress
+    progress = Progress(Counters(), "Executing", **opts).start()
+    atexit.register(progress.stop)
+
+
+def tree_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files
+    )
+
+
+def set_governor(**opts):
+    """Pace the actions and the copies by a Governor of the options (low-impact mode)"""
+    global governor
+    governor = Governor(**opts).start()
+    atexit.register(governor.stop)
+
+
+def pace():
+    """Block while the governor pauses the backup"""
+    if governor is not None:
+        governor.wait()
+
+
+def set_io(**opts):
+    """Copy the files with a CopyIO of the options instead of shutil.copy2"""
+    global copy_io
+    copy_io = CopyIO(**opts)
+
+
+def copy2(src, dst):
+    """Copy the data and the metadata of the file"""
+    if copy_io is None:
+        return shutil.copy2(src, dst)
+    copy_io.copy(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def advise(fd, advice, offset=0, length=0):
+    """Hint the kernel's page cache, if the platform supports it"""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+class CopyIO:
+    """Copies files sparing the page cache: the source is read sequentially with large
+    page-aligned buffers and dropped from the cache as it's read, the destination is
+    written back and dropped every 'window' bytes, so a copy keeps at most a window cached.
+    Large destinations are preallocated. Files of at least 'direct' bytes bypass the cache
+    with O_DIRECT, if the filesystem supports it"""
+
+    ALIGN = 4096
+
+    def __init__(
+        self, bufsize=4 << 20, prealloc=64 << 20, direct=None, drop_cache=True, window=8 << 20
+    ):
+        self.bufsize = max(self.ALIGN, bufsize // self.ALIGN * self.ALIGN)
+        self.prealloc = prealloc
+        self.direct = direct if getattr(os, "O_DIRECT", 0) else None
+        self.drop_cache = drop_cache and hasattr(os, "POSIX_FADV_DONTNEED")
+        self.window = window
+
+    def copy(self, src, dst):
+        size = os.stat(src).st_size
+        if self.direct and size >= self.direct:
+            try:
+                return self.copy_direct(src, dst, size)
+            except OSError as e:
+                log.debug(f"Direct copy of {src} failed ({e}), copying through the cache")
+        with open(src, "rb", buffering=0) as fin, open(dst, "wb", buffering=0) as fout:
+            fdin, fdout = fin.fileno(), fout.fileno()
+            if hasattr(os, "POSIX_FADV_SEQUENTIAL"):
+                advise(fdin, os.POSIX_FADV_SEQUENTIAL)
+            self.preallocate(fdout, size)
+            pos, flushed = 0, 0
+            with mmap.mmap(-1, self.bufsize) as buf, memoryview(buf) as view:
+                while n := fin.readinto(buf):
+                    pace()
+                    self.write(fdout, view[:n])
+                    pos += n
+                    if self.drop_cache and pos - flushed >= self.window:
+                        # dirty pages can't be dropped, the window is written back first
+                        advise(fdin, os.POSIX_FADV_DONTNEED, 0, pos)
+                        os.fdatasync(fdout)
+                        advise(fdout, os.POSIX_FADV_DONTNEED, 0, pos)
+                        flushed = pos
+            if pos != size:
+                # the source changed during the copy
+                os.ftruncate(fdout, pos)
+            if self.drop_cache:
+                advise(fdin, os.POSIX_FADV_DONTNEED)
+                # starts the write-back of the last window
+                advise(fdout, os.POSIX_FADV_DONTNEED, flushed)
+
+    def copy_direct(self, src, dst, size):
+        """Copy with O_DIRECT. Its transfers must be aligned, so the unaligned
+        tail is transferred through the cache"""
+        import fcntl
+
+        fin = os.open(src, os.O_RDONLY | os.O_DIRECT)
+        try:
+            fout = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o666)
+        except OSError:
+            os.close(fin)
+            raise
+        try:
+            self.preallocate(fout, size)
+            pos = 0
+            with mmap.mmap(-1, self.bufsize) as buf, memoryview(buf) as view:
+                while n := os.readv(fin, [buf]):
+                    pace()
+                    if n % self.ALIGN:
+                        for fd in (fin, fout):
+                            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+                    self.write(fout, view[:n])
+                    pos += n
+            os.ftruncate(fout, pos)
+        finally:
+            os.close(fin)
+            os.close(fout)
+
+    def preallocate(self, fd, size):
+        """Reserve the space of a large file at once, which limits its fragmentation"""
+        if size < self.prealloc or not hasattr(os, "posix_fallocate"):
+            return
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
+
+    @staticmethod
+    def write(fd, data):
+        while data:
+            data = data[os.write(fd, data) :]
+
+
+@checkpointed
+def rm(dst):
+    os.remove(dst)
+    track(dst, removed=True)
+    report("rm", dst, f"Removed file {dst}")
+
+
+@checkpointed
+def rmdir(dst):
+    shutil.rmtree(dst)
+    track(dst, removed=True)
+    report("rmdir", dst, f"Removed directory {dst}")
+
+
+@checkpointed
+def mv(src, dst):
+    """Rename the file on the destination, e.g. moved on the source"""
+    os.replace(src, dst)
+    track(src, removed=True)
+    track(dst)
+    report("mv", dst, f"Moved {src} to {dst}", src=src)
+
+
+@checkpointed
+def cp(src, *dsts):
+    """Copy the file to each destination. Source is read only once.
+    Data is written to a temporary file which then replaces the destination"""
+    parts = [f"{dst}{PART}" for dst in dsts]
+    for dst in dsts:
+        os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    if len(dsts) == 1:
+        copy2(src, parts[0])
+    else:
+        tee(src, parts)
+        for part in parts:
+            shutil.copystat(src, part)
+    size = os.stat(parts[0]).st_size
+    for part, dst in zip(parts, dsts):
+        os.replace(part, dst)
+        track(dst)
+        report("cp", dst, f"Copied file to {dst}", src=src, bytes=size)
+
+
+@checkpointed
+def meta(src, *dsts):
+    """Apply the mtime, mode and (as root) the ownership of the file, without copying it"""
+    st = os.stat(src)
+    for dst in dsts:
+        shutil.copystat(src, dst)
+        if hasattr(os, "geteuid") and os.geteuid() == 0:
+            os.chown(dst, st.st_uid, st.st_gid)
+        track(dst)
+        report("meta", dst, f"Updated metadata of {dst}", src=src)
+
+
+@checkpointed
+def cpdir(src, *dsts, ignore=None):
+    """Copy the directory to each destination. Files are teed from the first copy.
+    The tree is built in a temporary directory which is then renamed"""
+    parts = [f"{dst}{PART}" for dst in dsts]
+    for part in parts:
+        # leftover of an interrupted run
+        shutil.rmtree(part, ignore_errors=True)
+    if len(dsts) == 1:
+        shutil.copytree(src, parts[0], ignore=ignore, copy_function=copy2)
+    else:
+        head, tail = parts[0], parts[1:]
+
+        def copy_function(s, d):
+            rel = os.path.relpath(d, head)
+            others = [os.path.join(t, rel) for t in tail]
+            for o in others:
+                os.makedirs(os.path.dirname(o), exist_ok=True)
+            tee(s, [d, *others])
+            for o in [d, *others]:
+                shutil.copystat(s, o)
+
+        shutil.copytree(src, head, ignore=ignore, copy_function=copy_function)
+        for root, _, _ in os.walk(head):
+            rel = os.path.relpath(root, head)
+            for t in tail:
+                os.makedirs(os.path.join(t, rel), exist_ok=True)
+                shutil.copystat(root, os.path.join(t, rel))
+    # the size is only needed by the action log and the progress
+    fields = dict()
+    if action_log is not None or progress is not None:
+        fields["bytes"] = tree_size(parts[0])
+    for part, dst in zip(parts, dsts):
+        if os.path.isdir(dst) and os.listdir(dst):
+            # the tree replaces a previous copy at once
+            old = f"{dst}{PART}.old"
+            os.replace(dst, old)
+            os.replace(part, dst)
+            shutil.rmtree(old)
+        else:
+            os.replace(part, dst)
+        track(dst)
+        report("cpdir", dst, f"Copied directory to {dst}", src=src, **fields)
+
+
+def tee(src, dsts, bufsize=BUFSIZE, depth=8):
+    """Read the src once and write it to all dsts concurrently.
+    Each destination has a writer thread fed by a bounded queue"""
+    queues = [queue.Queue(depth) for _ in dsts]
+    errors = list()
+
+    def writer(dst, q):
+        try:
+            with open(dst, "wb") as f:
+                while (buf := q.get()) is not None:
+                    f.write(buf)
+        except Exception as e:
+            errors.append(e)
+            while q.get() is not None:
+                pass
+
+    threads = [
+        threading.Thread(target=writer, args=(d, q), daemon=True)
+        for d, q in zip(dsts, queues)
+    ]
+    for t in threads:
+        t.start()
+    try:
+        with open(src, "rb") as f:
+            while buf := f.read(bufsize):
+                pace()
+                for q in queues:
+                    q.put(buf)
+    finally:
+        for q in queues:
+            q.put(None)
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+
+
+class Scheduler:
+    """Executes the queued copies concurrently, ordered for throughput:
+    - small files are copied in on-disk order (device, inode) by a pool of workers
+      whose size is adapted to the measured throughput (AIMD)
+    - large files and dirs are streamed by dedicated workers, largest first
+    - all workers share a cap on the bytes in flight
+    """
+
+    def __init__(
+        self,
+        workers=4,
+        max_workers=16,
+        large_workers=2,
+        large_file=64 << 20,
+        inflight_bytes=512 << 20,
+        window=1.0,
+    ):
+        self.limit = workers
+        self.max_workers = max(workers, max_workers)
+        self.large_workers = large_workers
+        self.large_file = large_file
+        self.inflight_cap = inflight_bytes
+        self.window = window
+        self.small, self.large = list(), list()
+        self.errors = list()
+        self.cond = threading.Condition()
+        self.active = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.rate = 0.0
+        self.window_bytes = 0
+        self.window_start = monotonic()
+
+    def cp(self, src, *dsts, aid=None):
+        self.add(cp, src, dsts, {"aid": aid})
+
+    def cpdir(self, src, *dsts, aid=None, ignore=None):
+        self.add(cpdir, src, dsts, {"aid": aid, "ignore": ignore})
+
+    def add(self, fn, src, dsts, kwargs):
+        try:
+            st = os.stat(src)
+            size = None if os.path.isdir(src) else st.st_size
+            locality = (st.st_dev, st.st_ino)
+        except OSError:
+            # let the copy fail and report it
+            size, locality = 0, (0, 0)
+        job = (fn, src, dsts, kwargs)
+        if size is None or size >= self.large_file:
+            self.large.append((size, job))
+        else:
+            self.small.append((locality, size, job))
+
+    def run(self):
+        self.small.sort(key=lambda j: j[0])
+        self.large.sort(key=lambda j: -(j[0] or self.large_file))
+        small = iter([(size, job) for _, size, job in self.small])
+        large = iter(self.large)
+        threads = [
+            threading.Thread(target=self.worker, args=(large, False), daemon=True)
+            for _ in range(self.large_workers)
+        ] + [
+            threading.Thread(target=self.worker, args=(small, True), daemon=True)
+            for _ in range(self.max_workers)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.small, self.large = list(), list()
+        if self.errors:
+            raise self.errors[0]
+
+    def worker(self, jobs, adaptive: bool):
+        while True:
+            with self.cond:
+                try:
+                    size, (fn, src, dsts, kwargs) = next(jobs)
+                except StopIteration:
+                    return
+            size = self.large_file if size is None else size
+            self.acquire(size, adaptive)
+            try:
+                fn(src, *dsts, **kwargs)
+            except Exception as e:
+                self.errors.append(e)
+                report("cp", src, f"Failed to copy {src}: {e}", e)
+            finally:
+                self.release(size, adaptive)
+
+    def acquire(self, size: int, adaptive: bool):
+        """Wait for a free worker slot and room for the bytes in flight.
+        A job bigger than the cap is admitted once nothing else is in flight"""
+        with self.cond:
+            self.cond.wait_for(
+                lambda: (not adaptive or self.active < self.limit)
+                and (self.inflight == 0 or self.inflight + size <= self.inflight_cap)
+            )
+            self.active += adaptive
+            self.inflight += size
+            self.max_inflight = max(self.max_inflight, self.inflight)
+
+    def release(self, size: int, adaptive: bool):
+        with self.cond:
+            self.active -= adaptive
+            self.inflight -= size
+            self.window_bytes += size
+            self.adapt(monotonic())
+            self.cond.notify_all()
+
+    def adapt(self, now: float):
+        """Additive increase of the workers while the throughput grows,
+        multiplicative decrease once it drops"""
+        elapsed = now - self.window_start
+        if elapsed < self.window:
+            return
+        rate = self.window_bytes / elapsed
+        if rate >= self.rate * 0.95:
+            self.limit = min(self.limit + 1, self.max_workers)
+        else:
+            self.limit = max(1, self.limit // 2)
+        self.rate = rate
+        self.window_bytes = 0
+        self.window_start = now
+
+
+class Packer:
+    """Streams runs of small files to the destination as tar batches.
+    A worker on the destination side unpacks the stream, its writers overlap the
+    per-file latency of the mount. Batches are sized from the observed per-file
+    latency, so each takes about 'target' seconds. Other copies go to the fallback.
+    Members are named by their index in the batch and the writers hold at most
+    'inflight_bytes' of read data
+    """
+
+    def __init__(
+        self,
+        small_file=1 << 20,
+        batch=64,
+        min_batch=8,
+        max_batch=8192,
+        workers=8,
+        target=0.5,
+        inflight_bytes=64 << 20,
+        fallback=None,
+    ):
+        self.small_file = small_file
+        self.batch = batch
+        self.min_batch = min_batch
+        self.max_batch = max(batch, max_batch)
+        self.workers = workers
+        self.target = target
+        self.inflight_cap = inflight_bytes
+        self.fallback = fallback or cp
+        self.latency = None
+        self.pending = list()
+        self.batches = 0
+        self.cond = threading.Condition()
+        self.inflight = 0
+        self.max_inflight = 0
+
+    def cp(self, src, *dsts, aid=None):
+        if aid is not None and str(aid) in done:
+            return
+        try:
+            small = len(dsts) == 1 and os.stat(src).st_size < self.small_file
+        except OSError:
+            small = False
+        if not small:
+            return self.fallback(src, *dsts, aid=aid)
+        self.pending.append((src, dsts[0], aid))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """Stream the pending files and wait for the destination to unpack them"""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, list()
+        pace()
+        t0 = monotonic()
+        rfd, wfd = os.pipe()
+        written, errors = list(), list()
+        dsts = [dst for _, dst, _ in batch]
+        worker = threading.Thread(
+            target=self.unpack, args=(os.fdopen(rfd, "rb"), dsts, written, errors), daemon=True
+        )
+        worker.start()
+        try:
+            with os.fdopen(wfd, "wb") as stream:
+                with tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                    for i, (src, _, _) in enumerate(batch):
+                        try:
+                            with open(src, "rb") as f:
+                                info = tar.gettarinfo(arcname=str(i), fileobj=f)
+                                tar.addfile(info, f)
+                        except OSError as e:
+                            errors.append(e)
+                            report("pack", src, f"Failed to pack {src}: {e}", e)
+        finally:
+            worker.join()
+        written = set(written)
+        for src, dst, aid in batch:
+            if dst not in written:
+                continue
+            if aid is not None and journal:
+                with journal_lock:
+                    journal.write(f"{aid}\n")
+        self.batches += 1
+        self.adapt((monotonic() - t0) / len(batch))
+        if errors:
+            raise errors[0]
+
+    def unpack(self, stream, dsts, written, errors):
+        """Read the tar stream, members are written to their dsts by a pool of writers"""
+        made = set()
+
+        def write(dst, data, mode, mtime):
+            try:
+                part = f"{dst}{PART}"
+                with open(part, "wb") as f:
+                    f.write(data)
+                os.chmod(part, mode)
+                os.utime(part, (mtime, mtime))
+                os.replace(part, dst)
+                track(dst)
+                written.append(dst)
+                report("cp", dst, f"Copied file to {dst}", bytes=len(data))
+            except Exception as e:
+                errors.append(e)
+                report("cp", dst, f"Failed to unpack {dst}: {e}", e)
+            finally:
+                self.release(len(data))
+
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                with tarfile.open(fileobj=stream, mode="r|") as tar:
+                    for m in tar:
+                        dst = dsts[int(m.name)]
+                        parent = os.path.dirname(dst)
+                        if parent and parent not in made:
+                            os.makedirs(parent, exist_ok=True)
+                            made.add(parent)
+                        self.acquire(m.size)
+                        try:
+                            data = tar.extractfile(m).read()
+                        except Exception:
+                            self.release(m.size)
+                            raise
+                        pool.submit(write, dst, data, m.mode, m.mtime)
+        except Exception as e:
+            errors.append(e)
+            # unblock the writer of the stream
+            while stream.read(BUFSIZE):
+                pass
+        finally:
+            stream.close()
+
+    def acquire(self, size: int):
+        """Wait for room for the member's data. A member bigger than the cap
+        is admitted once nothing else is in flight"""
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.inflight == 0 or self.inflight + size <= self.inflight_cap
+            )
+            self.inflight += size
+            self.max_inflight = max(self.max_inflight, self.inflight)
+
+    def release(self, size: int):
+        with self.cond:
+            self.inflight -= size
+            self.cond.notify_all()
+
+    def adapt(self, latency: float):
+        """Smoothed per-file latency sets the size of the next batch"""
+        self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+        size = round(self.target / max(self.latency, 1e-6))
+        self.batch = max(self.min_batch, min(self.max_batch, size))
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,301 @@
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from progress import Counters
+
+# progress of the walks, bumped once per listed dir
+counters = Counters()
+
+
+def build_tree(rootdir: str, exclude: re.Pattern, fingerprint: dict, kinds: dict = None) -> set:
+    """Build Tree Recursive - all paths under the rootdir, excluded ones are pruned.
+    Mtimes of the visited dirs (and of the rootdir's parent) are recorded in the fingerprint,
+    whether each path is a dir - in the kinds
+    """
+    res = set()
+    kinds = dict() if kinds is None else kinds
+    parent = os.path.dirname(rootdir) or "."
+    try:
+        fingerprint.setdefault(parent, os.stat(parent).st_mtime_ns)
+    except FileNotFoundError:
+        fingerprint[parent] = None
+    _build_tree_recursive(rootdir, exclude, res, fingerprint, kinds)
+    return res
+
+
+def _build_tree_recursive(
+    rootdir: str, exclude: re.Pattern, res: set, fingerprint: dict, kinds: dict
+):
+    try:
+        with os.scandir(rootdir) as it:
+            entries = list(it)
+        fingerprint[rootdir] = os.stat(rootdir).st_mtime_ns
+        kinds[rootdir] = True
+        counters.listed(rootdir, len(entries))
+        for e in entries:
+            path = f"{rootdir}/{e.name}"
+            if exclude.search(path):
+                continue
+            res.add(path)
+            # the type is usually known from the listing, without a stat
+            kinds[path] = e.is_dir()
+            if kinds[path]:
+                _build_tree_recursive(path, exclude, res, fingerprint, kinds)
+    except FileNotFoundError:
+        pass
+    except NotADirectoryError:
+        res.add(rootdir)
+        kinds[rootdir] = False
+
+
+def build_tree_parallel(
+    rootdir: str, exclude: re.Pattern, fingerprint: dict, kinds: dict = None, workers: int = 4
+) -> set:
+    """Same as build_tree, the tree is walked by a ParallelWalker"""
+    res = set()
+    kinds = dict() if kinds is None else kinds
+    parent = os.path.dirname(rootdir) or "."
+    try:
+        fingerprint.setdefault(parent, os.stat(parent).st_mtime_ns)
+    except FileNotFoundError:
+        fingerprint[parent] = None
+    for current, mtime, entries in ParallelWalker(workers).walk(rootdir, exclude):
+        if mtime is None:
+            # the rootdir is a file
+            res.add(current)
+            kinds[current] = False
+            continue
+        fingerprint[current] = mtime
+        kinds[current] = True
+        for path, is_dir in entries:
+            res.add(path)
+            kinds[path] = is_dir
+    return res
+
+
+class ParallelWalker:
+    """Walks a single tree with a pool of threads. Each worker owns a deque of dirs:
+    it lists the newest dir of its own (depth first) and, once idle, steals the oldest
+    dir of another worker - the biggest untouched subtree. Listings are merged in the
+    order of the dirs, so the result doesn't depend on the scheduling"""
+
+    def __init__(self, workers: int = 4):
+        self.workers = max(1, workers)
+
+    def walk(self, rootdir: str, exclude: re.Pattern) -> list:
+        """Returns [(dir, mtime_ns, [(path, is_dir)])] sorted by the dir.
+        The mtime is None if the rootdir is a file"""
+        self.deques = [deque() for _ in range(self.workers)]
+        self.deques[0].append(rootdir)
+        self.pending = 1
+        self.cond = threading.Condition()
+        self.listings, self.errors = list(), list()
+        threads = [
+            threading.Thread(target=self.worker, args=(i, exclude), daemon=True)
+            for i in range(self.workers)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if self.errors:
+            raise self.errors[0]
+        return sorted(self.listings, key=lambda x: x[0])
+
+    def take(self, i: int) -> str:
+        if self.deques[i]:
+            return self.deques[i].pop()
+        for j in range(1, self.workers):
+            if victim := self.deques[(i + j) % self.workers]:
+                return victim.popleft()
+        return None
+
+    def worker(self, i: int, exclude: re.Pattern):
+        while True:
+            with self.cond:
+                while (current := self.take(i)) is None or self.errors:
+                    if self.pending == 0 or self.errors:
+                        return
+                    self.cond.wait()
+            subdirs = list()
+            try:
+                subdirs = self.list_dir(current, exclude)
+            except Exception as e:
+                self.errors.append(e)
+            with self.cond:
+                self.deques[i].extend(subdirs)
+                self.pending += len(subdirs) - 1
+                self.cond.notify_all()
+
+    def list_dir(self, current: str, exclude: re.Pattern) -> list:
+        """Record the listing of the dir, returns its subdirs"""
+        try:
+            with os.scandir(current) as it:
+                found = list(it)
+            mtime = os.stat(current).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        except NotADirectoryError:
+            self.listings.append((current, None, []))
+            return []
+        entries, subdirs = list(), list()
+        for e in found:
+            path = f"{current}/{e.name}"
+            if exclude.search(path):
+                continue
+            is_dir = e.is_dir()
+            entries.append((path, is_dir))
+            if is_dir:
+                subdirs.append(path)
+        self.listings.append((current, mtime, entries))
+        counters.listed(current, len(found))
+        return subdirs
+
+
+def iter_tree(rootdir: str, exclude: re.Pattern, fingerprint: dict = None, skip: set = None):
+    """Walk without collecting the tree, yields (path, is_dir, entry).
+    A dir added to the skip while its entry is consumed isn't descended.
+    Mtimes of the visited dirs are recorded in the fingerprint"""
+    fingerprint = dict() if fingerprint is None else fingerprint
+    skip = set() if skip is None else skip
+    parent = os.path.dirname(rootdir) or "."
+    try:
+        fingerprint.setdefault(parent, os.stat(parent).st_mtime_ns)
+    except FileNotFoundError:
+        fingerprint[parent] = None
+    stack = [rootdir]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = list(it)
+            fingerprint[current] = os.stat(current).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        except NotADirectoryError:
+            yield current, False, None
+            continue
+        counters.listed(current, len(entries))
+        subdirs = list()
+        for e in entries:
+            path = f"{current}/{e.name}"
+            if exclude.search(path):
+                continue
+            is_dir = e.is_dir()
+            yield path, is_dir, e
+            if is_dir and path not in skip:
+                subdirs.append(path)
+            skip.discard(path)
+        stack.extend(reversed(subdirs))
+
+
+def is_within(path: str, root: str) -> bool:
+    return path == root or path.startswith(f"{root.rstrip('/')}/")
+
+
+def outermost(items, key, is_tree) -> list:
+    """Items not within the tree of another item, e.g. files of a removed dir.
+    Items are sorted by the key, so parents are seen before their children"""
+    out, trees = list(), set()
+    for item in sorted(items, key=key):
+        path = key(item)
+        parent = os.path.dirname(path)
+        while parent not in trees and parent != os.path.dirname(parent):
+            parent = os.path.dirname(parent)
+        if parent in trees:
+            continue
+        out.append(item)
+        if is_tree(item):
+            trees.add(path)
+    return out
+
+
+def select_tree(entries, rootdir: str, exclude: re.Pattern, prune: bool = True) -> set:
+    """Entries under the rootdir. If prune, apply the exclude as the walk would have"""
+    prefix = f"{rootdir}/"
+    if not prune:
+        return {e for e in entries if e.startswith(prefix)}
+    return set(iter_select(sorted(e for e in entries if e.startswith(prefix)), exclude))
+
+
+def iter_select(entries, exclude: re.Pattern):
+    """Sorted entries without the excluded ones and their children"""
+    pruned = set()
+    # parents are sorted before their children
+    for e in entries:
+        if e[: e.rfind("/")] in pruned or exclude.search(e):
+            pruned.add(e)
+        else:
+            yield e
+
+
+class SharedScan:
+    """Snapshot of the trees scanned by many monitors (e.g. of different profiles).
+    Overlapping roots are deduplicated - only the outermost one is walked
+    and nested roots are served by filtering its snapshot"""
+
+    no_exclude = re.compile(r".^")
+
+    def __init__(self, workers: int = 4):
+        self.workers = workers
+        self.snapshots = dict()
+
+    def plan(self, roots: list[tuple[str, re.Pattern]]) -> dict:
+        """Map outermost roots to the exclude they can be walked with.
+        If consumers of a root disagree on excludes, it's walked unfiltered"""
+        outer = list()
+        for root in sorted({r for r, _ in roots}):
+            if not any(is_within(root, o) for o in outer):
+                outer.append(root)
+        plan = dict()
+        for root in outer:
+            patterns = {e.pattern for r, e in roots if is_within(r, root)}
+            plan[root] = (
+                next(e for r, e in roots if is_within(r, root))
+                if len(patterns) == 1
+                else self.no_exclude
+            )
+        return plan
+
+    def prefetch(self, roots: list[tuple[str, re.Pattern]]):
+        """Walk the deduplicated roots concurrently"""
+        plan = self.plan(roots)
+        with ThreadPoolExecutor(self.workers) as pool:
+            walks = pool.map(lambda kv: self.walk(*kv), plan.items())
+            for root, snapshot in zip(plan, walks):
+                self.snapshots[root] = snapshot
+
+    def walk(self, root: str, exclude: re.Pattern) -> tuple:
+        fingerprint, kinds = dict(), dict()
+        return exclude, build_tree(root, exclude, fingerprint, kinds), fingerprint, kinds
+
+    def get(self, rootdir: str, exclude: re.Pattern, fingerprint: dict, kinds: dict = None) -> set:
+        """Same as build_tree, served from the snapshot if possible"""
+        kinds = dict() if kinds is None else kinds
+        outer = next((r for r in self.snapshots if is_within(rootdir, r)), None)
+        if outer is None:
+            return build_tree(rootdir, exclude, fingerprint, kinds)
+        snap_exclude, entries, snap_fingerprint, snap_kinds = self.snapshots[outer]
+        # the rootdir could have been pruned while walking the outer root
+        node = rootdir
+        while node != outer:
+            if snap_exclude.search(node):
+                return build_tree(rootdir, exclude, fingerprint, kinds)
+            node = os.path.dirname(node)
+        parent = os.path.dirname(rootdir) or "."
+        fingerprint.setdefault(parent, snap_fingerprint.get(parent))
+        if rootdir not in snap_fingerprint:
+            # a file or a missing path
+            if rootdir not in entries:
+                return set()
+            kinds[rootdir] = False
+            return {rootdir}
+        res = select_tree(entries, rootdir, exclude, snap_exclude.pattern != exclude.pattern)
+        fingerprint[rootdir] = snap_fingerprint[rootdir]
+        kinds[rootdir] = True
+        fingerprint.update((d, snap_fingerprint[d]) for d in res if d in snap_fingerprint)
+        kinds.update((e, snap_kinds[e]) for e in res)
+        return res
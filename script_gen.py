@@ -1,8 +1,25 @@
 import os
 import re
+import json
+import inspect
 from abc import ABC, abstractmethod
 
-from monitors import LinuxMonitor, PythonMonitor
+from actions import (
+    COPYTREE,
+    EXTRACT,
+    META,
+    MKDIR,
+    MOVE,
+    REMOVE,
+    RMTREE,
+    TRANSFERS,
+    Optimizer,
+    lower,
+    lower_mkdirs,
+)
+from context import PlanContext
+from monitors import AgnosticMonitor, LinuxMonitor, PythonMonitor
+from scan import is_within
 
 
 def sq(text: str):
@@ -21,12 +38,192 @@ class AgnosticScriptGenerator(ABC):
 
     def parse_cmd(self, cmd: str) -> str:
         """Replace special tags with corresponding variables"""
-        cmd = cmd.replace(r"${LOG_PATH}", sq(self.logpath))
+        cmd = cmd.replace(r"${LOG_PATH}", self.log_target)
         return cmd
 
     def parse_path(self, path: str) -> str:
         return self.re_path.sub(r"\ ", path)
 
+    def gen_cas_lines(self) -> list:
+        """Python statements updating the content-addressed stores ('cas' layout paths).
+        Paths sharing a dst share the store, so their contents are deduplicated"""
+        import cas
+
+        stores = dict()
+        for path in self.context.paths:
+            if path.get("layout") == "cas" and not (path.get("archive") or path.get("extract")):
+                stores.setdefault(os.path.join(path["dst"], ".cas"), list()).append(path)
+        out = list()
+        for root, paths in stores.items():
+            manifest = cas.CasStore(root).manifest
+            out.append(f"store = CasStore('{root}')")
+            for path in paths:
+                puts, drops = self.monitor.get_cas_changes(path, manifest)
+                out.extend(f"store.put('{src}', '{key}')" for src, key in puts)
+                out.extend(f"store.drop('{key}')" for key in drops)
+            out.append("store.commit()")
+        return out
+
+    def get_manifest_roots(self) -> list:
+        """Destinations of the mirrored paths, if the 'manifest' setting is enabled"""
+        if not self.config["settings"].get("manifest"):
+            return []
+        return sorted(
+            {
+                p["dst"]
+                for p in self.context.paths
+                if self.monitor.is_mirrored(p)
+            }
+        )
+
+    def get_stale_manifests(self) -> list:
+        """Roots whose manifest is missing or outdated - the plan walked them and
+        the script rebuilds the manifest before the actions"""
+        return [r for r in self.get_manifest_roots() if self.monitor.get_manifest(r) is None]
+
+    def get_manifest_source(self) -> list:
+        """Source of the manifest module, without its command line entry point"""
+        import manifest
+
+        return inspect.getsource(manifest).split('\nif __name__ == "__main__":')[0].splitlines()
+
+    def get_cas_source(self) -> list:
+        import cas
+
+        return inspect.getsource(cas).splitlines()
+
+    def get_extract_source(self) -> list:
+        """Source of the extract module, without its command line entry point"""
+        import extract
+
+        return inspect.getsource(extract).split('\nif __name__ == "__main__":')[0].splitlines()
+
+    def get_action_log_options(self) -> dict:
+        """Options of the 'actionlog' setting, None if disabled"""
+        if not (opts := self.config["settings"].get("actionlog")):
+            return None
+        return opts if isinstance(opts, dict) else dict()
+
+    def get_action_log_source(self, entry_point: bool = False) -> list:
+        """Source of the actionlog module, with its command line entry point if requested"""
+        import actionlog
+
+        source = inspect.getsource(actionlog)
+        if not entry_point:
+            source = source.split('\nif __name__ == "__main__":')[0]
+        return source.splitlines()
+
+    def get_governor_options(self) -> tuple:
+        """(priority, governor) options of the 'governor' setting, None if disabled"""
+        if not (opts := self.config["settings"].get("governor")):
+            return None
+        opts = dict(opts) if isinstance(opts, dict) else dict()
+        priority = {"nice": opts.pop("nice", 10), "ioclass": opts.pop("ioclass", 3)}
+        return priority, opts
+
+    def get_governor_source(self, entry_point: bool = False) -> list:
+        """Source of the governor module, with its command line entry point if requested"""
+        import governor
+
+        source = inspect.getsource(governor)
+        if not entry_point:
+            source = source.split('\nif __name__ == "__main__":')[0]
+        return source.splitlines()
+
+    def get_progress_options(self) -> dict:
+        """Options of the 'progress' setting, None if disabled"""
+        if not (opts := self.config["settings"].get("progress")):
+            return None
+        return opts if isinstance(opts, dict) else dict()
+
+    def get_progress_source(self) -> list:
+        import progress
+
+        return inspect.getsource(progress).splitlines()
+
+    def checkpoint(self, action: str, src: str = None, dst: str = None) -> str:
+        """Register the action in the actions_index.
+        Returns its id if the checkpoint journal is enabled, else None"""
+        if not self.config["settings"].get("journal"):
+            return None
+        aid = str(len(self.actions_index) + 1)
+        self.actions_index.append({"id": aid, "action": action, "src": src, "dst": dst})
+        return aid
+
+    @abstractmethod
+    def get_transfers(self) -> list:
+        """Copy/update actions of the plan [{src, dst, action, batch_id}]"""
+        ...
+
+    @abstractmethod
+    def get_stats(self, with_bytes=True) -> dict:
+        """Summary of the generated plan: {deletions, copies, bytes}"""
+        ...
+
+    @abstractmethod
+    def get_actions(self) -> list:
+        """All actions of the plan [{src, dst, action, batch_id}]"""
+        ...
+
+    def get_optimize_options(self) -> dict:
+        """Options of the 'optimize' setting, None if disabled"""
+        if not (opts := self.config["settings"].get("optimize")):
+            return None
+        return opts if isinstance(opts, dict) else dict()
+
+    def get_plan(self) -> list:
+        """Ops of the plan, lowered from the actions and optimized once per generation.
+        Both backends render their scripts from it"""
+        if self.plan is None:
+            optimizer = Optimizer(self.monitor, self.get_optimize_options())
+            ops = lower_mkdirs(self.config["settings"]["mkdirs"])
+            ops.extend(lower(self.get_plan_actions(), self.monitor))
+            self.plan = optimizer.run(ops)
+        return self.plan
+
+    def get_plan_actions(self) -> list:
+        """Actions lowered to the plan"""
+        return self.get_actions()
+
+    def get_ops(self, *kinds) -> list:
+        return [op for op in self.get_plan() if op.kind in kinds]
+
+    def get_totals(self) -> dict:
+        """Totals of the plan for the progress: {actions, bytes}. A transfer to many
+        destinations counts for each of them, the sizes are served from the scan"""
+        if self.totals is None:
+            actions, size = 0, 0
+            for op in self.get_plan():
+                if op.kind in {MKDIR, EXTRACT}:
+                    continue
+                actions += len(op.dsts)
+                if op.kind in TRANSFERS:
+                    try:
+                        size += self.monitor.get_size(op.src) * len(op.dsts)
+                    except OSError:
+                        pass
+            self.totals = {"actions": actions, "bytes": size}
+        return self.totals
+
+    @abstractmethod
+    def drop(self, actions: list):
+        """Leave the actions out of the plan. Takes effect on the next generate(),
+        which re-uses the results of the scan"""
+        ...
+
+    def count_transfers(self, monitor: AgnosticMonitor, res: list, with_bytes: bool) -> dict:
+        """Count copy/update actions and the size of their sources"""
+        transfers = [p for p in res if p["action"] in {"copy", "update"}]
+        size = None
+        if with_bytes:
+            size = 0
+            for p in transfers:
+                try:
+                    size += monitor.get_size(p["src"])
+                except OSError:
+                    pass
+        return {"copies": len(transfers), "bytes": size}
+
 
 class LinuxScriptGenerator(AgnosticScriptGenerator):
     """Generate instructions for the bash script. It employs the rsync
@@ -38,26 +235,59 @@ class LinuxScriptGenerator(AgnosticScriptGenerator):
         self.logpath = self.config["settings"]["logfile"]
         self.compression_options = {"tar": "", "bz2": "j", "gzip": "z"}
         self.log_ref = r'"${log[@]}"'
-        self.monitor = LinuxMonitor(self.config)
+        self.context = PlanContext(self.config)
+        self.monitor = LinuxMonitor(self.config, self.context)
+        self.dropped = set()
+        self.plan = None
+        self.totals = None
+
+    @property
+    def govern(self) -> str:
+        """Prefix of the commands paced by the governor"""
+        return "govern " if self.get_governor_options() else ""
 
     def generate(self) -> list:
         """Create a list of all operations - foundament of the bash script"""
         self.out: list = list()
+        self.actions_index: list = list()
+        self.plan = None
+        self.totals = None
         self.gen_header()
         self.gen_logging()
+        self.gen_journal()
+        self.gen_manifest()
+        self.gen_governor()
+        self.gen_extract()
         self.gen_mkdirs()
         self.gen_cmds("pre")
         self.gen_monitor_actions()
+        self.gen_meta()
         self.gen_tool_actions()
+        self.gen_cas()
         self.gen_cmds("post")
+        self.gen_log_exit()
+        self.gen_journal_exit()
         return self.out
 
     def gen_header(self):
         self.out.extend([self.config["settings"].get("shebang", "#!/bin/bash"), ""])
         self.out.extend(["# Enable Pathname Expansion", "shopt -s extglob", ""])
 
+    @property
+    def log_target(self) -> str:
+        """Where the output of the commands is appended: the logfile or the action log"""
+        if self.get_action_log_options() is None:
+            return sq(self.logpath)
+        return '"/dev/fd/$actionlog"'
+
+    def logged(self, action: str, path: str, cmd: str) -> str:
+        """Record the outcome of the command in the action log, its output as messages"""
+        return f"alog {action} {sq(path)} {cmd}"
+
     def gen_logging(self):
         self.out.append("# Setup logging")
+        if (opts := self.get_action_log_options()) is not None:
+            return self.gen_action_log(opts)
         self.out.extend(
             [
                 f"echo -n > {sq(self.logpath)}",
@@ -66,15 +296,201 @@ class LinuxScriptGenerator(AgnosticScriptGenerator):
             ]
         )
 
+    def gen_action_log(self, opts: dict):
+        """Output of the commands is fed to the embedded ActionLog writer, rsync reports each
+        transfer, other commands are wrapped by 'alog <action> <path>'. rsync is wrapped by
+        'aerr', which records only its failure - its output is piped. Closed by gen_log_exit"""
+        self.out.extend(
+            [
+                "read -r -d '' actionlog_py <<'OPENBACKUP_ACTIONLOG'",
+                *self.get_action_log_source(entry_point=True),
+                "OPENBACKUP_ACTIONLOG",
+                f'exec {{actionlog}}> >(python3 -c "$actionlog_py" {sq(self.logpath)} {sq(json.dumps(opts))})',
+                "actionlog_pid=$!",
+                "log=(--out-format=$'sync\\t%n\\top=%o\\tbytes=%l')",
+                "alog() {",
+                "\tlocal action=$1 path=$2 rc=0; shift 2",
+                '\t"$@" >&"$actionlog" 2>&1 || rc=$?',
+                "\tif (( rc )); then",
+                "\t\tprintf '%s\\t%s\\terror=%s\\n' \"$action\" \"$path\" \"$rc\"",
+                "\telse",
+                "\t\tprintf '%s\\t%s\\n' \"$action\" \"$path\"",
+                '\tfi >&"$actionlog"',
+                "\treturn $rc",
+                "}",
+                "aerr() {",
+                "\tlocal action=$1 path=$2 rc=0; shift 2",
+                '\t"$@" 2>&1 || rc=$?',
+                "\tif (( rc )); then",
+                "\t\tprintf '%s\\t%s\\terror=%s\\n' \"$action\" \"$path\" \"$rc\" >&\"$actionlog\"",
+                "\tfi",
+                "\treturn $rc",
+                "}",
+                "",
+            ]
+        )
+
+    def gen_log_exit(self):
+        """The action log writes the summary once its input is closed"""
+        if self.get_action_log_options() is None:
+            return
+        self.out.extend(['exec {actionlog}>&-', 'wait "$actionlog_pid"', ""])
+
+    def gen_journal(self):
+        """Actions prefixed with 'step <id>' are skipped if they're already in the journal"""
+        if not (journal := self.config["settings"].get("journal")):
+            return
+        self.out.extend(
+            [
+                "# Checkpoint journal",
+                f"journal={sq(journal)}",
+                'touch "$journal"',
+                'rm -f "$journal.failed"',
+                "declare -A done",
+                'while read -r id; do done[$id]=1; done < "$journal"',
+                "step() {",
+                "\tlocal id=$1; shift",
+                "\t[[ ${done[$id]} ]] && return 0",
+                '\tif "$@"; then echo "$id" >> "$journal"; else touch "$journal.failed"; fi',
+                "}",
+                "",
+            ]
+        )
+
+    def gen_manifest(self):
+        """Completed actions are recorded in the destination manifests
+        by an embedded python script, fed with the affected paths"""
+        if not self.get_manifest_roots():
+            return
+        self.out.extend(
+            [
+                "# Destination manifest",
+                "read -r -d '' manifest_py <<'OPENBACKUP_MANIFEST'",
+                *self.get_manifest_source(),
+                "update(*sys.argv[1:], sys.stdin)",
+                "OPENBACKUP_MANIFEST",
+                *[
+                    f'python3 -c "$manifest_py" rebuild {sq(root)} < /dev/null'
+                    for root in self.get_stale_manifests()
+                ],
+                "",
+            ]
+        )
+
+    def gen_governor(self):
+        """rsync and tar run through 'govern': at a lower priority and paced
+        by the embedded governor, which stops them while the system is under pressure"""
+        if not (opts := self.get_governor_options()):
+            return
+        priority, opts = opts
+        self.out.extend(
+            [
+                "# Low-impact mode",
+                "read -r -d '' governor_py <<'OPENBACKUP_GOVERNOR'",
+                *self.get_governor_source(entry_point=True),
+                "OPENBACKUP_GOVERNOR",
+                f"ionice=(); command -v ionice > /dev/null && ionice=(ionice -c {priority['ioclass']})",
+                "govern() {",
+                f'\tnice -n {priority["nice"]} "${{ionice[@]}}" python3 -c "$governor_py" {sq(json.dumps(opts))} "$@"',
+                "}",
+                "",
+            ]
+        )
+
+    def gen_extract(self):
+        """Source of the extraction engine, if any archive is to be extracted"""
+        paths = [p for p in self.context.paths if p.get("extract")]
+        if all(self.monitor.get_extract_changes(p) == [] for p in paths):
+            return
+        prec = self.config["settings"].get("sync_precision", 1)
+        self.out.extend(
+            [
+                "# Archives extraction",
+                "read -r -d '' extract_py <<'OPENBACKUP_EXTRACT'",
+                *self.get_extract_source(),
+                "logging.basicConfig(format='%(message)s', level='INFO')",
+                f"extract(*sys.argv[1:3], precision={prec!r})",
+                "OPENBACKUP_EXTRACT",
+                "",
+            ]
+        )
+
+    def gen_manifest_removals(self, removed: list) -> list:
+        """Remove the deleted paths from the manifests of their destinations"""
+        return self.gen_manifest_updates(removed, "remove")
+
+    def gen_manifest_updates(self, changed: list, op: str) -> list:
+        """Record or remove the paths in the manifests of their destinations"""
+        groups, roots = dict(), self.get_manifest_roots()
+        for p in changed:
+            if within := [r for r in roots if is_within(p, r)]:
+                groups.setdefault(max(within, key=len), list()).append(p)
+        out = list()
+        for root, paths in groups.items():
+            out.extend(
+                [
+                    f'python3 -c "$manifest_py" {op} {sq(root)} <<\'OPENBACKUP_PATHS\'',
+                    *paths,
+                    "OPENBACKUP_PATHS",
+                ]
+            )
+        return out
+
+    def gen_journal_exit(self):
+        """Exit with an error if any step failed, so that the plan can be resumed"""
+        if self.config["settings"].get("journal"):
+            self.out.extend(['if [[ -e "$journal.failed" ]]; then exit 1; fi', ""])
+
+    def step(self, cmd: str, action: str, src: str = None, dst: str = None) -> str:
+        """Prefix the command with a checkpoint if the journal is enabled"""
+        aid = self.checkpoint(action, src, dst)
+        return cmd if aid is None else f"step {aid} {cmd}"
+
+    def gen_meta(self):
+        """Files whose content is unchanged get the metadata of the source,
+        so that rsync's quick check skips them instead of re-copying"""
+        if not self.config["settings"].get("meta"):
+            return
+        metas = [(op.src, dst) for op in self.get_ops(META) for dst in op.dsts]
+        if not metas:
+            return
+        self.out.extend(
+            [
+                "# Apply metadata (unchanged content)",
+                "meta() {",
+                '	touch -r "$1" "$2" && chmod --reference="$1" "$2" || return 1',
+                "	# the ownership can only be given away by root",
+                '	if [[ $EUID -eq 0 ]]; then chown --reference="$1" "$2"; fi',
+                "}",
+                *[self.step(f"meta {sq(src)} {sq(dst)}", "meta", src, dst) for src, dst in metas],
+                *self.gen_manifest_updates([dst for _, dst in metas], "record"),
+                "",
+            ]
+        )
+
     def gen_tool_actions(self):
         self.out.append("# Sync files")
         for path in self.config["paths"]:
-            if path.get("archive"):
+            if path.get("layout") == "cas" and not (path.get("archive") or path.get("extract")):
+                # stored by gen_cas
+                continue
+            elif path.get("archive"):
                 cmd = self.get_archive_cmd(path)
+                cmd = [self.step(cmd[0], "archive", path["src"], path["dst"])]
             elif path.get("extract"):
+                if self.monitor.get_extract_changes(path) == []:
+                    continue
                 cmd = self.get_extract_cmd(path)
+                arch_path = os.path.join(path["dst"], os.path.basename(path["src"]))
+                cmd = [
+                    self.step(cmd[0], "extract", path["src"], path["dst"]),
+                    self.step(cmd[1], "remove", dst=arch_path),
+                ]
             else:
-                cmd = self.gen_rsync(path)
+                cmd = [
+                    self.step(c, "sync", path["src"], path["dst"])
+                    for c in self.gen_rsync(path)
+                ]
 
             if path.get("require_closed"):
                 self.gen_require_closed(cmd, path)
@@ -88,9 +504,52 @@ class LinuxScriptGenerator(AgnosticScriptGenerator):
             if path.get("isconf")
             else self.config["settings"]["rmode"]
         )
-        return [
-            f"rsync -{mode} {self.parse_path(path['src'])} {self.parse_path(path['dst'])} {self.log_ref}{self.fmt_excl(path)}"
-        ]
+        cmd = f"{self.govern}rsync -{mode} {self.parse_path(path['src'])} {self.parse_path(path['dst'])} {self.log_ref}{self.fmt_excl(path)}"
+        for d in sorted(self.dropped):
+            if is_within(d, path["dst"]):
+                # anchored at the transfer root, i.e. the parent of the src
+                cmd += f" --exclude={sq('/' + os.path.relpath(d, path['dst']))}"
+        manifest = f"""python3 -c "$manifest_py" record {sq(path['dst'])}"""
+        if self.get_action_log_options() is not None:
+            # errors go along the transfers, a failure is recorded
+            cmd = f"aerr sync {sq(path['dst'])} {cmd}"
+        if path["dst"] not in self.get_manifest_roots():
+            if self.get_action_log_options() is not None:
+                cmd += f" >> {self.log_target}"
+            elif self.get_progress_options() is not None:
+                # rsync renders the bytes, the rate and the ETA of the transfer
+                cmd += " --info=progress2"
+        elif self.get_action_log_options() is not None:
+            # names are the second field of the records
+            cmd += f" | tee -a {self.log_target} | cut -s -f2 | {manifest}"
+        else:
+            # transferred names are relative to the dst
+            cmd += f" --out-format='%n' | {manifest}"
+        return [cmd]
+
+    def gen_cas(self):
+        """Content-addressed stores are updated by an embedded python script"""
+        if not (lines := self.gen_cas_lines()):
+            return
+        if self.get_action_log_options() is None:
+            run = "python3 - <<'OPENBACKUP_CAS'"
+            dest = f"filename={self.logpath!r}, "
+        else:
+            # messages to stderr, fed to the action log
+            run = f"python3 - >> {self.log_target} 2>&1 <<'OPENBACKUP_CAS'"
+            dest = ""
+        self.out.extend(
+            [
+                "# Content-addressed store",
+                run,
+                "import logging",
+                f"logging.basicConfig({dest}format='%(message)s', level='INFO')",
+                *self.get_cas_source(),
+                *lines,
+                "OPENBACKUP_CAS",
+                "",
+            ]
+        )
 
     def gen_cmds(self, which: str):
         """Generate which:(pre,post) commands if available"""
@@ -101,15 +560,11 @@ class LinuxScriptGenerator(AgnosticScriptGenerator):
             self.out.append(self.parse_cmd(c))
         self.out.append("")
 
-    def gen_require_closed(self, cmd: str, path):
-        if path.get("archive"):
-            cmd = self.get_archive_cmd(path)
-        elif path.get("extract"):
-            cmd = self.get_extract_cmd(path)
+    def gen_require_closed(self, cmd: list, path):
         self.out.extend(
             [
                 f"if pgrep {sq(path['require_closed'])}; then",
-                f"\techo 'ERROR {path['require_closed']} must be closed in order to backup the configuration' >> {sq(self.logpath)}",
+                f"\techo 'ERROR {path['require_closed']} must be closed in order to backup the configuration' >> {self.log_target}",
                 "else",
                 *[f"\t{c}" for c in cmd],
                 "fi",
@@ -118,35 +573,106 @@ class LinuxScriptGenerator(AgnosticScriptGenerator):
 
     def gen_mkdirs(self):
         """Generate actions for creating mkdirs paths"""
-        make_nodes = [
-            d for d in self.config["settings"]["mkdirs"] if not os.path.exists(d)
-        ]
-        if make_nodes:
+        if make_nodes := self.get_ops(MKDIR):
             self.out.extend(
                 [
                     "# Create directories",
-                    *[f"mkdir -p {self.parse_path(f)}" for f in make_nodes],
+                    *[f"mkdir -p {self.parse_path(op.dst)}" for op in make_nodes],
                     "",
                 ]
             )
 
     def gen_monitor_actions(self):
-        if res := self.monitor.generate():
-            self.out.extend(["# Apply changes (renamed/deleted/moved)", *res, ""])
+        """Moves and removals of the plan. Files copied by rsync are renamed beforehand,
+        so its quick check finds them in place"""
+        if not (ops := self.get_ops(MOVE, REMOVE, RMTREE)):
+            return
+        res, removed, moved = list(), list(), list()
+        for op in ops:
+            if op.kind == MOVE:
+                name, cmd, args = "mv", "mv -f", f"{sq(op.src)} {sq(op.dst)}"
+                removed.append(op.src)
+                moved.append(op.dst)
+            else:
+                name, cmd, args = "rm", "rm -rf", sq(op.dst)
+                removed.append(op.dst)
+            if self.get_action_log_options() is not None:
+                cmd = self.logged(name, op.dst, f"{cmd} {args}")
+            else:
+                cmd = f"{cmd}v {args} | tee -a {sq(self.logpath)}"
+            res.append(self.step(cmd, op.action, op.src, None if op.kind == MOVE else op.dst))
+        self.out.extend(
+            [
+                "# Apply changes (renamed/deleted/moved)",
+                *res,
+                *self.gen_manifest_removals(removed),
+                *self.gen_manifest_updates(moved, "record"),
+                "",
+            ]
+        )
+
+    def get_transfers(self) -> list:
+        """Transfers made by rsync are estimated with the PythonMonitor"""
+        return [
+            t
+            for t in PythonMonitor(self.config, self.context).get_transfers()
+            if not any(is_within(t["dst"], d) for d in self.dropped)
+        ]
+
+    def get_removals(self) -> list:
+        self.monitor.generate(use_cache=True)
+        return [
+            {"src": None, "dst": p, "action": "remove", "batch_id": 0}
+            for p in self.monitor.diff
+        ]
+
+    def get_actions(self) -> list:
+        return self.get_removals() + self.get_transfers()
+
+    def get_plan_actions(self) -> list:
+        """rsync makes the transfers. They're estimated by a pass of the PythonMonitor
+        only if the plan needs them - for the 'meta' ops and the optimizer's moves
+        and conflicts. Otherwise the plan holds the mkdirs and the removals"""
+        if self.config["settings"].get("meta") or self.get_optimize_options() is not None:
+            return self.get_actions()
+        return self.get_removals()
+
+    def drop(self, actions: list):
+        """Removals are left out of the diff, transfers are excluded from the rsync"""
+        self.monitor.discard_digests(actions)
+        self.monitor.diff -= {a["dst"] for a in actions if a["action"] == "remove"}
+        self.monitor.gen_actions()
+        self.dropped |= {a["dst"] for a in actions if a["action"] != "remove"}
+
+    def get_stats(self, with_bytes=True) -> dict:
+        return {
+            "deletions": len(self.monitor.diff),
+            **self.count_transfers(self.monitor, self.get_transfers(), with_bytes),
+        }
 
     def get_archive_cmd(self, path) -> list:
         ext = path["dst"].split(".")[-1]
         comp = self.compression_options.get(ext, "")
+        if self.get_action_log_options() is not None:
+            # a record of the archive instead of its members
+            cmd = f"{self.govern}tar{self.fmt_excl(path)} -c{comp}f {self.parse_path(path['dst'])} -C {self.parse_path(path['src'])} ."
+            return [self.logged("archive", path["dst"], cmd)]
         return [
-            f"tar{self.fmt_excl(path)} -c{comp}vf {self.parse_path(path['dst'])} -C {self.parse_path(path['src'])} . &>> {sq(self.logpath)}"
+            f"{self.govern}tar{self.fmt_excl(path)} -c{comp}vf {self.parse_path(path['dst'])} -C {self.parse_path(path['src'])} . &>> {sq(self.logpath)}"
         ]
 
     def get_extract_cmd(self, path) -> list:
-        ext = path["src"].split(".")[-1]
-        comp = self.compression_options.get(ext, "")
+        """Members differing from the destination are extracted by the embedded python engine"""
         arch_path = os.path.join(path["dst"], os.path.basename(path["src"]))
+        if self.get_action_log_options() is not None:
+            return [
+                self.logged(
+                    "extract", path["dst"], f'python3 -c "$extract_py" {sq(path["src"])} {sq(path["dst"])}'
+                ),
+                self.logged("rm", arch_path, f"rm {self.parse_path(arch_path)}"),
+            ]
         return [
-            f'''tar -x{comp}vf {self.parse_path(path['src'])} -C {self.parse_path(path['dst'])} . &>> "{self.logpath}"''',
+            f'''python3 -c "$extract_py" {sq(path['src'])} {sq(path['dst'])} &>> "{self.logpath}"''',
             f"rm -v {self.parse_path(arch_path)} | tee -a {sq(self.logpath)}",
         ]
 
@@ -173,23 +699,64 @@ class PythonScriptGenerator(AgnosticScriptGenerator):
 
     def __init__(self, config):
         self.config = config
-        self.monitor = PythonMonitor(self.config)
+        self.context = PlanContext(self.config)
+        self.monitor = PythonMonitor(self.config, self.context)
+        self.plan = None
+        self.totals = None
 
     def generate(self) -> list:
         out = list()
+        self.actions_index = list()
+        self.plan = None
+        self.totals = None
         out.extend(self.gen_headers())
         out.extend(self.gen_mkdirs())
         # out.extend(self.gen_pre_cmds())
         out.extend(self.gen_rms())
         out.extend(self.gen_cps())
+        out.extend(self.gen_extracts())
+        out.extend(self.gen_cas())
         # out.extend(self.gen_archs())
         # out.extend(self.gen_post_cmds())
         return out
 
     def gen_headers(self) -> list:
+        import runtime
+
+        action_log = self.get_action_log_options() is not None
         return [
             "import logging, shutil, os",
             "",
+            *([] if action_log else self.gen_logging()),
+            "# Declare functions",
+            *inspect.getsource(runtime).splitlines(),
+            *(self.get_action_log_source() if action_log else []),
+            *(self.get_governor_source() if self.get_governor_options() else []),
+            *(self.get_progress_source() if self.get_progress_options() is not None else []),
+            "",
+            *self.gen_action_log(),
+            *self.gen_journal(),
+            *self.gen_manifest(),
+            *self.gen_io(),
+            *self.gen_governor(),
+            *self.gen_progress(),
+        ]
+
+    def gen_progress(self) -> list:
+        """Actions and bytes done are rendered against the totals of the plan,
+        the ETA is based on the throughput of the previous runs until the run has its own"""
+        if (opts := self.get_progress_options()) is None:
+            return []
+        opts = {k: opts[k] for k in ("rate", "interval", "every") if opts.get(k) is not None}
+        args = "".join(f", {k}={v!r}" for k, v in {**self.get_totals(), **opts}.items())
+        return [
+            "# Live progress",
+            f"set_progress({args[2:]})",
+            "",
+        ]
+
+    def gen_logging(self) -> list:
+        return [
             "# Setup logging",
             "try:",
             f"\tos.remove('{self.config['settings']['logfile']}')",
@@ -202,29 +769,98 @@ class PythonScriptGenerator(AgnosticScriptGenerator):
             "\tdatefmt='%H:%M:%S', ",
             "\tlevel='DEBUG'",
             ")",
-            'log = logging.getLogger("OpenBackup")',
             "",
-            "# Declare functions",
-            "def rm(dst):",
-            "\tos.remove(dst)",
-            "\tlog.info(f'Removed file {dst}')",
-            "def rmdir(dst):",
-            "\tshutil.rmtree(dst)",
-            "\tlog.info(f'Removed directory {dst}')",
-            "def cp(src, dst):",
-            "\tshutil.copy2(src, dst)",
-            "\tlog.info(f'Copied file to {dst}')",
-            "def cpdir(src, dst, ignore=None):",
-            "\tshutil.copytree(src, dst, ignore=ignore)",
-            "\tlog.info(f'Copied directory to {dst}')",
+        ]
+
+    def gen_action_log(self) -> list:
+        """Actions and messages are written to the logfile by an ActionLog
+        if the 'actionlog' setting is enabled"""
+        if (opts := self.get_action_log_options()) is None:
+            return []
+        args = "".join(f", {k}={v!r}" for k, v in opts.items())
+        return [
+            "# Action log",
+            f"open_action_log(os.path.realpath({self.config['settings']['logfile']!r}){args})",
+            "",
+        ]
+
+    def gen_cas(self) -> list:
+        if not (lines := self.gen_cas_lines()):
+            return []
+        return [
+            "# Content-addressed store",
+            *self.get_cas_source(),
+            "",
+            *lines,
+            "",
+        ]
+
+    def gen_extracts(self) -> list:
+        """Archives are extracted by the inlined engine, only the members that differ"""
+        out = list()
+        prec = self.config["settings"].get("sync_precision", 1)
+        for op in self.get_ops(EXTRACT):
+            aid = self.fmt_aid(self.checkpoint("extract", op.src, op.dst))
+            out.append(f"extract('{op.src}', '{op.dst}', precision={prec!r}{aid})")
+        if not out:
+            return []
+        return [
+            "# Extract archives",
+            *self.get_extract_source(),
+            "",
+            "extract = checkpointed(extract)",
+            *out,
+            "",
+        ]
+
+    def gen_journal(self) -> list:
+        """Actions with an 'aid' are skipped if they're already in the journal"""
+        if not (journal := self.config["settings"].get("journal")):
+            return []
+        return ["# Checkpoint journal", f"open_journal('{journal}')", ""]
+
+    def gen_io(self) -> list:
+        """Files are copied by a CopyIO if the 'io' setting is enabled"""
+        if not (opts := self.config["settings"].get("io")):
+            return []
+        opts = opts if isinstance(opts, dict) else dict()
+        return ["# Copy I/O", f"set_io({', '.join(f'{k}={v!r}' for k, v in opts.items())})", ""]
+
+    def gen_governor(self) -> list:
+        """Actions and copies are paced by a governor if the 'governor' setting is enabled"""
+        if not (opts := self.get_governor_options()):
+            return []
+        priority, opts = opts
+        return [
+            "# Low-impact mode",
+            f"lower_priority({priority['nice']!r}, {priority['ioclass']!r})",
+            f"set_governor({', '.join(f'{k}={v!r}' for k, v in opts.items())})",
             "",
         ]
 
+    def gen_manifest(self) -> list:
+        """Completed actions are recorded in the destination manifests"""
+        if not (roots := self.get_manifest_roots()):
+            return []
+        stale = self.get_stale_manifests()
+        return [
+            "# Destination manifest",
+            *self.get_manifest_source(),
+            "",
+            *[
+                f"open_manifest('{root}', rebuild=True)" if root in stale else f"open_manifest('{root}')"
+                for root in roots
+            ],
+            "",
+        ]
+
+    def fmt_aid(self, aid: str, sep=", ") -> str:
+        return "" if aid is None else f"{sep}aid={aid}"
+
     def gen_mkdirs(self) -> list:
         mkdirs = [
-            f"os.mkdir('{p}')\nlog.info(f'Created directory {p}')"
-            for p in self.config["settings"]["mkdirs"]
-            if not os.path.exists(p)
+            f"os.mkdir('{op.dst}')\nlog.info(f'Created directory {op.dst}')"
+            for op in self.get_ops(MKDIR)
         ]
         return ["# Create directories", *mkdirs, ""] if mkdirs else []
 
@@ -244,40 +880,97 @@ class PythonScriptGenerator(AgnosticScriptGenerator):
 
     def gen_rms(self) -> list:
         out = list()
-        res = self.monitor.generate(use_cache=True)
-        mxdstlen = max(len(path["dst"]) for path in res)
-        for path in res:
-            if path["action"] not in {"remove"}:
+        mxdstlen = max((len(op.dst) for op in self.get_plan()), default=0)
+        for op in self.get_ops(MOVE, REMOVE, RMTREE):
+            if op.kind == MOVE:
+                aid = self.fmt_aid(self.checkpoint("move", op.src, op.dst))
+                out.append(f"mv('{op.src}', '{op.dst}'{aid})")
                 continue
-            elif os.path.isfile(path["dst"]):
-                out.append(f"rm('{path['dst']}'{' '*(mxdstlen-len(path['dst']))})")
+            aid = self.fmt_aid(self.checkpoint("remove", dst=op.dst))
+            if op.kind == REMOVE:
+                out.append(f"rm('{op.dst}'{' '*(mxdstlen-len(op.dst))}{aid})")
             else:
-                out.append(f"rmdir('{path['dst']}'{' '*(mxdstlen-len(path['dst'])-3)})")
-        return ["# Apply changes (renamed/deleted/moved)", *sorted(out), ""]
+                out.append(f"rmdir('{op.dst}'{' '*(mxdstlen-len(op.dst)-3)}{aid})")
+        return ["# Apply changes (renamed/deleted/moved)", *out, ""]
 
     def gen_cps(self) -> list:
         out = list()
-        res = self.monitor.generate(use_cache=True)
-        batch_map_exclude = {
-            p["batch_id"]: p.get("exclude") for p in self.config["paths"]
-        }
-        for path in res:
-            if path["action"] not in {"copy", "update"}:
+        # fanned-out paths are copied to all destinations at once
+        for op in self.get_ops(META, *TRANSFERS):
+            if op.kind == META:
+                # only the metadata changed, applied in place
+                dsts = ", ".join(f"'{d}'" for d in op.dsts)
+                aid = self.fmt_aid(self.checkpoint("meta", op.src, op.dsts))
+                out.append(f"meta('{op.src}', {dsts}{aid})")
                 continue
-            elif os.path.isfile(path["src"]):
+            dsts = f",{self.newline}\t".join(f"'{d}'" for d in op.dsts)
+            aid = self.fmt_aid(
+                self.checkpoint(op.action, op.src, op.dsts),
+                sep=f",{self.newline}\t",
+            )
+            prefix = "sched." if self.config["settings"].get("scheduler") else ""
+            if op.kind != COPYTREE:
+                prefix = "pack." if self.config["settings"].get("pack") else prefix
                 out.append(
-                    f"cp({self.newline}\t'{path['src']}',{self.newline}\t'{path['dst']}'{self.newline})"
+                    f"{prefix}cp({self.newline}\t'{op.src}',{self.newline}\t{dsts}{aid}{self.newline})"
                 )
             else:
-                p1 = f"cpdir({self.newline}\t'{path['src']}',{self.newline}\t'{path['dst']}'"
-                excl = batch_map_exclude[path["batch_id"]]
+                p1 = f"{prefix}cpdir({self.newline}\t'{op.src}',{self.newline}\t{dsts}{aid}"
+                excl = self.config["paths"][op.batch_id].get("exclude")
                 p2 = (
                     f""",{self.newline}\tignore=shutil.ignore_patterns('{"', '".join(excl)}',){self.newline})"""
                     if excl
                     else "\n)"
                 )
                 out.append(p1 + p2)
-        return ["# Sync files", *sorted(out), ""]
+        head, tail = list(), list()
+        if sched := self.get_scheduler():
+            head.append(sched)
+            tail.append("sched.run()")
+        if pack := self.get_packer():
+            head.append(pack)
+            tail.insert(0, "pack.close()")
+        return ["# Sync files", *head, *out, *tail, ""]
+
+    def get_scheduler(self) -> str:
+        """Instantiation of the copies Scheduler if the 'scheduler' setting is enabled"""
+        if not (opts := self.config["settings"].get("scheduler")):
+            return ""
+        opts = opts if isinstance(opts, dict) else dict()
+        return f"sched = Scheduler({', '.join(f'{k}={v!r}' for k, v in opts.items())})"
+
+    def get_packer(self) -> str:
+        """Instantiation of the small files Packer if the 'pack' setting is enabled.
+        Files it doesn't pack are queued in the Scheduler, if any"""
+        if not (opts := self.config["settings"].get("pack")):
+            return ""
+        opts = opts if isinstance(opts, dict) else dict()
+        args = [f"{k}={v!r}" for k, v in opts.items()]
+        if self.config["settings"].get("scheduler"):
+            args.append("fallback=sched.cp")
+        return f"pack = Packer({', '.join(args)})"
+
+    def get_transfers(self) -> list:
+        return [
+            p
+            for p in self.monitor.generate(use_cache=True)
+            if p["action"] in {"copy", "update"}
+        ]
+
+    def get_actions(self) -> list:
+        return self.monitor.generate(use_cache=True)
+
+    def drop(self, actions: list):
+        self.monitor.discard_digests(actions)
+        dropped = {id(a) for a in actions}
+        self.monitor.results = [a for a in self.get_actions() if id(a) not in dropped]
+
+    def get_stats(self, with_bytes=True) -> dict:
+        res = self.monitor.generate(use_cache=True)
+        return {
+            "deletions": sum(p["action"] == "remove" for p in res),
+            **self.count_transfers(self.monitor, res, with_bytes),
+        }
 
     def gen_archs(self) -> list:
         return ["# Gen/Ext Archives", "# ...", ""]
@@ -0,0 +1,163 @@
+"""Memory-bounded collections for trees larger than RAM. Items are kept in memory
+up to a budget, then spilled to temporary files: paths as sorted runs merged on
+iteration (external merge sort), actions as an append-only log"""
+
+import os
+import json
+import heapq
+import weakref
+import tempfile
+
+ITEM_OVERHEAD = 80  # of a str in a list, roughly
+MAX_RUNS = 64
+ACTION_OVERHEAD = 400  # of a small dict
+
+
+def parse_budget(value) -> int:
+    """Bytes of the 'memory' setting: a number of MiB or {"budget": MiB}"""
+    if isinstance(value, dict):
+        value = value.get("budget")
+    if not value or value is True:
+        return 0
+    return int(float(value) * (1 << 20))
+
+
+def iter_run(path: str, bufsize: int = 1 << 20):
+    """Items of a run, separated by NUL - the only byte a path can't contain"""
+    with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+        tail = ""
+        while buf := f.read(bufsize):
+            *items, tail = (tail + buf).split("\0")
+            yield from items
+
+
+def remove_runs(runs: list):
+    for path in runs:
+        os.remove(path)
+    runs.clear()
+
+
+class ExternalSorter:
+    """Collects paths and iterates them sorted and unique. Once the buffer exceeds
+    the budget, it's sorted and written as a run. Iteration merges the runs lazily"""
+
+    def __init__(self, budget: int, tmpdir: str = None):
+        self.budget = budget
+        self.tmpdir = tmpdir
+        self.buffer = list()
+        self.used = 0
+        self.runs = list()
+        self.count = 0
+        # leftover runs are removed once the sorter is collected
+        self.finalizer = weakref.finalize(self, remove_runs, self.runs)
+
+    def add(self, item: str):
+        self.buffer.append(item)
+        self.used += len(item) + ITEM_OVERHEAD
+        self.count += 1
+        if self.used > self.budget:
+            self.spill()
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+
+    def spill(self):
+        self.buffer.sort()
+        self.runs.append(self.write_run(self.buffer))
+        self.buffer, self.used = list(), 0
+        if len(self.runs) >= MAX_RUNS:
+            # merge pass, bounds the open files and the read buffers
+            runs = list(self.runs)
+            merged = self.write_run(self.merge(runs, []))
+            remove_runs(self.runs)
+            self.runs.append(merged)
+
+    def write_run(self, items) -> str:
+        fd, path = tempfile.mkstemp(prefix="ob-run-", dir=self.tmpdir)
+        with open(fd, "w", encoding="utf-8", errors="surrogateescape") as f:
+            f.writelines(f"{item}\0" for item in items)
+        return path
+
+    def merge(self, runs: list, buffer: list):
+        """Unique items of the runs and the sorted buffer.
+        Each run is read with an equal share of the budget"""
+        bufsize = max(1 << 12, self.budget // (2 * max(1, len(runs))))
+        last = None
+        for item in heapq.merge(*(iter_run(r, bufsize) for r in runs), buffer):
+            if item != last:
+                yield item
+            last = item
+
+    def __iter__(self):
+        self.buffer.sort()
+        return self.merge(self.runs, self.buffer)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        remove_runs(self.runs)
+        self.buffer, self.used = list(), 0
+
+
+def difference(a, b):
+    """Items of the sorted iterable a, missing from the sorted iterable b"""
+    b = iter(b)
+    current = next(b, None)
+    for item in a:
+        while current is not None and current < item:
+            current = next(b, None)
+        if current != item:
+            yield item
+
+
+class SpillList:
+    """List of actions, written to a JSON-lines log once over the budget.
+    Iteration yields the spilled actions first, in the order of appending"""
+
+    def __init__(self, budget: int, tmpdir: str = None):
+        self.budget = budget
+        self.tmpdir = tmpdir
+        self.items = list()
+        self.used = 0
+        self.path = None
+        self.spilled = 0
+
+    def append(self, item: dict):
+        self.items.append(item)
+        self.used += ACTION_OVERHEAD + sum(len(v) for v in item.values() if isinstance(v, str))
+        if self.used > self.budget:
+            self.spill()
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def spill(self):
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp(prefix="ob-actions-", dir=self.tmpdir)
+            os.close(fd)
+            self.finalizer = weakref.finalize(self, os.remove, self.path)
+        with open(self.path, "a", encoding="utf-8", errors="surrogateescape") as f:
+            f.writelines(json.dumps(i) + "\n" for i in self.items)
+        self.spilled += len(self.items)
+        self.items, self.used = list(), 0
+
+    def __iter__(self):
+        if self.path:
+            with open(self.path, "r", encoding="utf-8", errors="surrogateescape") as f:
+                for line in f:
+                    yield json.loads(line)
+        yield from self.items
+
+    def __len__(self):
+        return self.spilled + len(self.items)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def close(self):
+        if self.path:
+            self.finalizer()
+        self.path, self.items, self.used, self.spilled = None, list(), 0, 0
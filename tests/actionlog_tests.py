@@ -0,0 +1,158 @@
+import io
+import os
+import json
+import shutil
+import platform
+from copy import deepcopy
+from subprocess import run
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipIf
+
+import runtime
+from actionlog import ActionLog, parse_line, read_summary, serve
+from base import AgnosticBase
+from script_gen import LinuxScriptGenerator, PythonScriptGenerator
+from . import config
+
+
+def read_records(path: str) -> list:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class ActionLogTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "log.jsonl")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_write(self):
+        """Verify that the records are written in batches, followed by the summary"""
+        log = ActionLog(self.path, interval=60, batch=3)
+        log.write("cp", "/d/a", bytes=10)
+        log.write("cp", "/d/b", OSError("denied"))
+        self.assertEqual(os.path.getsize(self.path), 0)
+        log.message("done")
+        log.close()
+        *records, summary = read_records(self.path)
+        self.assertEqual([r.get("path") for r in records], ["/d/a", "/d/b", None])
+        self.assertEqual(records[1]["error"], "denied")
+        summary = summary["summary"]
+        self.assertEqual(summary["actions"], {"cp": 2})
+        self.assertEqual(summary["errors"], {"cp": 1})
+        self.assertEqual((summary["bytes"], summary["messages"]), (10, 1))
+        self.assertEqual(read_summary(self.path), summary)
+
+    def test_read_summary(self):
+        """Verify that the summary of an interrupted run is computed from the records"""
+        log = ActionLog(self.path, interval=60)
+        log.write("rm", "/d/a")
+        log.flush()
+        self.assertEqual(read_summary(self.path)["actions"], {"rm": 1})
+        log.close()
+
+    def test_append(self):
+        """Verify that the runs are appended and the summary is of the last one"""
+        with ActionLog(self.path) as log:
+            log.write("cp", "/d/a")
+        with ActionLog(self.path) as log:
+            log.write("rm", "/d/a")
+        self.assertEqual(len(read_records(self.path)), 4)
+        self.assertEqual(read_summary(self.path)["actions"], {"rm": 1})
+        start = os.path.getsize(self.path)
+        log = ActionLog(self.path, interval=60)
+        log.write("mv", "/d/b")
+        log.flush()
+        self.assertEqual(read_summary(self.path, start)["actions"], {"mv": 1})
+        log.close()
+
+    def test_parse_line(self):
+        self.assertEqual(
+            parse_line("sync\tdir/f\top=send\tbytes=12"),
+            ("sync", "dir/f", {"op": "send", "bytes": 12}),
+        )
+        self.assertIsNone(parse_line("sent 100 bytes"))
+
+    def test_serve(self):
+        stream = io.StringIO("sync\ta\tbytes=3\nsending incremental file list\n\nrm\tb\terror=1\n")
+        serve(self.path, stream)
+        records = read_records(self.path)
+        self.assertEqual([r.get("action") for r in records], ["sync", None, "rm", None])
+        self.assertEqual(records[-1]["summary"]["errors"], {"rm": 1})
+
+    def test_runtime(self):
+        """Verify that the runtime reports the actions to the action log"""
+        src, dst = os.path.join(self.tmpdir.name, "src"), os.path.join(self.tmpdir.name, "dst")
+        with open(src, "w") as f:
+            f.write("data")
+        runtime.action_log = ActionLog(self.path)
+        try:
+            runtime.cp(src, dst)
+            runtime.rm(dst)
+        finally:
+            runtime.action_log.close()
+            runtime.action_log = None
+        records = read_records(self.path)
+        self.assertEqual([(r["action"], r["path"]) for r in records[:2]], [("cp", dst), ("rm", dst)])
+        self.assertEqual(records[0]["bytes"], 4)
+
+
+class ActionLogScriptTests(TestCase, AgnosticBase):
+
+    def get_config(self, actionlog) -> dict:
+        cfg = self.parse_config(deepcopy(config))
+        cfg["settings"]["actionlog"] = actionlog
+        return cfg
+
+    def test_gen_python(self):
+        cfg = self.get_config({"interval": 0.5})
+        res = PythonScriptGenerator(cfg).gen_headers()
+        self.assertIn("class ActionLog:", res)
+        self.assertNotIn("logging.basicConfig(", res)
+        path = cfg["settings"]["logfile"]
+        self.assertIn(f"open_action_log(os.path.realpath({path!r}), interval=0.5)", res)
+
+    def test_gen_linux(self):
+        """Verify that the commands report to the action log instead of the logfile"""
+        cfg = self.get_config(True)
+        # the pre commands are up to the user
+        cfg["settings"]["cmd"] = dict()
+        generator = LinuxScriptGenerator(cfg)
+        script = "\n".join(generator.generate())
+        self.assertIn("alog() {", script)
+        self.assertIn("aerr sync ", script)
+        self.assertNotIn("tee -a", script)
+        self.assertNotIn("--log-file", script)
+        self.assertTrue(script.rstrip().endswith('wait "$actionlog_pid"'))
+        res = generator.get_archive_cmd({"src": "/x/y", "dst": "/z/a.tar", "exclude": []})
+        self.assertTrue(res[0].startswith("alog archive '/z/a.tar' tar"))
+
+    @skipIf(platform.system() != "Linux" or not shutil.which("bash"), "Unsupported OS!")
+    def test_run_linux(self):
+        """Verify that the bash script feeds the writer and waits for the summary"""
+        with TemporaryDirectory() as tmp:
+            cfg = self.get_config(True)
+            cfg["settings"]["logfile"] = os.path.join(tmp, "log.jsonl")
+            cfg["settings"]["cmd"] = dict()
+            generator = LinuxScriptGenerator(cfg)
+            generator.out = list()
+            generator.gen_logging()
+            script = [
+                *generator.out,
+                generator.logged("rm", f"{tmp}/a", f"rm {tmp}/a"),
+                generator.logged("mkdir", f"{tmp}/b", f"mkdir {tmp}/b"),
+                # as rsync is run, its output is redirected by the caller
+                f"aerr sync {tmp}/c ls {tmp}/c >> /dev/fd/$actionlog",
+            ]
+            generator.out = list()
+            generator.gen_log_exit()
+            script.extend(generator.out)
+            run(["bash", "-c", "\n".join(script)], check=True)
+            *records, summary = read_records(cfg["settings"]["logfile"])
+        self.assertEqual(summary["summary"]["actions"], {"rm": 1, "mkdir": 1, "sync": 1})
+        self.assertEqual(summary["summary"]["errors"], {"rm": 1, "sync": 1})
+        self.assertTrue(any("No such file" in r.get("message", "") for r in records))
+        self.assertEqual(records[0]["level"], "INFO")
@@ -0,0 +1,167 @@
+import os
+import sys
+from copy import deepcopy
+from subprocess import run
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from actions import COPY, COPYTREE, META, MOVE, REMOVE, RMTREE, Op, Optimizer
+from base import AgnosticBase
+from scan import outermost
+from script_gen import LinuxScriptGenerator, PythonScriptGenerator
+from . import config
+
+
+def write(path: str, data: str, mtime: int = 1000):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+    os.utime(path, (mtime, mtime))
+
+
+class OutermostTests(TestCase):
+
+    def test_outermost(self):
+        """Verify that only the items within a tree are dropped, e.g. not its siblings"""
+        items = ["/d/a/x", "/d/a", "/d/a-b", "/d/a/y/z", "/d/b"]
+        self.assertEqual(
+            outermost(items, str, lambda p: p in {"/d/a", "/d/b"}), ["/d/a", "/d/a-b", "/d/b"]
+        )
+
+
+class OptimizerTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        self.dst = os.path.join(self.tmpdir.name, "dst")
+        self.root = os.path.join(self.dst, "src")
+        self.cfg = deepcopy(config)
+        self.cfg["settings"]["mkdirs"] = []
+        self.cfg["settings"]["logfile"] = os.path.join(self.tmpdir.name, "log.txt")
+        self.cfg["settings"]["optimize"] = {"min_files": 3}
+        self.cfg["paths"] = [{"src": self.src, "dst": self.dst}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get_plan(self, generator=PythonScriptGenerator) -> list:
+        self.generator = generator(self.parse_config(deepcopy(self.cfg)))
+        return [
+            (
+                op.kind,
+                op.src and os.path.relpath(op.src, self.tmpdir.name),
+                os.path.relpath(op.dst, self.root),
+            )
+            for op in self.generator.get_plan()
+        ]
+
+    def execute(self):
+        script = os.path.join(self.tmpdir.name, "job.py")
+        with open(script, "w") as f:
+            f.write("\n".join(self.generator.generate()))
+        run([sys.executable, script], check=True, cwd=self.tmpdir.name)
+
+    def test_moves(self):
+        """Verify that a renamed file is moved on the destination instead of re-copied"""
+        write(os.path.join(self.src, "d/renamed"), "data")
+        write(os.path.join(self.root, "d/original"), "data")
+        write(os.path.join(self.src, "new"), "data", mtime=2000)
+        self.assertEqual(
+            self.get_plan(),
+            [(MOVE, "dst/src/d/original", "d/renamed"), (COPY, "src/new", "new")],
+        )
+        self.execute()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, "d"))), ["renamed"])
+        self.cfg["settings"]["optimize"] = False
+        write(os.path.join(self.src, "d/again"), "data")
+        self.assertNotIn(MOVE, [k for k, _, _ in self.get_plan()])
+
+    def test_moves_content(self):
+        """Verify that files of the same size and mtime aren't moved if their content differs"""
+        write(os.path.join(self.src, "d/renamed"), "data")
+        write(os.path.join(self.root, "d/original"), "diff")
+        self.assertEqual(
+            self.get_plan(), [(REMOVE, None, "d/original"), (COPY, "src/d/renamed", "d/renamed")]
+        )
+
+    def test_merge_copies(self):
+        """Verify that a dir whose files are all copied is copied at once, replacing the stale one"""
+        for name in ("a", "b", "c"):
+            write(os.path.join(self.src, "d", name), name)
+        write(os.path.join(self.root, "d/stale"), "stale", mtime=0)
+        write(os.path.join(self.src, "e/a"), "a")
+        os.makedirs(os.path.join(self.root, "e"))
+        self.assertEqual(self.get_plan(), [(COPYTREE, "src/d", "d"), (COPY, "src/e/a", "e/a")])
+        self.execute()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, "d"))), ["a", "b", "c"])
+
+    def test_resolve_conflicts(self):
+        """Verify that a file replacing a dir is copied once the dir is removed"""
+        write(os.path.join(self.src, "x"), "file", mtime=2000)
+        write(os.path.join(self.root, "x/child"), "child")
+        os.utime(os.path.join(self.root, "x"), (0, 0))
+        self.assertEqual(self.get_plan(), [(RMTREE, None, "x"), (COPY, "src/x", "x")])
+        self.execute()
+        with open(os.path.join(self.root, "x")) as f:
+            self.assertEqual(f.read(), "file")
+
+    def test_linux(self):
+        """Verify that the bash script renders the moves and removals of the same plan"""
+        write(os.path.join(self.src, "renamed"), "data")
+        write(os.path.join(self.root, "original"), "data")
+        write(os.path.join(self.root, "gone"), "gone!")
+        self.cfg["settings"]["cmd"] = dict()
+        self.get_plan(LinuxScriptGenerator)
+        script = self.generator.generate()
+        original, renamed = os.path.join(self.root, "original"), os.path.join(self.root, "renamed")
+        log = self.cfg["settings"]["logfile"]
+        self.assertIn(f"mv -fv '{original}' '{renamed}' | tee -a '{log}'", script)
+        self.assertIn(f"rm -rfv '{os.path.join(self.root, 'gone')}' | tee -a '{log}'", script)
+
+    def test_linux_transfers(self):
+        """Verify that the transfers of rsync are estimated only if the plan needs them"""
+        write(os.path.join(self.src, "new"), "data")
+        write(os.path.join(self.root, "gone"), "gone!")
+        self.cfg["settings"]["optimize"] = False
+        generator = LinuxScriptGenerator(self.parse_config(deepcopy(self.cfg)))
+        with patch.object(generator, "get_transfers", side_effect=AssertionError):
+            self.assertEqual([op.kind for op in generator.get_plan()], [REMOVE])
+        self.cfg["settings"]["optimize"] = True
+        self.assertEqual(
+            self.get_plan(LinuxScriptGenerator), [(REMOVE, None, "gone"), (COPY, "src/new", "new")]
+        )
+
+    def test_fanout(self):
+        """Verify that the transfers and metadata of a source are grouped for all destinations"""
+        generator = PythonScriptGenerator(self.parse_config(deepcopy(self.cfg)))
+        ops = [
+            Op(COPY, "/s/a", ["/d1/a"]),
+            Op(META, "/s/b", ["/d1/b"]),
+            Op(COPY, "/s/a", ["/d2/a"]),
+            Op(META, "/s/b", ["/d2/b"]),
+        ]
+        self.assertEqual(
+            [(op.kind, op.dsts) for op in Optimizer(generator.monitor).fanout(ops)],
+            [(COPY, ["/d1/a", "/d2/a"]), (META, ["/d1/b", "/d2/b"])],
+        )
+
+    def test_fanout_excludes(self):
+        """Verify that a dir copied by paths with other excludes is copied once per path"""
+        self.cfg["paths"] = [
+            {"src": self.src, "dst": self.dst, "exclude": ["*skip*"]},
+            {"src": self.src, "dst": os.path.join(self.tmpdir.name, "all")},
+        ]
+        write(os.path.join(self.src, "d/a"), "a")
+        write(os.path.join(self.src, "d/b.skip"), "b")
+        self.get_plan()
+        self.assertEqual(
+            [(op.kind, len(op.dsts)) for op in self.generator.get_plan()],
+            [(COPYTREE, 1), (COPYTREE, 1)],
+        )
+        self.execute()
+        self.assertEqual(os.listdir(os.path.join(self.root, "d")), ["a"])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.tmpdir.name, "all/src/d"))), ["a", "b.skip"]
+        )
@@ -0,0 +1,107 @@
+import os
+from copy import deepcopy
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from base import AgnosticBase
+from cas import CasStore
+from monitors import PythonMonitor
+from script_gen import LinuxScriptGenerator
+from . import config
+
+
+class CasStoreTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        os.makedirs(os.path.join(self.src, "sub"))
+        for name, data in {"a": b"same", "sub/b": b"same", "c": b"other"}.items():
+            with open(os.path.join(self.src, name), "wb") as f:
+                f.write(data)
+        self.store = CasStore(os.path.join(self.tmpdir.name, "dst", ".cas"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def count_objects(self) -> int:
+        return sum(len(f) for _, _, f in os.walk(self.store.objects))
+
+    def put_all(self):
+        for name in ("a", "sub/b", "c"):
+            self.store.put(os.path.join(self.src, name), f"src/{name}")
+        return self.store.commit()
+
+    def test_put(self):
+        """Verify that identical contents are stored once"""
+        self.put_all()
+        self.assertEqual(self.count_objects(), 2)
+        self.assertEqual(
+            self.store.manifest["src/a"]["hash"], self.store.manifest["src/sub/b"]["hash"]
+        )
+        self.assertEqual(CasStore(self.store.root).manifest, self.store.manifest)
+
+    def test_materialize(self):
+        """Verify that files are restored with their content and mtime"""
+        os.utime(os.path.join(self.src, "c"), (1, 1))
+        self.put_all()
+        target = os.path.join(self.tmpdir.name, "restored")
+        self.assertEqual(self.store.materialize(target), 3)
+        with open(os.path.join(target, "src/sub/b"), "rb") as f:
+            self.assertEqual(f.read(), b"same")
+        self.assertEqual(os.stat(os.path.join(target, "src/c")).st_mtime, 1)
+        self.assertEqual(self.store.materialize(target), 0)
+        self.assertEqual(self.store.materialize(target + "2", subpath="src/sub"), 1)
+
+    def test_gc(self):
+        """Verify that objects referenced only by removed manifests are deleted"""
+        self.put_all()
+        self.store.drop("src/c")
+        self.store.commit()
+        self.assertEqual(self.store.gc(keep=1), (1, 1, 5))
+        self.assertEqual(self.count_objects(), 1)
+        self.assertEqual(len(self.store.list_manifests()), 1)
+
+
+class CasMonitorTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        os.makedirs(os.path.join(self.src, "sub"))
+        for name in ("a", "sub/b"):
+            open(os.path.join(self.src, name), "w").close()
+        cfg = deepcopy(config)
+        cfg["paths"] = [{"src": self.src, "dst": self.tmpdir.name, "layout": "cas"}]
+        self.monitor = PythonMonitor(self.parse_config(cfg))
+        self.monitor._files_scanned = 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get_cas_changes(self):
+        """Verify that only new/modified files are stored and removed ones dropped"""
+        path = self.monitor.config["paths"][0]
+        st = os.stat(os.path.join(self.src, "a"))
+        manifest = {
+            "src/a": {"size": st.st_size, "mtime": st.st_mtime},
+            "src/gone": {"size": 0, "mtime": 0},
+            "other/x": {"size": 0, "mtime": 0},
+        }
+        puts, drops = self.monitor.get_cas_changes(path, manifest)
+        self.assertEqual(puts, [(os.path.join(self.src, "sub/b"), "src/sub/b")])
+        self.assertEqual(drops, ["src/gone"])
+        self.assertFalse(self.monitor.is_mirrored(path))
+
+    def test_archive(self):
+        """Verify that an archive path is still archived with the 'cas' layout as default"""
+        cfg = deepcopy(config)
+        cfg["settings"].update({"layout": "cas", "mkdirs": [], "cmd": dict()})
+        archive = os.path.join(self.tmpdir.name, "src.tar")
+        cfg["paths"] = [
+            {"src": self.src, "dst": self.tmpdir.name},
+            {"src": self.src, "dst": archive, "archive": True},
+        ]
+        script = "\n".join(LinuxScriptGenerator(self.parse_config(cfg)).generate())
+        self.assertIn(f"-cvf {archive} -C {self.src} .", script)
+        self.assertIn("store.put(", script)
@@ -0,0 +1,64 @@
+import os
+import re
+from copy import deepcopy
+from unittest import TestCase
+
+from base import AgnosticBase
+from context import PlanContext, expand_braces, expand_paths
+from script_gen import LinuxScriptGenerator, PythonScriptGenerator
+from scan import build_tree
+from . import SWD, config
+
+
+class ExpandTests(TestCase):
+
+    def test_expand_braces(self):
+        """Verify many and nested groups"""
+        self.assertEqual(expand_braces("a/b"), ["a/b"])
+        self.assertEqual(expand_braces("a/{b,c}"), ["a/b", "a/c"])
+        self.assertEqual(
+            expand_braces("{a,b}/{1,2}"), ["a/1", "a/2", "b/1", "b/2"]
+        )
+        self.assertEqual(
+            expand_braces("x/{a,b{c,d}}/y"), ["x/a/y", "x/bc/y", "x/bd/y"]
+        )
+        self.assertEqual(expand_braces("x/{a,b"), ["x/{a,b"])
+
+    def test_expand_paths(self):
+        """Verify that expanded paths follow the plain ones"""
+        paths = [{"src": "{a,b}", "batch_id": 0}, {"src": "c", "batch_id": 1}]
+        self.assertEqual(
+            expand_paths(paths),
+            [
+                {"src": "c", "batch_id": 1},
+                {"src": "a", "batch_id": 0},
+                {"src": "b", "batch_id": 0},
+            ],
+        )
+
+
+class PlanContextTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.config = self.parse_config(deepcopy(config))
+        self.context = PlanContext(self.config)
+
+    def test_get_matcher(self):
+        """Verify that excludes are compiled once"""
+        m = self.context.get_matcher(["*a*"], lambda e: re.compile(e[0][1:-1]))
+        self.assertIs(self.context.get_matcher(["*a*"], None), m)
+
+    def test_kinds(self):
+        """Verify that the scan records the kinds of the entries"""
+        root = os.path.join(SWD, "data/src/dir1/dir2")
+        build_tree(root, re.compile(r".^"), dict(), self.context.kinds)
+        self.assertTrue(self.context.isdir(f"{root}/venv"))
+        self.assertTrue(self.context.isfile(f"{root}/c.csv"))
+        self.assertTrue(self.context.isdir(root))
+
+    def test_shared(self):
+        """Verify that the generators share the context with their monitors"""
+        for gen in (LinuxScriptGenerator, PythonScriptGenerator):
+            g = gen(deepcopy(self.config))
+            self.assertIs(g.monitor.context, g.context)
+            self.assertIs(g.monitor.get_expanded_paths(g.config["paths"]), g.context.paths)
@@ -0,0 +1,151 @@
+import os
+import re
+import shutil
+from copy import deepcopy
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from base import AgnosticBase
+from digest import DigestStore, get_digests
+from monitors import LinuxMonitor, PythonMonitor
+from scan import build_tree
+from . import config
+
+
+class DigestTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, "src")
+        for d in ("a/b", "a/c", "d"):
+            os.makedirs(os.path.join(self.root, d))
+            for i in range(3):
+                with open(os.path.join(self.root, d, f"f{i}"), "w") as f:
+                    f.write(d * i)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get_digests(self) -> dict:
+        tree = build_tree(self.root, re.compile(r".^"), dict())
+        return get_digests(self.root, tree, os.path.isdir, os.stat)
+
+    def test_get_digests(self):
+        """Verify that a change is propagated only to the ancestors"""
+        exp = self.get_digests()
+        self.assertEqual(len(exp), 5)
+        self.assertEqual(self.get_digests(), exp)
+        os.utime(os.path.join(self.root, "a/b/f1"), (1000, 1000))
+        res = self.get_digests()
+        changed = {d[len(self.root) :] for d in exp if res[d] != exp[d]}
+        self.assertEqual(changed, {"", "/a", "/a/b"})
+
+    def test_store(self):
+        store = DigestStore(self.tmpdir.name)
+        store.save("src", "x", {"": ("1", 10), "/a": ("2", 20)})
+        self.assertEqual(store.load("src", "x"), {"": ("1", 10), "/a": ("2", 20)})
+        self.assertEqual(store.load("src", "y"), {})
+        self.assertEqual(store.load("src", "x", max_age=1e-9), {})
+        store.save("src", "x", {"": ("3", 30)})
+        self.assertEqual(store.load("src", "x"), {"": ("3", 30)})
+        store.close()
+
+
+class DigestMonitorTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        self.dst = os.path.join(self.tmpdir.name, "dst")
+        for i in range(20):
+            path = os.path.join(self.src, f"d{i % 4}", f"s{i % 2}", f"f{i}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write("x" * i)
+        self.cfg = deepcopy(config)
+        self.cfg["settings"]["mkdirs"] = []
+        self.cfg["settings"]["digests"] = True
+        self.cfg["paths"] = [{"src": self.src, "dst": self.dst}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get_monitor(self, cls=PythonMonitor):
+        return cls(self.parse_config(deepcopy(self.cfg)))
+
+    def mirror(self, monitor):
+        """Stand-in for a successful run"""
+        shutil.rmtree(os.path.join(self.dst, "src"), ignore_errors=True)
+        shutil.copytree(self.src, os.path.join(self.dst, "src"))
+        monitor.save_digests()
+
+    def generate(self, monitor) -> tuple:
+        """Returns the actions and the destination paths compared"""
+        compared = list()
+        get_dst_mtime = monitor.get_dst_mtime
+
+        def counted(path, dst):
+            compared.append(path)
+            return get_dst_mtime(path, dst)
+
+        with patch.object(monitor, "get_dst_mtime", counted):
+            res = monitor.generate()
+        return sorted((a["action"], a["dst"][len(self.dst) :]) for a in res), compared
+
+    def test_generate(self):
+        """Verify that only the differing subtrees are compared"""
+        monitor = self.get_monitor()
+        res, compared = self.generate(monitor)
+        self.assertEqual(len(res), 4)
+        # the store is created only once the run succeeded
+        self.assertFalse(os.path.exists(os.path.join(self.dst, DigestStore.NAME)))
+        self.mirror(monitor)
+        res, compared = self.generate(self.get_monitor())
+        self.assertEqual((res, compared), ([], []))
+        os.utime(os.path.join(self.src, "d1/s1/f5"), (4e9, 4e9))
+        os.remove(os.path.join(self.src, "d2/s0/f2"))
+        res, compared = self.generate(self.get_monitor())
+        self.assertEqual(res, [("remove", "/src/d2/s0/f2"), ("update", "/src/d1/s1/f5")])
+        # the entries of the changed dirs and of their ancestors
+        self.assertEqual(len(compared), 4 + (1 + 5) + (1 + 4))
+
+    def test_lost_at_destination(self):
+        """Verify that the entries lost at the destination since the last run are restored"""
+        monitor = self.get_monitor()
+        monitor.generate()
+        self.mirror(monitor)
+        os.remove(os.path.join(self.dst, "src/d1/s1/f5"))
+        shutil.rmtree(os.path.join(self.dst, "src/d2"))
+        res, compared = self.generate(self.get_monitor())
+        self.assertEqual(
+            [r for r in res if r[1].startswith("/src/d1")], [("copy", "/src/d1/s1/f5")]
+        )
+        self.assertIn(("copy", "/src/d2"), res)
+        # the untouched subtrees are still skipped
+        self.assertFalse(any(p.startswith(os.path.join(self.dst, "src/d0/")) for p in compared))
+
+    def test_collect_diff(self):
+        """Verify that the removals match a full walk of the destination"""
+        monitor = self.get_monitor(LinuxMonitor)
+        monitor.generate()
+        self.mirror(monitor)
+        os.remove(os.path.join(self.src, "d3/s1/f7"))
+        self.cfg["settings"]["digests"] = False
+        exp = self.get_monitor(LinuxMonitor)
+        exp.generate()
+        self.cfg["settings"]["digests"] = True
+        res = self.get_monitor(LinuxMonitor)
+        res.generate()
+        self.assertEqual(res.diff, exp.diff)
+        self.assertEqual(len(res.diff), 1)
+
+    def test_discard(self):
+        """Verify that dirs of the dropped actions are compared by the next run"""
+        monitor = self.get_monitor()
+        monitor.generate()
+        monitor.discard_digests([{"dst": os.path.join(self.dst, "src/d1/s1/f5")}])
+        self.mirror(monitor)
+        res, compared = self.generate(self.get_monitor())
+        self.assertEqual(res, [])
+        self.assertEqual(len(compared), 4 + 1 + 5)
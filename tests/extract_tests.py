@@ -0,0 +1,162 @@
+import os
+import io
+import gzip
+import tarfile
+from copy import deepcopy
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from base import AgnosticBase
+from extract import CHUNK, GzipMembers, Extractor, open_archive, read_index
+from monitors import PythonMonitor
+from script_gen import LinuxScriptGenerator
+from . import config
+
+
+class ExtractTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.dst = os.path.join(self.root, "dst")
+        self.files = {f"cfg/f{i}": os.urandom(100 * i) for i in range(10)}
+        self.files["cfg/sub/big"] = os.urandom(3 << 20)
+        self.files["cfg/magic"] = b"\x1f\x8b\x08\x00" * 1000
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_tar(self, name: str, mode: str = "w") -> str:
+        path = os.path.join(self.root, name)
+        with tarfile.open(path, mode) as tar:
+            for member, data in self.files.items():
+                info = tarfile.TarInfo(f"./{member}")
+                info.size, info.mtime = len(data), 1000
+                tar.addfile(info, io.BytesIO(data))
+            tar.addfile(tarfile.TarInfo("../escape"), io.BytesIO())
+        return path
+
+    def make_multi_gzip(self, name: str) -> str:
+        """Archive compressed as many members, like bgzip does"""
+        tar = self.make_tar(f"{name}.tmp")
+        with open(tar, "rb") as f:
+            data = f.read()
+        path = os.path.join(self.root, name)
+        self.members = range(0, len(data), 64 << 10)
+        with open(path, "wb") as f:
+            for i in self.members:
+                # stored blocks keep the magic of the data, i.e. false candidates
+                f.write(gzip.compress(data[i : i + (64 << 10)], compresslevel=i % 2 * 6))
+        return path
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def assert_extracted(self):
+        for member, data in self.files.items():
+            path = os.path.join(self.dst, member)
+            self.assertEqual(self.read(path), data)
+            self.assertEqual(os.stat(path).st_mtime, 1000)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "escape")))
+
+    def test_gzip_members(self):
+        """Verify that members are found despite false candidates"""
+        path = self.make_multi_gzip("a.tar.gz")
+        with gzip.open(path, "rb") as f:
+            exp = f.read()
+        stream = GzipMembers(path, workers=4, window=3)
+        self.assertGreater(len(stream.get_candidates()), len(self.members))
+        self.assertEqual(stream.read(1000) + stream.read(), exp)
+        stream.close()
+
+    def test_bounded_chunks(self):
+        """Verify that a member of several MB is inflated and read back in bounded chunks"""
+        data = (os.urandom(1000) + bytes(3000)) * 2000
+        path = os.path.join(self.root, "big.gz")
+        with open(path, "wb") as f:
+            f.write(gzip.compress(data) + gzip.compress(b"tail"))
+        stream = GzipMembers(path, workers=2, max_member=1 << 20)
+        self.assertLessEqual(max(len(c) for c in stream.iter_chunks()), CHUNK)
+        out = list()
+        while buf := stream.read(10240):
+            out.append(buf)
+            self.assertLessEqual(len(stream.pending), CHUNK + 10240)
+        self.assertEqual(b"".join(out), data + b"tail")
+        stream.close()
+
+    def test_single_member(self):
+        """Verify that a single-member archive is streamed by the tarfile"""
+        self.files = {"cfg/a": b"a" * 1000}
+        with open_archive(self.make_tar("s.tar.gz", "w:gz")) as tar:
+            self.assertNotIsInstance(tar.fileobj, GzipMembers)
+            self.assertEqual([m.name for m in tar], ["./cfg/a", "../escape"])
+
+    def test_extract(self):
+        """Verify each mode extracts the archive and skips the unchanged members"""
+        for name, mode in (("a.tar", "w"), ("a.tar.bz2", "w:bz2"), ("a.tar.gz", "w:gz")):
+            with self.subTest(name):
+                self.dst = os.path.join(self.root, f"dst-{name}")
+                archive = self.make_tar(name, mode)
+                self.assertEqual(Extractor(archive, self.dst, workers=4).run(), (12, 0))
+                self.assert_extracted()
+                os.utime(os.path.join(self.dst, "cfg/f1"), (2000, 2000))
+                extractor = Extractor(archive, self.dst, workers=4, large_member=1 << 20)
+                self.assertEqual(extractor.run(), (1, 11))
+                self.assert_extracted()
+                self.assertEqual(len(read_index(archive)), 12)
+
+    def test_extract_multi_gzip(self):
+        archive = self.make_multi_gzip("b.tar.gz")
+        self.assertEqual(Extractor(archive, self.dst).run(), (12, 0))
+        self.assert_extracted()
+
+    def test_inflight(self):
+        """Verify that the writers hold at most the cap of the streamed members' data"""
+        archive = self.make_tar("c.tar.gz", "w:gz")
+        extractor = Extractor(
+            archive, self.dst, workers=4, large_member=1 << 20, inflight_bytes=2000
+        )
+        self.assertEqual(extractor.run(), (12, 0))
+        self.assert_extracted()
+        # 'cfg/magic' is bigger than the cap, it's admitted alone
+        self.assertLessEqual(extractor.max_inflight, 4000)
+        self.assertEqual(extractor.inflight, 0)
+
+
+class ExtractMonitorTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.archive = os.path.join(self.tmpdir.name, "conf.tar")
+        self.dst = os.path.join(self.tmpdir.name, "dst")
+        with tarfile.open(self.archive, "w") as tar:
+            for name in ("a", "b"):
+                info = tarfile.TarInfo(f"./{name}")
+                info.size, info.mtime = 1, 1000
+                tar.addfile(info, io.BytesIO(b"x"))
+        self.cfg = deepcopy(config)
+        self.cfg["settings"]["mkdirs"] = []
+        self.cfg["paths"] = [{"src": self.archive, "dst": self.dst, "extract": True}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_generate(self):
+        """Verify that the archive is extracted only while members differ"""
+        monitor = PythonMonitor(self.parse_config(deepcopy(self.cfg)))
+        self.assertEqual(
+            [(a["action"], a["members"]) for a in monitor.generate()], [("extract", 2)]
+        )
+        Extractor(self.archive, self.dst).run()
+        self.assertEqual(monitor.generate(), [])
+
+    def test_journal(self):
+        """Verify that the clean-up step is checked against the removed archive on resume"""
+        self.cfg["settings"].update({"cmd": dict(), "journal": os.path.join(self.tmpdir.name, "j")})
+        generator = LinuxScriptGenerator(self.parse_config(deepcopy(self.cfg)))
+        generator.generate()
+        self.assertEqual(
+            [(a["action"], a["dst"]) for a in generator.actions_index],
+            [("extract", self.dst), ("remove", os.path.join(self.dst, "conf.tar"))],
+        )
@@ -0,0 +1,149 @@
+import os
+import sys
+import signal
+import platform
+from copy import deepcopy
+from time import sleep, monotonic
+from subprocess import Popen
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipIf
+
+from base import AgnosticBase
+from governor import Governor, read_pressure
+from script_gen import LinuxScriptGenerator, PythonScriptGenerator
+from . import SWD, config
+
+
+def get_state(pid: int) -> str:
+    """State of the process: R, S, T (stopped), ..."""
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().rsplit(")", 1)[1].split()[0]
+
+
+class GovernorTests(TestCase):
+
+    def test_read_pressure(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "io")
+            with open(path, "w") as f:
+                f.write("some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n")
+                f.write("full avg10=2.00 avg60=1.00 avg300=0.00 total=50\n")
+            self.assertEqual(read_pressure(path), 12.5)
+            self.assertIsNone(read_pressure(os.path.join(tmp, "missing")))
+
+    def test_adapt(self):
+        """Verify that the duty is halved under pressure and raised by steps after"""
+        governor = Governor(target=10, min_duty=0.1, step=0.25)
+        self.assertEqual([governor.adapt(50) for _ in range(5)], [0.5, 0.25, 0.125, 0.1, 0.1])
+        self.assertEqual([governor.adapt(0) for _ in range(5)], [0.35, 0.6, 0.85, 1.0, 1.0])
+
+    def test_wait(self):
+        """Verify that workers are paused under pressure, but not longer than the interval"""
+        states = list()
+        governor = Governor(target=10, interval=0.2, min_duty=0.5, probe=lambda: 100)
+        governor.listeners.append(states.append)
+        governor.start()
+        try:
+            sleep(0.15)
+            self.assertFalse(governor.running.is_set())
+            t0 = monotonic()
+            governor.wait()
+            self.assertLess(monotonic() - t0, 0.2)
+        finally:
+            governor.stop()
+        self.assertTrue(governor.running.is_set())
+        self.assertEqual(states[:2], [False, True])
+
+    @skipIf(platform.system() != "Linux", "Unsupported OS!")
+    def test_run(self):
+        """Verify that the governed command is stopped while paused and completes"""
+        probe = "lambda: 100"
+        cmd = [
+            sys.executable,
+            "-c",
+            "import sys, governor; "
+            f"sys.exit(governor.run(sys.argv[1:], interval=0.4, min_duty=0.1, probe={probe}))",
+            sys.executable,
+            "-c",
+            "import time; [time.sleep(0.01) for _ in range(100)]",
+        ]
+        env = {**os.environ, "PYTHONPATH": os.path.dirname(SWD)}
+        proc = Popen(cmd, env=env)
+        try:
+            children = set()
+            states = set()
+            t0 = monotonic()
+            while proc.poll() is None and monotonic() - t0 < 5:
+                with open(f"/proc/{proc.pid}/task/{proc.pid}/children") as f:
+                    children.update(int(p) for p in f.read().split())
+                for pid in children:
+                    try:
+                        states.add(get_state(pid))
+                    except FileNotFoundError:
+                        pass
+                sleep(0.02)
+            self.assertEqual(proc.wait(5), 0)
+            self.assertIn("T", states)
+        finally:
+            proc.kill()
+
+    @skipIf(platform.system() != "Linux", "Unsupported OS!")
+    def test_run_terminated(self):
+        """Verify that a SIGTERM is forwarded to the command, resumed if it was stopped"""
+        cmd = [
+            sys.executable,
+            "-c",
+            "import sys, governor; "
+            "sys.exit(governor.run(sys.argv[1:], interval=0.4, min_duty=0.1, probe=lambda: 100))",
+            "sleep",
+            "30",
+        ]
+        env = {**os.environ, "PYTHONPATH": os.path.dirname(SWD)}
+        proc = Popen(cmd, env=env)
+        try:
+            t0, child = monotonic(), None
+            while monotonic() - t0 < 5:
+                with open(f"/proc/{proc.pid}/task/{proc.pid}/children") as f:
+                    child = next((int(p) for p in f.read().split()), None)
+                if child and get_state(child) == "T":
+                    break
+                sleep(0.02)
+            self.assertEqual(get_state(child), "T")
+            proc.terminate()
+            self.assertEqual(proc.wait(5), 256 - signal.SIGTERM)
+            self.assertFalse(os.path.exists(f"/proc/{child}"))
+        finally:
+            proc.kill()
+
+
+class GovernorScriptTests(TestCase, AgnosticBase):
+
+    def get_config(self, governor) -> dict:
+        cfg = self.parse_config(deepcopy(config))
+        cfg["settings"]["governor"] = governor
+        return cfg
+
+    def test_gen_python(self):
+        generator = PythonScriptGenerator(self.get_config({"target": 20, "nice": 5}))
+        res = generator.gen_headers()
+        self.assertIn("class Governor:", res)
+        self.assertEqual(
+            generator.gen_governor(),
+            ["# Low-impact mode", "lower_priority(5, 3)", "set_governor(target=20)", ""],
+        )
+        self.assertEqual(PythonScriptGenerator(self.get_config(None)).gen_governor(), [])
+
+    def test_gen_linux(self):
+        """Verify that rsync and tar are governed"""
+        generator = LinuxScriptGenerator(self.get_config(True))
+        generator.out = list()
+        generator.gen_governor()
+        self.assertIn("govern() {", generator.out)
+        self.assertIn(
+            '\tnice -n 10 "${ionice[@]}" python3 -c "$governor_py" \'{}\' "$@"', generator.out
+        )
+        path = {"src": "/x/y", "dst": "/z/y", "exclude": []}
+        self.assertTrue(generator.gen_rsync(path)[0].startswith("govern rsync "))
+        self.assertTrue(
+            generator.get_archive_cmd({"src": "/x/y", "dst": "/z/a.tar"})[0].startswith("govern tar")
+        )
@@ -0,0 +1,136 @@
+import io
+import os
+import json
+from contextlib import redirect_stderr, redirect_stdout
+from copy import deepcopy
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from base import PythonBase
+from make_backup import MultiProfileRunner, OpenBackup, parse_args
+from plans import PlanStore
+from script_gen import PythonScriptGenerator
+from . import config
+
+
+class ProfileCacheTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.ob = OpenBackup()
+        self.ob.SWD = self.tmpdir.name
+        self.path = os.path.join(self.tmpdir.name, "profile.json")
+        self.write_profile("a")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_profile(self, name: str):
+        cfg = deepcopy(config)
+        cfg["settings"]["name"] = name
+        with open(self.path, "w") as f:
+            json.dump(cfg, f)
+
+    def test_read_profile(self):
+        """Verify that the normalized profile is cached until the file is modified"""
+        self.assertEqual(self.ob.read_profile(self.path)["settings"]["name"], "a")
+        cache = os.path.join(self.tmpdir.name, ".cache", "profile.json")
+        with open(cache, "r") as f:
+            cached = json.load(f)
+        self.assertEqual(cached["config"]["paths"][0]["batch_id"], 0)
+        cached["config"]["settings"]["name"] = "from-cache"
+        with open(cache, "w") as f:
+            json.dump(cached, f)
+        self.assertEqual(self.ob.read_profile(self.path)["settings"]["name"], "from-cache")
+        self.write_profile("b")
+        os.utime(self.path, ns=(0, 0))
+        self.assertEqual(self.ob.read_profile(self.path)["settings"]["name"], "b")
+
+    def test_read_profile_parser(self):
+        """Verify that the cached profile is parsed again once the parser changed"""
+        self.ob.read_profile(self.path)
+        cache = os.path.join(self.tmpdir.name, ".cache", "profile.json")
+        with open(cache, "r") as f:
+            cached = json.load(f)
+        cached["parser"] = "old"
+        cached["config"]["settings"]["name"] = "from-cache"
+        with open(cache, "w") as f:
+            json.dump(cached, f)
+        self.assertEqual(self.ob.read_profile(self.path)["settings"]["name"], "a")
+
+    def test_parse_args(self):
+        args = parse_args(["--plan-only", "-c", "x"])
+        self.assertTrue(args.plan_only)
+        self.assertFalse(args.list_profiles)
+
+    def test_parse_args_many_profiles(self):
+        """Verify that the options a run of many profiles doesn't support are rejected"""
+        self.assertEqual(parse_args(["-c", "x", "-c", "y", "-j", "3"]).jobs, 3)
+        for argv in (["review"], ["--resume"], ["--profile"], ["--plan-only"]):
+            with self.assertRaises(SystemExit), redirect_stderr(io.StringIO()):
+                parse_args([*argv, "-c", "x", "-c", "y"])
+
+
+class ResumeTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.ob = OpenBackup(command="resume")
+        self.ob.plans = PlanStore(self.tmpdir.name)
+        self.ob.profile_name = "p"
+        self.ob.config = deepcopy(config)
+        self.ob.config["settings"]["journal"] = self.ob.plans.get_journal_path("p")
+        self.ob.config["settings"]["verify"] = "touched"
+        self.ob.FN = PythonBase.FN
+        self.ob.script_executor = lambda tmpfile: 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_verify_pairs(self):
+        """Verify that a resumed run verifies the files of the interrupted plan without a scan"""
+        pairs = [["/src/a", "/dst/a"]]
+        self.ob.plans.save(
+            "p",
+            {"status": "running", "exe": "py", "instructions": "", "actions": [], "verify": pairs},
+        )
+        with patch.object(self.ob, "gen_tmpfile"), patch.object(
+            self.ob, "get_verify_pairs", side_effect=AssertionError
+        ), patch.object(self.ob, "verify") as verify, redirect_stdout(io.StringIO()):
+            self.ob.resume()
+        verify.assert_called_once_with(pairs)
+
+    def test_held_plan_totals(self):
+        """Verify that the execution of a held plan doesn't scan for the totals of the history"""
+        from progress import History
+
+        self.ob.command = "review"
+        self.ob.instructions, self.ob.actions_index = "", []
+        self.ob.ScriptGenerator = PythonScriptGenerator(self.ob.config)
+        self.ob.history = History(os.path.join(self.tmpdir.name, "p.history"))
+        with patch.object(self.ob, "get_verify_pairs", return_value=None), patch.object(
+            self.ob.ScriptGenerator, "get_totals", side_effect=AssertionError
+        ), patch.object(self.ob.ScriptGenerator.monitor, "save_digests"), redirect_stdout(
+            io.StringIO()
+        ):
+            self.ob.execute()
+        self.assertIsNone(self.ob.history.get("bytes_rate"))
+
+
+class MultiProfileRunnerTests(TestCase):
+
+    def test_group_by_device(self):
+        """Verify that the profiles writing to a common device are executed in turn"""
+        runner = MultiProfileRunner([], jobs=4)
+        backups = [OpenBackup() for _ in range(3)]
+        devices = [{1}, {2, 3}, {3}]
+        with patch.object(runner, "get_devices", lambda ob: devices[backups.index(ob)]):
+            groups = runner.group_by_device(backups)
+        self.assertEqual(groups, [[backups[0]], [backups[1], backups[2]]])
+
+    def test_get_devices(self):
+        with TemporaryDirectory() as tmpdir:
+            ob = OpenBackup()
+            ob.config = {"paths": [{"dst": os.path.join(tmpdir, "missing/dst")}]}
+            self.assertEqual(MultiProfileRunner.get_devices(ob), {os.stat(tmpdir).st_dev})
@@ -0,0 +1,140 @@
+import os
+import io
+import shutil
+from copy import deepcopy
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import runtime
+from base import AgnosticBase
+from manifest import DestManifest, update
+from monitors import PythonMonitor
+from script_gen import PythonScriptGenerator
+from . import config
+
+
+class DestManifestTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, "dst")
+        os.makedirs(os.path.join(self.root, "src/sub"))
+        for name in ("src/a", "src/sub/b", "src-other"):
+            open(os.path.join(self.root, name), "w").close()
+        self.manifest = DestManifest(self.root)
+        self.manifest.rebuild()
+
+    def tearDown(self):
+        self.manifest.close()
+        self.tmpdir.cleanup()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def test_rebuild(self):
+        """Verify that the walk records the tree, without the manifest itself"""
+        self.assertEqual(
+            self.manifest.list(self.root),
+            [
+                (self.path("src"), True),
+                (self.path("src-other"), False),
+                (self.path("src/a"), False),
+                (self.path("src/sub"), True),
+                (self.path("src/sub/b"), False),
+            ],
+        )
+        self.assertGreater(self.manifest.get_verified(), 0)
+
+    def test_list_subtree(self):
+        """Verify that siblings sharing the prefix are not listed"""
+        self.assertEqual(
+            [p for p, _ in self.manifest.list(self.path("src"))],
+            [self.path("src/a"), self.path("src/sub"), self.path("src/sub/b")],
+        )
+
+    def test_record_remove(self):
+        """Verify that removing a dir drops its subtree only"""
+        os.utime(self.path("src/a"), (5, 5))
+        self.manifest.record(self.path("src/a"))
+        self.assertEqual(self.manifest.get(self.path("src/a")), (0, 5, 0))
+        self.manifest.remove(self.path("src"))
+        self.assertIsNone(self.manifest.get(self.path("src/sub/b")))
+        self.assertEqual(self.manifest.list(self.root), [(self.path("src-other"), False)])
+
+    def test_update(self):
+        """Verify the entry point fed with the rsync output"""
+        open(self.path("src/c"), "w").close()
+        self.manifest.close()
+        update("record", self.root, io.StringIO("src/c\nsent 10 bytes\n\n"))
+        update("remove", self.root, io.StringIO(f"{self.path('src/sub')}\n"))
+        self.manifest = DestManifest(self.root)
+        self.assertIsNotNone(self.manifest.get(self.path("src/c")))
+        self.assertIsNone(self.manifest.get(self.path("src/sub")))
+
+    def test_runtime_tracking(self):
+        """Verify that the script functions record the completed actions"""
+        # the generator inlines the manifest module into the script
+        runtime.DestManifest = DestManifest
+        runtime.open_manifest(self.root)
+        try:
+            runtime.cp(self.path("src/a"), self.path("copy/a"))
+            runtime.rmdir(self.path("src/sub"))
+        finally:
+            runtime.manifests.pop(self.root).commit()
+        self.assertIsNotNone(self.manifest.get(self.path("copy/a")))
+        # created along with the copy
+        self.assertEqual(self.manifest.get(self.path("copy"))[2], 1)
+        self.assertIsNone(self.manifest.get(self.path("src/sub/b")))
+
+
+class ManifestMonitorTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        self.dst = os.path.join(self.tmpdir.name, "dst")
+        os.makedirs(os.path.join(self.src, "keep"))
+        os.makedirs(os.path.join(self.dst, "src/gone"))
+        os.makedirs(os.path.join(self.dst, "src/keep"))
+        for name in ("keep/a", "new"):
+            open(os.path.join(self.src, name), "w").close()
+        shutil.copy2(os.path.join(self.src, "keep/a"), os.path.join(self.dst, "src/keep/a"))
+        self.cfg = deepcopy(config)
+        self.cfg["settings"]["manifest"] = True
+        self.cfg["settings"]["mkdirs"] = []
+        self.cfg["paths"] = [{"src": self.src, "dst": self.dst}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get_actions(self) -> set:
+        monitor = PythonMonitor(self.parse_config(deepcopy(self.cfg)))
+        return {
+            (a["action"], os.path.relpath(a["dst"], self.dst)) for a in monitor.generate()
+        }
+
+    def test_generate(self):
+        """Verify that the plan is the same as with a walk of the destination"""
+        exp = {("copy", "src/new"), ("remove", "src/gone")}
+        self.assertEqual(self.get_actions(), exp)
+        self.cfg["settings"]["manifest"] = False
+        self.assertEqual(self.get_actions(), exp)
+
+    def test_destination_not_walked(self):
+        """Verify that changes made behind the manifest's back are seen only once verified"""
+        # built by the script of the first run
+        DestManifest(self.dst).rebuild()
+        os.rmdir(os.path.join(self.dst, "src/gone"))
+        self.assertIn(("remove", "src/gone"), self.get_actions())
+        self.cfg["settings"]["verify_manifest"] = True
+        self.assertEqual(self.get_actions(), {("copy", "src/new")})
+
+    def test_read_only(self):
+        """Verify that the plan doesn't create the manifest, the script rebuilds it"""
+        shutil.rmtree(self.dst)
+        generator = PythonScriptGenerator(self.parse_config(deepcopy(self.cfg)))
+        self.assertIn(f"open_manifest('{self.dst}', rebuild=True)", generator.generate())
+        self.assertFalse(os.path.exists(self.dst))
+        DestManifest(self.dst).rebuild()
+        generator = PythonScriptGenerator(self.parse_config(deepcopy(self.cfg)))
+        self.assertIn(f"open_manifest('{self.dst}')", generator.generate())
@@ -1,11 +1,15 @@
 import pytest
 import re
 import os
+import shutil
 from copy import deepcopy
+from tempfile import TemporaryDirectory
 import logging
 
 from unittest import TestCase
+from unittest.mock import patch
 from monitors import LinuxMonitor, PythonMonitor
+from script_gen import LinuxScriptGenerator, PythonScriptGenerator
 from base import AgnosticBase
 from . import SWD, config, DDP
 
@@ -194,3 +198,95 @@ class PythonMonitorTests(TestCase, AgnosticBase):
             },
             out,
         )
+
+
+class FanOutTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        super().setUp()
+        cfg = deepcopy(config)
+        cfg["paths"] = [
+            {
+                "src": f"{SWD}/data/src/dir1",
+                "dst": [f"{SWD}/data/tgt", f"{SWD}/data/fanout"],
+                "exclude": cfg["paths"][0]["exclude"],
+            }
+        ]
+        self.monitor = PythonMonitor(self.parse_config(cfg))
+
+    def test_parse_config(self):
+        """Verify that a list of destinations is split into separate paths"""
+        paths = self.monitor.config["paths"]
+        self.assertEqual([p["dst"] for p in paths], [DDP, f"{SWD}/data/fanout"])
+        self.assertEqual([p["batch_id"] for p in paths], [0, 1])
+        self.assertEqual({p["fanout"] for p in paths}, {0})
+
+    def test_generate(self):
+        """Verify that the source is scanned once for all destinations"""
+        out = self.monitor.get_transfers()
+        src_scans = [k for k in self.monitor.scan_cache if k[0].endswith("src/dir1")]
+        self.assertEqual(len(src_scans), 1)
+        dsts = {p["dst"] for p in out if p["src"] == f"{SWD}/data/src/dir1/b.txt"}
+        self.assertEqual(dsts, {f"{DDP}/dir1/b.txt", f"{SWD}/data/fanout/dir1/b.txt"})
+
+
+class MetaTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        self.dst = os.path.join(self.tmpdir.name, "dst")
+        os.makedirs(self.src)
+        for name in ("touched", "rewritten", "same"):
+            with open(os.path.join(self.src, name), "wb") as f:
+                f.write(name.encode() * 1000)
+        shutil.copytree(self.src, os.path.join(self.dst, "src"))
+        for name in ("touched", "rewritten"):
+            os.utime(os.path.join(self.src, name), (4e9, 4e9))
+        with open(os.path.join(self.src, "rewritten"), "r+b") as f:
+            f.write(b"x")
+        os.utime(os.path.join(self.src, "rewritten"), (4e9, 4e9))
+        self.cfg = deepcopy(config)
+        self.cfg["settings"]["mkdirs"] = []
+        self.cfg["settings"]["meta"] = {"samples": 2, "block": 16}
+        self.cfg["paths"] = [{"src": self.src, "dst": self.dst}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_generate(self):
+        """Verify that only the files with the same content are given the metadata"""
+        res = PythonMonitor(self.parse_config(deepcopy(self.cfg))).generate()
+        self.assertEqual(
+            sorted((a["action"], os.path.basename(a["dst"])) for a in res),
+            [("meta", "touched"), ("update", "rewritten")],
+        )
+        self.cfg["settings"]["meta"] = False
+        res = PythonMonitor(self.parse_config(deepcopy(self.cfg))).generate()
+        self.assertEqual({a["action"] for a in res}, {"update"})
+
+    def test_scripts(self):
+        touched = (os.path.join(self.src, "touched"), os.path.join(self.dst, "src/touched"))
+        res = PythonScriptGenerator(self.parse_config(deepcopy(self.cfg))).generate()
+        self.assertIn("meta('%s', '%s')" % touched, res)
+        res = LinuxScriptGenerator(self.parse_config(deepcopy(self.cfg))).generate()
+        self.assertIn("meta '%s' '%s'" % touched, res)
+
+    def test_whole_file(self):
+        """Verify that an edit between the samples is found by the default whole-file comparison"""
+        path = os.path.join(self.src, "same")
+        with open(path, "r+b") as f:
+            f.seek(2000)
+            f.write(b"x")
+        os.utime(path, (4e9, 4e9))
+        for meta, exp in (({"samples": 2, "block": 16}, "meta"), (True, "update")):
+            self.cfg["settings"]["meta"] = meta
+            res = PythonMonitor(self.parse_config(deepcopy(self.cfg))).generate()
+            self.assertIn((exp, "same"), {(a["action"], os.path.basename(a["dst"])) for a in res})
+
+    def test_linux_disabled(self):
+        """Verify that the linux script doesn't plan the metadata without the setting"""
+        self.cfg["settings"]["meta"] = False
+        generator = LinuxScriptGenerator(self.parse_config(deepcopy(self.cfg)))
+        with patch.object(generator, "get_ops", side_effect=AssertionError):
+            generator.gen_meta()
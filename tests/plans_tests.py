@@ -0,0 +1,71 @@
+import os
+import time
+from copy import deepcopy
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from base import AgnosticBase
+from monitors import LinuxMonitor
+from plans import PlanStore, check_approval
+from . import config
+
+
+class PlanStoreTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.store = PlanStore(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_save_load(self):
+        """Verify that a plan survives the round trip"""
+        self.store.save("job", {"instructions": "echo", "fingerprint": {}})
+        self.assertEqual(self.store.list(), ["job"])
+        self.assertEqual(self.store.load("job")["instructions"], "echo")
+        self.store.remove("job")
+        self.assertEqual(self.store.list(), [])
+
+    def test_is_valid(self):
+        """Verify that the fingerprint detects added files"""
+        root = os.path.join(self.tmpdir.name, "src")
+        os.mkdir(root)
+        monitor = LinuxMonitor(self.parse_config(deepcopy(config)))
+        monitor.btr(root, monitor.parse_rsync_exclude(None))
+        plan = {"fingerprint": monitor.fingerprint}
+        self.assertIn(root, plan["fingerprint"])
+        self.assertTrue(self.store.is_valid(plan))
+        time.sleep(0.01)
+        open(os.path.join(root, "new.txt"), "w").close()
+        self.assertFalse(self.store.is_valid(plan))
+
+    def test_is_valid_config(self):
+        """Verify that editing the profile invalidates the plan"""
+        path = os.path.join(self.tmpdir.name, "profile.json")
+        open(path, "w").close()
+        plan = {
+            "fingerprint": {},
+            "config_path": path,
+            "config_mtime": self.store.get_mtime(path),
+        }
+        self.assertTrue(self.store.is_valid(plan))
+        os.utime(path, ns=(0, 0))
+        self.assertFalse(self.store.is_valid(plan))
+
+
+class CheckApprovalTests(TestCase):
+
+    def test_check_approval(self):
+        """Verify that limits are exclusive and unknown values hold the plan"""
+        stats = {"deletions": 3, "copies": 10, "bytes": 2048}
+        self.assertEqual(check_approval(stats, {"max_deletions": 4}), [])
+        self.assertEqual(
+            check_approval(stats, {"max_deletions": 3, "max_bytes": 4096}),
+            ["deletions 3 >= 3"],
+        )
+        self.assertEqual(
+            check_approval({**stats, "bytes": None}, {"max_bytes": 1}),
+            ["bytes unknown"],
+        )
+        self.assertEqual(check_approval(stats, {}), ["no approval rules"])
@@ -1,8 +1,9 @@
 from copy import deepcopy
 from unittest import TestCase
 import logging
+import re
 
-from . import SWD, config
+from . import SWD, DDP, config
 from script_gen import LinuxScriptGenerator, PythonScriptGenerator
 from base import AgnosticBase
 from tests.scenarios import (
@@ -104,6 +105,17 @@ class PythonPrepareScriptTests(TestCase, AgnosticBase):
         res = "\n".join(self.python_generator.generate())
         log.debug(res)
 
+    def test_gen_io(self):
+        """Verify that the CopyIO is configured from the 'io' setting"""
+        self.assertEqual(self.python_generator.gen_io(), [])
+        self.python_generator.config["settings"]["io"] = {"direct": 1 << 30}
+        try:
+            self.assertEqual(
+                self.python_generator.gen_io(), ["# Copy I/O", f"set_io(direct={1 << 30})", ""]
+            )
+        finally:
+            del self.python_generator.config["settings"]["io"]
+
     def _test_gen_rms(self):
         """Check if correct objects are marked for removal"""
         self.assertListEqual(
@@ -136,3 +148,37 @@ class PythonPrepareScriptTests(TestCase, AgnosticBase):
                 "",
             ],
         )
+
+
+class CheckpointPrepareScriptTests(TestCase, AgnosticBase):
+    config = deepcopy(config)
+    config["settings"]["journal"] = "plans/job.journal"
+    maxDiff = None
+
+    def test_linux_steps(self):
+        """Verify that actions are prefixed with checkpoint steps"""
+        generator = LinuxScriptGenerator(self.parse_config(deepcopy(self.config)))
+        res = generator.generate()
+        self.assertIn("journal='plans/job.journal'", res)
+        self.assertIn(
+            f"step 1 rm -rfv '{DDP}/dir1/dir 4/r_i.ini' | tee -a 'some/pa th/test.log'",
+            res,
+        )
+        self.assertIn(
+            f"\tstep 5 tar --exclude=*/__.* -cvf tests/data/tgt/dir1/arch.tar -C {SWD}/data/src/dir6 . &>> 'some/pa th/test.log'",
+            res,
+        )
+        self.assertEqual(
+            [a["action"] for a in generator.actions_index],
+            ["remove", "remove", "remove", "sync", "archive", "sync", "sync"],
+        )
+        self.assertEqual(res[-2], 'if [[ -e "$journal.failed" ]]; then exit 1; fi')
+
+    def test_python_steps(self):
+        """Verify that actions are given ids"""
+        generator = PythonScriptGenerator(self.parse_config(deepcopy(self.config)))
+        res = "\n".join(generator.generate())
+        self.assertIn("open_journal('plans/job.journal')", res)
+        ids = {a["id"] for a in generator.actions_index}
+        self.assertEqual(len(ids), len(generator.actions_index))
+        self.assertEqual(set(re.findall(r"aid=(\d+)", res)), ids)
@@ -0,0 +1,46 @@
+import os
+import pstats
+from time import perf_counter
+from tempfile import TemporaryDirectory
+from subprocess import run
+from unittest import TestCase
+
+from profiling import PipelineProfiler
+
+
+def busy(seconds: float):
+    t0 = perf_counter()
+    while perf_counter() - t0 < seconds:
+        sum(range(1000))
+
+
+class PipelineProfilerTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.profiler = PipelineProfiler(self.tmpdir.name, interval=0.001)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_phase(self):
+        """Verify that each phase dumps pstats and collapsed stacks"""
+        with self.profiler.phase("generate"):
+            busy(0.05)
+        stats = pstats.Stats(os.path.join(self.tmpdir.name, "generate.pstats"))
+        self.assertTrue(any(k[2] == "busy" for k in stats.stats))
+        with open(os.path.join(self.tmpdir.name, "generate.collapsed")) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(any("profiling_tests.py:busy" in l for l in lines))
+        self.assertTrue(all(l.rsplit(" ", 1)[1].isdigit() for l in lines))
+
+    def test_wrap_command(self):
+        """Verify that a script can be profiled in a subprocess"""
+        script = os.path.join(self.tmpdir.name, "job.py")
+        with open(script, "w") as f:
+            f.write("x = sum(range(10**5))\n")
+        run(self.profiler.wrap_command(script), check=True)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.tmpdir.name, "execute.pstats"))
+        )
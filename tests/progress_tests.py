@@ -0,0 +1,135 @@
+import io
+import os
+import re
+import sys
+import threading
+from copy import deepcopy
+from subprocess import run
+from tempfile import TemporaryDirectory
+from time import monotonic
+from unittest import TestCase
+
+import scan
+from base import AgnosticBase
+from progress import Counters, History, Progress
+from script_gen import LinuxScriptGenerator, PythonScriptGenerator
+from . import config
+
+
+def write(path: str, data: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+
+class ProgressTests(TestCase):
+
+    def test_scan(self):
+        counters = Counters()
+        progress = Progress(counters, "Scanning", entries=100, rate=10, stream=io.StringIO())
+        # not started, the sample is rendered as if a second went by
+        progress.t0 = monotonic() - 1
+        counters.listed("/src", 20)
+        counters.listed("/src/d", 30)
+        self.assertEqual(
+            progress.render(), "Scanning: 2 dirs, 50 entries (50/s), ETA 00:05 /src/d"
+        )
+
+    def test_execution(self):
+        """Verify that the ETA is based on the rate of the previous runs until the run has its own"""
+        counters = Counters()
+        stream = io.StringIO()
+        progress = Progress(
+            counters, "Executing", actions=10, bytes=4096, rate=1024, interval=60, stream=stream
+        ).start()
+        for i in range(5):
+            counters.done(f"/dst/f{i}", 1024 if i == 0 else 0)
+        self.assertRegex(
+            progress.render(),
+            r"^Executing: 5/10 actions, 1\.0 KiB/4\.0 KiB \(.+/s\), ETA 00:03$",
+        )
+        progress.stop()
+        self.assertIn("5/10 actions", stream.getvalue())
+        progress.t0 -= 600
+        # the run's own rate: 1 KiB in 10 minutes
+        self.assertTrue(progress.render().endswith("ETA 30:00"))
+
+    def test_concurrent_actions(self):
+        """Verify that no actions reported by concurrent workers are lost"""
+        counters = Counters()
+        workers = [
+            threading.Thread(target=lambda: [counters.done("/dst/f", 2) for _ in range(10000)])
+            for _ in range(4)
+        ]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        self.assertEqual((counters.actions, counters.bytes), (40000, 80000))
+
+    def test_history(self):
+        """Verify that the rates are averaged over the runs and kept across the instances"""
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "plans/default.history")
+            History(path).update(bytes_rate=100)
+            history = History(path)
+            history.update(bytes_rate=200, scan_rate=10)
+            self.assertEqual(History(path).get("bytes_rate"), 150)
+            self.assertEqual(History(path).get("scan_rate"), 10)
+            self.assertIsNone(History(path).get("scan_entries"))
+
+    def test_scan_counters(self):
+        """Verify that the walks bump the counters once per listed dir"""
+        with TemporaryDirectory() as tmpdir:
+            for name in ("a", "d/b", "d/e/c"):
+                write(os.path.join(tmpdir, name), name)
+            scan.counters.reset()
+            scan.build_tree(tmpdir, re.compile(".^"), dict())
+            self.assertEqual((scan.counters.dirs, scan.counters.files), (3, 5))
+
+    def test_parallel_scan_counters(self):
+        """Verify that no increments of the concurrent walkers are lost"""
+        with TemporaryDirectory() as tmpdir:
+            for i in range(200):
+                write(os.path.join(tmpdir, f"d{i % 20}", f"e{i % 3}", str(i)), "")
+            scan.counters.reset()
+            scan.build_tree_parallel(tmpdir, re.compile(".^"), dict(), workers=8)
+            self.assertEqual((scan.counters.dirs, scan.counters.files), (81, 280))
+
+
+class ScriptProgressTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        self.dst = os.path.join(self.tmpdir.name, "dst")
+        for name in ("a", "d/b"):
+            write(os.path.join(self.src, name), "data")
+        self.cfg = deepcopy(config)
+        self.cfg["settings"]["mkdirs"] = []
+        self.cfg["settings"]["logfile"] = os.path.join(self.tmpdir.name, "log.txt")
+        self.cfg["settings"]["progress"] = {"rate": 1000, "every": 1, "interval": 0.01}
+        self.cfg["paths"] = [{"src": self.src, "dst": self.dst}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_python(self):
+        """Verify that the script renders the actions and bytes against the totals of the plan"""
+        os.makedirs(self.dst)
+        generator = PythonScriptGenerator(self.parse_config(deepcopy(self.cfg)))
+        script = generator.generate()
+        self.assertEqual(generator.get_totals(), {"actions": 2, "bytes": 8})
+        self.assertIn("set_progress(actions=2, bytes=8, rate=1000, interval=0.01, every=1)", script)
+        path = os.path.join(self.tmpdir.name, "job.py")
+        with open(path, "w") as f:
+            f.write("\n".join(script))
+        res = run([sys.executable, path], capture_output=True, text=True, cwd=self.tmpdir.name)
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.assertIn("Executing: 2/2 actions, 8 B/8 B", res.stderr)
+        self.assertTrue(os.path.isfile(os.path.join(self.dst, "src/d/b")))
+
+    def test_linux(self):
+        self.cfg["settings"]["cmd"] = dict()
+        generator = LinuxScriptGenerator(self.parse_config(deepcopy(self.cfg)))
+        self.assertIn("--info=progress2", "\n".join(generator.generate()))
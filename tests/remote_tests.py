@@ -0,0 +1,130 @@
+import os
+import zlib
+import shutil
+from copy import deepcopy
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from base import AgnosticBase
+from monitors import PythonMonitor
+from remote import RemoteSnapshot, ScannerAgent
+from . import config
+
+# the agent runs in a local shell instead of on a server
+TRANSPORT = ["sh", "-c"]
+
+
+def touch(path: str, mtime: int = None) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "w").close()
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+class ScannerAgentTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.srv = os.path.join(self.tmpdir.name, "srv")
+        for name in ("src/a", "src/sub/b", "src/sub/skip.tmp", "other/c"):
+            touch(os.path.join(self.srv, name), 1000)
+        self.agent = ScannerAgent(TRANSPORT)
+
+    def tearDown(self):
+        self.agent.close()
+        self.tmpdir.cleanup()
+
+    def test_scan(self):
+        """Verify that the remote trees are mapped onto the local roots, without the excluded"""
+        entries = self.agent.scan(
+            [
+                (f"{self.srv}/src", "/mnt/src", r"(\.tmp$)"),
+                (f"{self.srv}/other", "/mnt/other", ".^"),
+            ]
+        )
+        self.assertEqual(
+            sorted(entries),
+            ["/mnt/other", "/mnt/other/c", "/mnt/src", "/mnt/src/a", "/mnt/src/sub", "/mnt/src/sub/b"],
+        )
+        self.assertEqual(entries["/mnt/src/a"], (0, 1000.0, False))
+        self.assertTrue(entries["/mnt/src/sub"][2])
+
+    def test_many_requests(self):
+        """Verify that the agent serves requests until the pipe is closed"""
+        self.assertEqual(self.agent.scan([(f"{self.srv}/missing", "/mnt/missing", ".^")]), {})
+        touch(os.path.join(self.srv, "src/new"))
+        self.assertIn("/mnt/src/new", self.agent.scan([(f"{self.srv}/src", "/mnt/src", ".^")]))
+
+    def test_missing_root(self):
+        """Verify that the roots after a missing one are mapped onto their own local paths"""
+        entries = self.agent.scan(
+            [
+                (f"{self.srv}/missing", "/mnt/missing", ".^"),
+                (f"{self.srv}/other", "/mnt/other", ".^"),
+            ]
+        )
+        self.assertEqual(sorted(entries), ["/mnt/other", "/mnt/other/c"])
+
+    def test_split_frames(self):
+        """Verify that the records are decoded whole, even if a frame ends within a character"""
+        records = "0\td\t0\t0\t\0" "0\tf\t1\t1000000000000\tžluť/ä\0"
+        data = zlib.compress(records.encode(), 0)
+        frames = iter([*(data[i : i + 1] for i in range(len(data))), None])
+        with patch.object(self.agent, "read_frame", lambda: next(frames)):
+            entries = self.agent.scan([(self.srv, "/mnt", ".^")])
+        self.assertEqual(entries, {"/mnt": (0, 0.0, True), "/mnt/žluť/ä": (1, 1000.0, False)})
+
+    def test_agent_failed(self):
+        with self.assertRaises(ConnectionError):
+            ScannerAgent(["sh", "-c", "exit 3", "--"]).scan([(self.srv, "/mnt", ".^")])
+
+    def test_snapshot(self):
+        snapshot = RemoteSnapshot(
+            {"/d/s": (0, 0, True), "/d/s/a": (1, 0, False), "/d/s-x": (1, 0, False)}
+        )
+        self.assertEqual(snapshot.list("/d/s"), [("/d/s/a", False)])
+        self.assertEqual(snapshot.get("/d/s/a"), (1, 0, False))
+        self.assertIsNone(snapshot.get("/d/s/b"))
+
+
+class RemoteMonitorTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        # the destination is mounted at mnt, its contents are on the server at srv
+        self.mnt = os.path.join(self.tmpdir.name, "mnt")
+        self.srv = os.path.join(self.tmpdir.name, "srv")
+        for name in ("keep/a", "new", "old"):
+            touch(os.path.join(self.src, name), 1000)
+        for name in ("keep/a", "gone/b"):
+            dst = touch(os.path.join(self.srv, "src", name))
+            shutil.copy2(os.path.join(self.src, "keep/a"), dst)
+        touch(os.path.join(self.srv, "src/old"), 0)
+        self.cfg = deepcopy(config)
+        self.cfg["settings"]["mkdirs"] = []
+        self.cfg["settings"]["remote"] = {"command": TRANSPORT, "paths": {self.mnt: self.srv}}
+        self.cfg["paths"] = [{"src": self.src, "dst": self.mnt}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_generate(self):
+        """Verify that the mount is compared from the snapshot, without walking it"""
+        monitor = PythonMonitor(self.parse_config(deepcopy(self.cfg)))
+        try:
+            actions = monitor.generate()
+        finally:
+            monitor.context.agent.close()
+        self.assertEqual(
+            {(a["action"], os.path.relpath(a["dst"], self.mnt)) for a in actions},
+            {("copy", "src/new"), ("update", "src/old"), ("remove", "src/gone")},
+        )
+
+    def test_unmapped(self):
+        self.cfg["settings"]["remote"]["paths"] = {"/elsewhere": "/"}
+        monitor = PythonMonitor(self.parse_config(deepcopy(self.cfg)))
+        self.assertIsNone(monitor.get_manifest(self.mnt))
+        self.assertIsNone(monitor.context.agent)
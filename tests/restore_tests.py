@@ -0,0 +1,92 @@
+import os
+import sys
+from subprocess import run
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from base import AgnosticBase
+from restore import invert_config
+from script_gen import PythonScriptGenerator
+
+
+def write(path: str, data: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+
+class RestoreTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "host", "src")
+        self.dst = os.path.join(self.tmpdir.name, "backup")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get_config(self, **path) -> dict:
+        return self.parse_config(
+            {
+                "paths": [{"src": self.src, "dst": self.dst, **path}],
+                "settings": {"logfile": os.path.join(self.tmpdir.name, "log.txt"), "manifest": True},
+            }
+        )
+
+    def test_invert_config(self):
+        config, skipped = invert_config(self.get_config(exclude=["*.tmp"]))
+        self.assertEqual(skipped, [])
+        path = config["paths"][0]
+        self.assertEqual(path["src"], os.path.join(self.dst, "src"))
+        self.assertEqual(path["dst"], os.path.dirname(self.src))
+        self.assertEqual(path["exclude"], ["*.tmp"])
+        self.assertNotIn("manifest", config["settings"])
+
+    def test_subpath_target(self):
+        """Verify that only the selected subtree is restored, under the target"""
+        target = os.path.join(self.tmpdir.name, "target")
+        config, _ = invert_config(self.get_config(), [f"{self.src}/a/b"], target)
+        path = config["paths"][0]
+        self.assertEqual(path["src"], os.path.join(self.dst, "src", "a", "b"))
+        self.assertEqual(path["dst"], os.path.join(target, f"{self.src}/a".lstrip("/")))
+        config, _ = invert_config(self.get_config(), ["/elsewhere"])
+        self.assertEqual(config["paths"], [])
+
+    def test_skipped(self):
+        config, skipped = invert_config(self.get_config(archive=True))
+        self.assertEqual((config["paths"], len(skipped)), ([], 1))
+
+    def test_restore(self):
+        """Verify that only the differing files are restored"""
+        for name in ("a", "d/b", "d/c"):
+            write(os.path.join(self.dst, "src", name), name)
+        write(os.path.join(self.src, "a"), "a")
+        write(os.path.join(self.src, "d/b"), "modified")
+        write(os.path.join(self.src, "extra"), "extra")
+        os.utime(os.path.join(self.src, "d/b"), (0, 0))
+        config, _ = invert_config(self.get_config())
+        config["settings"]["scheduler"] = True
+        generator = PythonScriptGenerator(config)
+        actions = generator.get_actions()
+        self.assertEqual(
+            sorted((a["action"], os.path.relpath(a["dst"], self.src)) for a in actions),
+            [("copy", "d/c"), ("remove", "extra"), ("update", "d/b")],
+        )
+        generator.drop([a for a in actions if a["action"] == "remove"])
+        script = os.path.join(self.tmpdir.name, "restore.py")
+        write(script, "\n".join(generator.generate()))
+        run([sys.executable, script], check=True, cwd=self.tmpdir.name)
+        for name in ("a", "d/b", "d/c", "extra"):
+            with open(os.path.join(self.src, name)) as f:
+                self.assertEqual(f.read(), name)
+
+    def test_modified_on_host(self):
+        """Verify that a file modified on the host after the backup is restored"""
+        write(os.path.join(self.dst, "src", "a"), "a")
+        write(os.path.join(self.src, "a"), "b")
+        os.utime(os.path.join(self.dst, "src", "a"), (1000, 1000))
+        config, _ = invert_config(self.get_config())
+        actions = PythonScriptGenerator(config).get_actions()
+        self.assertEqual(
+            [(a["action"], a["dst"]) for a in actions], [("update", os.path.join(self.src, "a"))]
+        )
@@ -0,0 +1,102 @@
+import os
+from copy import deepcopy
+from unittest import TestCase
+
+from base import AgnosticBase
+from review import PlanSummary
+from script_gen import LinuxScriptGenerator, PythonScriptGenerator
+from . import config
+
+
+def action(action: str, dst: str, size: int = 1) -> dict:
+    return {"src": None, "dst": dst, "action": action, "batch_id": 0, "size": size}
+
+
+class PlanSummaryTests(TestCase):
+
+    def setUp(self):
+        self.actions = [
+            action("remove", "/d/a/x", 5),
+            action("remove", "/d/a/y/z", 1),
+            action("remove", "/d/a-b", 2),
+            action("copy", "/d/a/n", 3),
+            action("copy", "/d/c", 4),
+        ]
+        self.summary = PlanSummary(self.actions, depth=1)
+
+    def test_get_range(self):
+        """Verify that siblings sharing the prefix are not in the subtree"""
+        self.assertEqual(
+            [a["dst"] for a in self.summary.get_range("/d/a")],
+            ["/d/a/n", "/d/a/x", "/d/a/y/z"],
+        )
+
+    def test_get_rows(self):
+        rows = self.summary.get_rows(depth=1)
+        self.assertEqual(
+            {k: len(v) for k, v in rows.items()},
+            {
+                ("remove", "/d/a"): 2,
+                ("remove", "/d/a-b"): 1,
+                ("copy", "/d/a"): 1,
+                ("copy", "/d/c"): 1,
+            },
+        )
+        text = self.summary.render(rows, "stats")
+        self.assertIn("remove\t/d/a\t2 actions\t6 bytes", text)
+        self.assertIn("largest: /d/a/x (5), /d/a/y/z (1)", text)
+
+    def test_default_depth(self):
+        """Verify that the files at the cut are grouped with their dir, with its subtree"""
+        actions = [action("copy", f"/b/d{i % 3}/f{i}") for i in range(300)]
+        actions += [action("copy", "/b/d0/sub/x"), action("copy", "/b/e/sub/y")]
+        actions += [action("copy", "/b/g")]
+        summary = PlanSummary(actions)
+        rows = summary.get_rows(depth=summary.depth)
+        self.assertEqual(
+            {k[1]: len(v) for k, v in rows.items()},
+            {"/b/d0": 101, "/b/d1": 100, "/b/d2": 100, "/b/e/sub": 1, "/b/g": 1},
+        )
+        text = summary.render(rows).replace("copy\t/b/d0\t", "+copy\t/b/d0\t")
+        rows, _, _ = summary.update(rows, text)
+        self.assertEqual(len(rows), 4 + 100 + 1)
+
+    def test_update(self):
+        """Verify that deleted rows drop their actions and '+' expands a row"""
+        rows = self.summary.get_rows(depth=1)
+        text = self.summary.render(rows).replace("remove\t/d/a\t", "+remove\t/d/a\t")
+        text = "\n".join(l for l in text.splitlines() if not l.startswith("copy\t/d/c"))
+        rows, dropped, expanded = self.summary.update(rows, text)
+        self.assertTrue(expanded)
+        self.assertEqual([a["dst"] for a in dropped], ["/d/c"])
+        self.assertIn(("remove", "/d/a/y"), rows)
+        self.assertNotIn(("remove", "/d/a"), rows)
+        rows, dropped, expanded = self.summary.update(rows, self.summary.render(rows))
+        self.assertFalse(expanded or dropped)
+
+
+class DropTests(TestCase, AgnosticBase):
+
+    def test_python(self):
+        """Verify that the dropped actions are left out without re-scanning"""
+        gen = PythonScriptGenerator(self.parse_config(deepcopy(config)))
+        gen.generate()
+        removal = next(a for a in gen.get_actions() if a["action"] == "remove")
+        gen.monitor.reset_scan()
+        gen.drop([removal])
+        self.assertNotIn(removal["dst"], "\n".join(gen.generate()))
+        self.assertEqual(gen.monitor.scan_cache, dict())
+
+    def test_linux(self):
+        """Verify that removals are left out and transfers excluded from rsync"""
+        gen = LinuxScriptGenerator(self.parse_config(deepcopy(config)))
+        gen.generate()
+        actions = gen.get_actions()
+        removal = next(a for a in actions if a["action"] == "remove")
+        transfer = next(a for a in actions if a["action"] != "remove")
+        gen.drop([removal, transfer])
+        script = "\n".join(gen.generate())
+        self.assertNotIn(f"rm -rfv '{os.path.normpath(removal['dst'])}'", script)
+        path = gen.config["paths"][transfer["batch_id"]]
+        self.assertIn(f"--exclude='/{os.path.relpath(transfer['dst'], path['dst'])}'", script)
+        self.assertNotIn(transfer, gen.get_actions())
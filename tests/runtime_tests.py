@@ -0,0 +1,282 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import runtime
+from runtime import cp, cpdir, meta, tee, CopyIO, Scheduler, Packer
+
+
+class RuntimeTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.src = os.path.join(self.root, "src")
+        os.makedirs(os.path.join(self.src, "sub", "empty"))
+        self.data = os.urandom(3 * (1 << 20) + 7)
+        with open(os.path.join(self.src, "sub", "a.bin"), "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_tee(self):
+        """Verify that all destinations receive identical content"""
+        dsts = [os.path.join(self.root, f"d{i}.bin") for i in range(3)]
+        tee(os.path.join(self.src, "sub", "a.bin"), dsts, bufsize=4096)
+        for d in dsts:
+            self.assertEqual(self.read(d), self.data)
+
+    def test_tee_error(self):
+        """Verify that a failing destination is reported"""
+        dsts = [os.path.join(self.root, "ok.bin"), os.path.join(self.root, "no/x.bin")]
+        with self.assertRaises(FileNotFoundError):
+            tee(os.path.join(self.src, "sub", "a.bin"), dsts, bufsize=4096)
+
+    def test_cp_fanout(self):
+        """Verify that cp creates parents and preserves mtime on all destinations"""
+        src = os.path.join(self.src, "sub", "a.bin")
+        os.utime(src, (1, 1))
+        dsts = [os.path.join(self.root, f"t{i}", "x", "a.bin") for i in range(2)]
+        cp(src, *dsts)
+        for d in dsts:
+            self.assertEqual(self.read(d), self.data)
+            self.assertEqual(os.stat(d).st_mtime, 1)
+
+    def test_meta(self):
+        """Verify that the metadata is applied without rewriting the data"""
+        src = os.path.join(self.src, "sub", "a.bin")
+        dsts = [os.path.join(self.root, f"m{i}.bin") for i in range(2)]
+        for d in dsts:
+            cp(src, d)
+        inodes = [os.stat(d).st_ino for d in dsts]
+        os.chmod(src, 0o600)
+        os.utime(src, (5, 5))
+        meta(src, *dsts)
+        for d, ino in zip(dsts, inodes):
+            st = os.stat(d)
+            self.assertEqual((st.st_ino, st.st_mtime, st.st_mode & 0o777), (ino, 5, 0o600))
+
+    def test_cpdir_fanout(self):
+        """Verify that the whole tree, including empty dirs, is copied"""
+        dsts = [os.path.join(self.root, f"t{i}") for i in range(3)]
+        cpdir(self.src, *dsts)
+        for d in dsts:
+            self.assertEqual(self.read(os.path.join(d, "sub", "a.bin")), self.data)
+            self.assertTrue(os.path.isdir(os.path.join(d, "sub", "empty")))
+
+
+class SchedulerTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.src = os.path.join(self.root, "src")
+        os.makedirs(os.path.join(self.src, "dir"))
+        self.sizes = {f"f{i}": i * 1024 for i in range(20)}
+        self.sizes["big"] = 256 * 1024
+        for name, size in self.sizes.items():
+            with open(os.path.join(self.src, name), "wb") as f:
+                f.write(os.urandom(size))
+        open(os.path.join(self.src, "dir", "x"), "w").close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_run(self):
+        """Verify that all queued copies are executed within the in-flight cap"""
+        sched = Scheduler(workers=2, max_workers=4, large_file=128 * 1024, inflight_bytes=64 * 1024)
+        for name in self.sizes:
+            sched.cp(os.path.join(self.src, name), os.path.join(self.root, "dst", name))
+        sched.cpdir(os.path.join(self.src, "dir"), os.path.join(self.root, "dst", "dir"))
+        self.assertEqual(len(sched.large), 2)
+        sched.run()
+        for name, size in self.sizes.items():
+            self.assertEqual(os.path.getsize(os.path.join(self.root, "dst", name)), size)
+        self.assertTrue(os.path.exists(os.path.join(self.root, "dst", "dir", "x")))
+        # the big file and the dir exceed the cap, so they are admitted alone
+        self.assertLessEqual(sched.max_inflight, 256 * 1024)
+
+    def test_locality(self):
+        """Verify that small files are executed in inode order"""
+        order = list()
+        sched = Scheduler(workers=1, max_workers=1)
+        names = sorted(self.sizes, reverse=True)
+        for name in names:
+            sched.add(lambda src, *_, **__: order.append(src), os.path.join(self.src, name), [], {})
+        sched.run()
+        self.assertEqual(order, sorted(order, key=lambda p: os.stat(p).st_ino))
+
+    def test_errors(self):
+        """Verify that a failed copy is raised after the other copies complete"""
+        sched = Scheduler()
+        sched.cp(os.path.join(self.src, "missing"), os.path.join(self.root, "dst", "m"))
+        sched.cp(os.path.join(self.src, "f1"), os.path.join(self.root, "dst", "f1"))
+        with self.assertRaises(FileNotFoundError):
+            sched.run()
+        self.assertTrue(os.path.exists(os.path.join(self.root, "dst", "f1")))
+
+    def test_adapt(self):
+        """Verify the additive increase and multiplicative decrease of workers"""
+        sched = Scheduler(workers=4, max_workers=8, window=1.0)
+        sched.window_start, sched.window_bytes = 0.0, 100
+        sched.adapt(1.0)
+        self.assertEqual(sched.limit, 5)
+        sched.window_bytes = 200
+        sched.adapt(2.0)
+        self.assertEqual(sched.limit, 6)
+        sched.window_bytes = 50
+        sched.adapt(3.0)
+        self.assertEqual(sched.limit, 3)
+        sched.window_bytes = 10
+        sched.adapt(3.5)
+        self.assertEqual(sched.limit, 3)
+
+
+class PackerTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.src = os.path.join(self.root, "src")
+        self.dst = os.path.join(self.root, "dst")
+        os.makedirs(os.path.join(self.src, "sub"))
+        self.names = [f"f{i}" for i in range(10)] + ["sub/a", "big"]
+        for name in self.names:
+            with open(os.path.join(self.src, name), "wb") as f:
+                f.write(os.urandom(2048 if name == "big" else 100))
+            os.utime(os.path.join(self.src, name), (1000.5, 1000.5))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_cp(self):
+        """Verify that small files are packed in batches and big ones copied by the fallback"""
+        fallback = list()
+        packer = Packer(
+            small_file=1024,
+            batch=4,
+            min_batch=1,
+            max_batch=4,
+            fallback=lambda *a, **k: fallback.append(a),
+        )
+        for name in self.names:
+            packer.cp(os.path.join(self.src, name), os.path.join(self.dst, name))
+        packer.close()
+        self.assertEqual(fallback, [(os.path.join(self.src, "big"), os.path.join(self.dst, "big"))])
+        self.assertEqual(packer.batches, 3)
+        for name in self.names[:-1]:
+            self.assertEqual(
+                self.read(os.path.join(self.src, name)), self.read(os.path.join(self.dst, name))
+            )
+            self.assertEqual(os.stat(os.path.join(self.dst, name)).st_mtime, 1000.5)
+        self.assertFalse(any(n.endswith(runtime.PART) for n in os.listdir(self.dst)))
+
+    def test_journal(self):
+        """Verify that packed copies are journaled once unpacked and skipped when done"""
+        journal = os.path.join(self.root, "journal")
+        runtime.open_journal(journal)
+        try:
+            packer = Packer()
+            packer.cp(os.path.join(self.src, "f0"), os.path.join(self.dst, "f0"), aid=1)
+            with self.assertRaises(FileNotFoundError):
+                packer.cp(os.path.join(self.src, "missing"), os.path.join(self.dst, "m"), aid=2)
+            runtime.done.add("3")
+            packer.cp(os.path.join(self.src, "f1"), os.path.join(self.dst, "f1"), aid=3)
+            packer.close()
+        finally:
+            runtime.journal.close()
+            runtime.journal = None
+            runtime.done.clear()
+        with open(journal) as f:
+            self.assertEqual(f.read(), "1\n")
+        self.assertFalse(os.path.exists(os.path.join(self.dst, "f1")))
+
+    def test_adapt(self):
+        """Verify that batches follow the smoothed per-file latency"""
+        packer = Packer(min_batch=8, max_batch=1000, target=1.0)
+        packer.adapt(0.01)
+        self.assertEqual(packer.batch, 100)
+        packer.adapt(0.01 + 0.01 / 0.3)
+        self.assertEqual(packer.batch, 50)
+        packer.adapt(10)
+        self.assertEqual(packer.batch, 8)
+        packer.latency = 1e-9
+        packer.adapt(1e-9)
+        self.assertEqual(packer.batch, 1000)
+
+    def test_relative(self):
+        """Verify that relative destinations are unpacked where they are, not under the root"""
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            packer = Packer()
+            packer.cp(os.path.join(self.src, "f0"), "rel/f0")
+            packer.close()
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(
+            self.read(os.path.join(self.root, "rel/f0")), self.read(os.path.join(self.src, "f0"))
+        )
+
+    def test_inflight(self):
+        """Verify that the writers hold at most the cap of unpacked data"""
+        packer = Packer(inflight_bytes=250, workers=4)
+        names = self.names[:-1]
+        for name in names:
+            packer.cp(os.path.join(self.src, name), os.path.join(self.dst, name))
+        packer.close()
+        self.assertLessEqual(packer.max_inflight, 250)
+        self.assertEqual(packer.inflight, 0)
+        for name in names:
+            self.assertEqual(
+                self.read(os.path.join(self.src, name)), self.read(os.path.join(self.dst, name))
+            )
+
+
+class CopyIOTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.root = self.tmpdir.name
+
+    def tearDown(self):
+        runtime.copy_io = None
+        self.tmpdir.cleanup()
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_copy(self):
+        """Verify the content of the buffered and direct copies, aligned or not"""
+        for size in (0, 5, 4096, 3 * (1 << 20) + 7):
+            src = os.path.join(self.root, f"s{size}")
+            data = os.urandom(size)
+            with open(src, "wb") as f:
+                f.write(data)
+            for name, direct in (("buffered", None), ("direct", 1)):
+                with self.subTest(size=size, mode=name):
+                    dst = os.path.join(self.root, f"{name}{size}")
+                    engine = CopyIO(bufsize=1 << 20, prealloc=1, direct=direct, window=1 << 20)
+                    engine.copy(src, dst)
+                    self.assertEqual(self.read(dst), data)
+
+    def test_set_io(self):
+        """Verify that the copies of the script use the configured CopyIO"""
+        src, dst = os.path.join(self.root, "a"), os.path.join(self.root, "t", "a")
+        with open(src, "wb") as f:
+            f.write(b"a" * 10)
+        os.utime(src, (1, 1))
+        runtime.set_io(window=1 << 20)
+        cp(src, dst)
+        self.assertIsInstance(runtime.copy_io, CopyIO)
+        self.assertEqual((self.read(dst), os.stat(dst).st_mtime), (b"a" * 10, 1))
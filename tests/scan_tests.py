@@ -0,0 +1,105 @@
+import re
+from unittest import TestCase
+
+from scan import ParallelWalker, SharedScan, build_tree, build_tree_parallel
+from . import SWD
+
+
+class SharedScanTests(TestCase):
+
+    def setUp(self):
+        self.root = f"{SWD}/data/src"
+        self.venv = re.compile(r"(/venv|/__.)")
+        self.none = re.compile(r".^")
+
+    def test_plan(self):
+        """Verify that nested roots are deduplicated"""
+        scan = SharedScan()
+        plan = scan.plan(
+            [
+                (f"{self.root}/dir1", self.venv),
+                (f"{self.root}/dir1/dir2", self.venv),
+                (f"{self.root}/dir1 x", self.venv),
+                (f"{self.root}/dir6", self.venv),
+                (f"{self.root}/dir6/dir7", self.none),
+            ]
+        )
+        self.assertEqual(
+            plan,
+            {
+                f"{self.root}/dir1": self.venv,
+                f"{self.root}/dir1 x": self.venv,
+                f"{self.root}/dir6": SharedScan.no_exclude,
+            },
+        )
+
+    def test_get(self):
+        """Verify that the snapshot gives the same results as a direct walk"""
+        scan = SharedScan(workers=2)
+        scan.prefetch([(self.root, self.none), (f"{self.root}/dir1", self.venv)])
+        self.assertEqual(list(scan.snapshots), [self.root])
+        for rootdir in (
+            self.root,
+            f"{self.root}/dir1",
+            f"{self.root}/dir1/dir2",
+            f"{self.root}/g.xml",
+            f"{self.root}/missing",
+        ):
+            for excl in (self.none, self.venv):
+                fp_direct, fp_shared = dict(), dict()
+                self.assertEqual(
+                    scan.get(rootdir, excl, fp_shared),
+                    build_tree(rootdir, excl, fp_direct),
+                    rootdir,
+                )
+                self.assertEqual(fp_shared.keys() - {rootdir}, fp_direct.keys() - {rootdir})
+
+    def test_get_pruned(self):
+        """Verify that a root inside a pruned dir is walked directly"""
+        scan = SharedScan()
+        scan.prefetch([(f"{self.root}/dir1", self.venv)])
+        venv = f"{self.root}/dir1/dir2/venv"
+        self.assertEqual(
+            scan.get(venv, self.none, dict()), {f"{venv}/e.whl", f"{venv}/f.h"}
+        )
+
+
+class ParallelWalkerTests(TestCase):
+
+    def setUp(self):
+        self.root = f"{SWD}/data/src"
+        self.venv = re.compile(r"(/venv|/__.)")
+
+    def test_build_tree(self):
+        """Verify that the parallel walk gives the same results as build_tree"""
+        for rootdir in (
+            self.root,
+            f"{self.root}/dir1",
+            f"{self.root}/g.xml",
+            f"{self.root}/missing",
+        ):
+            for workers in (1, 4):
+                exp_fp, exp_kinds, fp, kinds = dict(), dict(), dict(), dict()
+                exp = build_tree(rootdir, self.venv, exp_fp, exp_kinds)
+                res = build_tree_parallel(rootdir, self.venv, fp, kinds, workers)
+                self.assertEqual(res, exp, rootdir)
+                self.assertEqual(fp, exp_fp)
+                self.assertEqual(kinds, exp_kinds)
+        self.assertFalse(any(self.venv.search(p) for p in res))
+
+    def test_order(self):
+        """Verify that the merged order doesn't depend on the workers"""
+        exp = ParallelWalker(1).walk(self.root, self.venv)
+        self.assertEqual([d for d, _, _ in exp], sorted(d for d, _, _ in exp))
+        for _ in range(5):
+            self.assertEqual(ParallelWalker(8).walk(self.root, self.venv), exp)
+
+    def test_error(self):
+        """Verify that a failed listing is raised"""
+        def list_dir(current, exclude):
+            raise PermissionError(current)
+
+        walker = ParallelWalker(4)
+        walker.list_dir = list_dir
+        with self.assertRaises(PermissionError):
+            walker.walk(self.root, self.venv)
@@ -0,0 +1,71 @@
+import os
+from copy import deepcopy
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from base import AgnosticBase
+from monitors import LinuxMonitor, PythonMonitor
+from spill import ExternalSorter, SpillList, difference, parse_budget
+from . import config
+
+class SpillTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_external_sorter(self):
+        """Verify that the runs are merged sorted and unique"""
+        sorter = ExternalSorter(500, self.tmpdir.name)
+        items = [f"/d{i % 7}/f\n{i % 50}" for i in range(200)]
+        sorter.extend(items)
+        self.assertGreater(len(sorter.runs), 10)
+        self.assertEqual(list(sorter), sorted(set(items)))
+        sorter.close()
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_difference(self):
+        self.assertEqual(list(difference(["a", "b", "c", "e"], ["b", "d", "e", "f"])), ["a", "c"])
+        self.assertEqual(list(difference(["a"], [])), ["a"])
+
+    def test_spill_list(self):
+        """Verify that the spilled actions keep their order"""
+        actions = SpillList(1000, self.tmpdir.name)
+        items = [{"src": f"s{i}", "dst": f"d{i}", "action": "copy", "batch_id": 0} for i in range(20)]
+        actions.extend(items)
+        self.assertTrue(actions.path)
+        self.assertEqual(list(actions), items)
+        self.assertEqual(len(actions), 20)
+        actions.close()
+
+    def test_parse_budget(self):
+        self.assertEqual(parse_budget(None), 0)
+        self.assertEqual(parse_budget(2), 2 << 20)
+        self.assertEqual(parse_budget({"budget": 0.5}), 1 << 19)
+
+
+class BoundedMonitorTests(TestCase, AgnosticBase):
+
+    def get_config(self, memory=None) -> dict:
+        cfg = self.parse_config(deepcopy(config))
+        if memory:
+            cfg["settings"]["memory"] = memory
+        return cfg
+
+    def test_generate(self):
+        """Verify that the plan is the same as the unbounded one"""
+        exp = PythonMonitor(self.get_config()).generate()
+        res = PythonMonitor(self.get_config({"budget": 0.001})).generate()
+        key = lambda a: (a["action"], a["src"] or "", a["dst"])
+        self.assertTrue(exp)
+        self.assertEqual(sorted(res, key=key), sorted(exp, key=key))
+
+    def test_collect_diff(self):
+        exp = LinuxMonitor(self.get_config())
+        exp.generate()
+        res = LinuxMonitor(self.get_config(0.001))
+        res.generate()
+        self.assertEqual(res.diff, exp.diff)
+        self.assertEqual(res.out, exp.out)
@@ -0,0 +1,104 @@
+import os
+import shutil
+from copy import deepcopy
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from base import AgnosticBase
+from monitors import PythonMonitor
+from verify import Verifier, compare, get_options, sample_equal
+from . import config
+
+
+class VerifierTests(TestCase, AgnosticBase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        self.dst = os.path.join(self.tmpdir.name, "dst")
+        os.makedirs(os.path.join(self.src, "sub"))
+        os.makedirs(os.path.join(self.src, "skip"))
+        for name, data in {"a": b"a", "sub/b": b"b", "skip/c": b"c"}.items():
+            with open(os.path.join(self.src, name), "wb") as f:
+                f.write(data)
+        shutil.copytree(self.src, os.path.join(self.dst, "src"))
+        cfg = deepcopy(config)
+        cfg["paths"] = [{"src": self.src, "dst": self.dst, "exclude": ["*skip*"]}]
+        self.monitor = PythonMonitor(self.parse_config(cfg))
+        self.verifier = Verifier(self.monitor, workers=2, bufsize=2)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def dst_path(self, name: str) -> str:
+        return os.path.join(self.dst, "src", name)
+
+    def test_compare(self):
+        """Verify that content, size and existence are compared"""
+        pair = (os.path.join(self.src, "a"), self.dst_path("a"))
+        self.assertIsNone(compare(pair, bufsize=1))
+        with open(self.dst_path("a"), "wb") as f:
+            f.write(b"x")
+        self.assertEqual(compare(pair), "checksum differs")
+        with open(self.dst_path("a"), "wb") as f:
+            f.write(b"xx")
+        self.assertEqual(compare(pair), "size differs")
+        os.remove(self.dst_path("a"))
+        self.assertEqual(compare(pair), f"missing {self.dst_path('a')}")
+
+    def test_get_pairs(self):
+        """Verify that the excluded files are not verified"""
+        self.assertEqual(
+            sorted(self.verifier.get_pairs("full")),
+            [
+                (os.path.join(self.src, "a"), self.dst_path("a")),
+                (os.path.join(self.src, "sub/b"), self.dst_path("sub/b")),
+            ],
+        )
+        self.assertEqual(len(self.verifier.get_pairs("sample", 0.5)), 1)
+        transfers = [
+            {"src": os.path.join(self.src, "sub"), "dst": self.dst_path("sub"), "batch_id": 0}
+        ]
+        self.assertEqual(
+            self.verifier.get_pairs("touched", transfers=transfers),
+            [(os.path.join(self.src, "sub/b"), self.dst_path("sub/b"))],
+        )
+
+    def test_run(self):
+        """Verify that mismatches are found by the process pool"""
+        with open(self.dst_path("sub/b"), "wb") as f:
+            f.write(b"x")
+        self.assertEqual(
+            self.verifier.run(self.verifier.get_pairs("full")),
+            [(os.path.join(self.src, "sub/b"), self.dst_path("sub/b"), "checksum differs")],
+        )
+
+    def test_sample_equal(self):
+        """Verify that the sampled blocks, and only them, are compared"""
+        a, b = os.path.join(self.src, "big"), self.dst_path("big")
+        data = bytearray(os.urandom(100_000))
+        for path in (a, b):
+            with open(path, "wb") as f:
+                f.write(data)
+        self.assertTrue(sample_equal(a, b, samples=4, block=1000))
+        with open(b, "r+b") as f:
+            # within the last block
+            f.seek(99_500)
+            f.write(b"x")
+        self.assertFalse(sample_equal(a, b, samples=4, block=1000))
+        self.assertFalse(sample_equal(a, b, samples=0))
+        with open(b, "r+b") as f:
+            f.seek(99_500)
+            f.write(data[99_500:99_501])
+            # between the samples
+            f.seek(50_000)
+            f.write(b"x" if data[50_000:50_001] != b"x" else b"y")
+        self.assertTrue(sample_equal(a, b, samples=4, block=1000))
+        self.assertFalse(sample_equal(a, b, samples=0))
+        self.assertFalse(sample_equal(a, os.path.join(self.src, "a")))
+
+    def test_get_options(self):
+        self.assertEqual(get_options("full"), {"mode": "full"})
+        self.assertEqual(get_options(True), {"mode": "touched"})
+        with self.assertRaises(ValueError):
+            get_options("all")
@@ -0,0 +1,126 @@
+"""Post-backup verification. Checksums of the source and destination files
+are compared by a pool of processes, each reading the files sequentially"""
+
+import os
+import random
+import hashlib
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+from monitors import AgnosticMonitor
+
+BUFSIZE = 8 << 20
+MODES = {"touched", "sample", "full"}
+
+
+def hash_file(path: str, bufsize: int = BUFSIZE) -> str:
+    h = hashlib.blake2b()
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def compare(pair: tuple, bufsize: int = BUFSIZE) -> str:
+    """Returns the reason of the mismatch, None if both files have the same content"""
+    src, dst = pair
+    try:
+        if os.path.getsize(src) != os.path.getsize(dst):
+            return "size differs"
+        if hash_file(src, bufsize) != hash_file(dst, bufsize):
+            return "checksum differs"
+    except FileNotFoundError as e:
+        return f"missing {e.filename}"
+    except OSError as e:
+        return str(e)
+    return None
+
+
+def sample_equal(src: str, dst: str, samples: int = 0, block: int = 1 << 16) -> bool:
+    """Quick check of the content: blocks spread evenly over the files, the first and the last
+    included. Files of up to 'samples' blocks are compared whole, as are all with samples=0"""
+    size = os.path.getsize(src)
+    if os.path.getsize(dst) != size:
+        return False
+    if not samples or size <= samples * block:
+        offsets = range(0, size, block)
+    else:
+        step = (size - block) / max(1, samples - 1)
+        offsets = sorted({int(i * step) for i in range(samples)})
+    with open(src, "rb", buffering=0) as a, open(dst, "rb", buffering=0) as b:
+        for pos in offsets:
+            if os.pread(a.fileno(), block, pos) != os.pread(b.fileno(), block, pos):
+                return False
+    return True
+
+
+def get_options(opts) -> dict:
+    """Normalize the 'verify' setting: a mode or {mode, fraction, workers, bufsize}"""
+    if isinstance(opts, str):
+        opts = {"mode": opts}
+    opts = dict(opts) if isinstance(opts, dict) else dict()
+    opts.setdefault("mode", "touched")
+    if opts["mode"] not in MODES:
+        raise ValueError(f"Unknown verify mode {opts['mode']}, use one of {MODES}")
+    return opts
+
+
+class Verifier:
+    """Selects pairs of (src, dst) files with the walker and excludes of the monitor,
+    then compares their checksums across a process pool"""
+
+    def __init__(self, monitor: AgnosticMonitor, workers: int = None, bufsize: int = BUFSIZE):
+        self.monitor = monitor
+        self.workers = workers or os.cpu_count() or 1
+        self.bufsize = bufsize
+
+    def get_pairs(self, mode: str = "full", fraction: float = 1.0, transfers: list = None) -> list:
+        """Files to verify - those of the transfers ('touched'), or a 'sample'
+        of the fraction or all ('full') files of the mirrored paths"""
+        if mode == "touched":
+            pairs = list()
+            for t in transfers or []:
+                pairs.extend(self.expand(t))
+            return pairs
+        pairs = [p for path in self.get_paths() for p in self.expand_path(path)]
+        if mode == "sample":
+            pairs = random.sample(pairs, round(len(pairs) * fraction))
+        return pairs
+
+    def get_paths(self) -> list:
+        return [p for p in self.monitor.context.paths if self.monitor.is_mirrored(p)]
+
+    def expand_path(self, path: dict) -> list:
+        return self.expand(
+            {
+                "src": path["src"],
+                "dst": self.monitor.context.get_target_root(path),
+                "batch_id": path["batch_id"],
+            }
+        )
+
+    def expand(self, transfer: dict) -> list:
+        """Pairs of files of the transfer. Dirs are walked with the path's exclude"""
+        src, dst = transfer["src"], transfer["dst"]
+        if not self.monitor.context.isdir(src):
+            return [(src, dst)]
+        path = self.monitor.config["paths"][transfer["batch_id"]]
+        excl = self.monitor.parse_rsync_exclude(path.get("exclude"))
+        return sorted(
+            (s, f"{dst}{s[len(src):]}")
+            for s in self.monitor.btr(src, excl)
+            if not self.monitor.context.isdir(s)
+        )
+
+    def run(self, pairs: list) -> list:
+        """Returns mismatches [(src, dst, reason)]"""
+        fn = functools.partial(compare, bufsize=self.bufsize)
+        if self.workers == 1 or len(pairs) < 2:
+            results = map(fn, pairs)
+            return [(*p, r) for p, r in zip(pairs, results) if r]
+        chunksize = max(1, len(pairs) // (self.workers * 16))
+        with ProcessPoolExecutor(self.workers) as pool:
+            results = pool.map(fn, pairs, chunksize=chunksize)
+            return [(*p, r) for p, r in zip(pairs, results) if r]